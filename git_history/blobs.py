@@ -0,0 +1,126 @@
+import io
+import subprocess
+
+# Blobs at least this large are streamed to the built-in converters rather
+# than being read into memory first
+STREAM_THRESHOLD = 1024 * 1024
+
+
+class Blob(bytes):
+    "The contents of a file, with the sha of the Git blob they were read from"
+
+    def __new__(cls, data, sha):
+        blob = super().__new__(cls, data)
+        blob.sha = sha
+        return blob
+
+    def __reduce__(self):
+        return Blob, (bytes(self), self.sha)
+
+
+class BlobReader:
+    """
+    Reads file contents from a repository using one long-running
+    "git cat-file --batch" process, so each blob costs a round trip on a
+    pipe rather than a new process or a pure-Python object lookup.
+
+    open() returns a BlobStream which reads the blob directly from the
+    pipe, and read() returns a Blob. Only one stream can be in use at a
+    time - opening the next blob skips whatever is left of the previous one.
+    """
+
+    def __init__(self, repo_path):
+        self.process = subprocess.Popen(
+            ["git", "cat-file", "--batch"],
+            cwd=repo_path,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self.stream = None
+
+    def open(self, commit_hash, path):
+        "Returns a BlobStream for path as of commit_hash, or None if it is missing"
+        return self.open_object("{}:{}".format(commit_hash, path))
+
+    def open_object(self, name):
+        "Returns a BlobStream for a blob sha or other object name, or None"
+        if self.stream is not None:
+            self.stream.close()
+        self.process.stdin.write("{}\n".format(name).encode("utf-8"))
+        self.process.stdin.flush()
+        header = self.process.stdout.readline().split()
+        if len(header) != 3:
+            # "<object> missing", or a tree or submodule
+            return None
+        self.stream = BlobStream(
+            self.process.stdout, header[0].decode("ascii"), int(header[2])
+        )
+        return self.stream
+
+    def read(self, commit_hash, path):
+        "Returns the contents of path as of commit_hash as a Blob, or None"
+        stream = self.open(commit_hash, path)
+        return None if stream is None else stream.read_blob()
+
+    def read_object(self, name):
+        "Returns the blob with this sha or object name as a Blob, or None"
+        stream = self.open_object(name)
+        return None if stream is None else stream.read_blob()
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        self.process.stdin.close()
+        self.process.stdout.close()
+        # Worker processes forked while this was open share its stdin, so
+        # git may never see it close - there is nothing left to read anyway
+        self.process.terminate()
+        self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BlobStream(io.RawIOBase):
+    """
+    A read-only file-like object for the size bytes of one blob in the
+    output of git cat-file. Wrap it in io.TextIOWrapper to read text.
+    """
+
+    def __init__(self, pipe, sha, size):
+        self.pipe = pipe
+        self.sha = sha
+        self.size = size
+        self.remaining = size
+
+    def read_blob(self):
+        "Read the rest of the blob into a Blob"
+        return Blob(self.read(), self.sha)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.closed:
+            raise ValueError("I/O operation on closed blob")
+        view = memoryview(buffer)[: self.remaining]
+        if not view:
+            return 0
+        read = self.pipe.readinto(view)
+        self.remaining -= read
+        return read
+
+    def close(self):
+        if not self.closed:
+            # Skip anything that was not read, and the trailing newline
+            while self.remaining:
+                chunk = self.pipe.read(min(self.remaining, 64 * 1024))
+                if not chunk:
+                    break
+                self.remaining -= len(chunk)
+            self.pipe.read(1)
+        super().close()
@@ -0,0 +1,184 @@
+import os
+
+# Tables shared by every namespace in a database. The catalog has a view for
+# each of them combining the rows from every shard.
+GLOBAL_TABLES = ("namespaces", "commits", "columns", "refs", "ref_commits")
+# Every shard numbers its commits, columns and so on from 1, so the views add
+# the id of the shard times this to the primary keys of GLOBAL_TABLES and to
+# the columns that refer to them. That keeps the ids unique, and joins between
+# the views match the same rows as joins between the tables in each shard.
+ID_STRIDE = 1 << 32
+
+
+def add_shards(db, paths):
+    """
+    Record the database files in paths as shards of the catalog db, a
+    sqlite_utils Database, creating its shards table if necessary.
+
+    Paths are stored relative to the catalog. Raises ValueError if any
+    namespace would then be in more than one shard.
+    """
+    import sqlite_utils
+
+    directory = _directory(db.conn)
+    if not db["shards"].exists():
+        db["shards"].create({"id": int, "path": str}, pk="id")
+        db["shards"].create_index(["path"], unique=True)
+    existing = [row[0] for row in db.execute("select path from shards order by id")]
+    new = [os.path.relpath(os.path.abspath(path), directory) for path in paths]
+    owners = {}
+    for path in existing + [path for path in new if path not in existing]:
+        filename = os.path.join(directory, path)
+        if not os.path.exists(filename):
+            raise ValueError("Shard {} does not exist".format(filename))
+        shard = sqlite_utils.Database(filename)
+        if shard["namespaces"].exists():
+            for (namespace,) in shard.execute("select name from namespaces"):
+                _claim(owners, namespace, path)
+    with db.conn:
+        db["shards"].insert_all(({"path": path} for path in new), ignore=True)
+
+
+def attach_shards(conn):
+    """
+    ATTACH every shard recorded in the catalog opened as the sqlite3
+    connection conn, then create temporary views in it that look like the
+    tables of a single database: one for each of the GLOBAL_TABLES, with the
+    rows from every shard, and one for each namespace table, such as item,
+    item_version and item_changed. Full-text search tables and views are not
+    included - query those in the shard, for example shard_1.item_fts.
+
+    The shards are attached as shard_1, shard_2 and so on, by their id in
+    the shards table. Returns a dictionary mapping each of those names to
+    the path of the file.
+    """
+    directory = _directory(conn)
+    shards = conn.execute("select id, path from shards order by id").fetchall()
+    owners = {}
+    # view name -> [(schema, table, offset, id_columns())]
+    sources = {}
+    attached = {}
+    for shard_id, path in shards:
+        schema = "shard_{}".format(shard_id)
+        filename = os.path.join(directory, path)
+        if not os.path.exists(filename):
+            # ATTACH would quietly create an empty database
+            raise ValueError("Shard {} does not exist".format(filename))
+        conn.execute("attach database ? as [{}]".format(schema), [filename])
+        attached[schema] = filename
+        tables = schema_tables(conn, schema)
+        namespaces = (
+            [
+                row[0]
+                for row in conn.execute(
+                    "select name from [{}].namespaces".format(schema)
+                )
+            ]
+            if "namespaces" in tables
+            else []
+        )
+        for namespace in namespaces:
+            _claim(owners, namespace, path)
+        for table in tables:
+            if table not in GLOBAL_TABLES and namespace_of(table, namespaces) is None:
+                continue
+            sources.setdefault(table, []).append(
+                (schema, table, shard_id * ID_STRIDE, id_columns(conn, schema, table))
+            )
+    for view, view_sources in sources.items():
+        conn.execute("drop view if exists temp.[{}]".format(view))
+        conn.execute(
+            "create temp view [{}] as {}".format(
+                view, "\nunion all\n".join(_selects(view_sources))
+            )
+        )
+    return attached
+
+
+def _directory(conn):
+    "The directory containing the main database of conn"
+    for _, name, filename in conn.execute("pragma database_list"):
+        if name == "main" and filename:
+            return os.path.dirname(filename)
+    return os.getcwd()
+
+
+def _claim(owners, namespace, path):
+    if owners.setdefault(namespace, path) != path:
+        raise ValueError(
+            "Namespace {} is in more than one shard: {} and {}".format(
+                namespace, owners[namespace], path
+            )
+        )
+
+
+def schema_tables(conn, schema):
+    "Names of the ordinary tables in schema, excluding full-text search indexes"
+    rows = conn.execute(
+        "select name, sql from [{}].sqlite_master where type = 'table'".format(schema)
+    ).fetchall()
+    virtual = [
+        name for name, sql in rows if sql and sql.upper().startswith("CREATE VIRTUAL")
+    ]
+    return [
+        name
+        for name, _ in rows
+        if not name.startswith("sqlite_")
+        and name not in virtual
+        and not any(name.startswith(table + "_") for table in virtual)
+    ]
+
+
+def namespace_of(table, namespaces):
+    "The longest namespace whose tables could include table, or None"
+    matches = [
+        namespace
+        for namespace in namespaces
+        if table == namespace or table.startswith(namespace + "_")
+    ]
+    return max(matches, key=len, default=None)
+
+
+def id_columns(conn, schema, table):
+    """
+    Returns {column: table} for every column of table, in order, where table
+    is the one of GLOBAL_TABLES whose ids the column holds, or None
+    """
+    references = {
+        row[3]: row[2]
+        for row in conn.execute(
+            "pragma [{}].foreign_key_list([{}])".format(schema, table)
+        )
+        if row[2] in GLOBAL_TABLES
+    }
+    columns = {}
+    for row in conn.execute("pragma [{}].table_info([{}])".format(schema, table)):
+        name = row[1]
+        if name in references:
+            columns[name] = references[name]
+        elif name == "_commit":
+            # The item table's _commit column is added without a foreign key
+            columns[name] = "commits"
+        elif table in GLOBAL_TABLES and row[5] == 1:
+            columns[name] = table
+        else:
+            columns[name] = None
+    return columns
+
+
+def _selects(sources):
+    "A select for each shard, with every column any of the shards has"
+    all_columns = []
+    for _, _, _, columns in sources:
+        all_columns.extend(column for column in columns if column not in all_columns)
+    for schema, table, offset, columns in sources:
+        expressions = []
+        for column in all_columns:
+            if column not in columns:
+                expression = "null"
+            elif columns[column]:
+                expression = "[{}] + {}".format(column, offset)
+            else:
+                expression = "[{}]".format(column)
+            expressions.append("{} as [{}]".format(expression, column))
+        yield "select {} from [{}].[{}]".format(", ".join(expressions), schema, table)
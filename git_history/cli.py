@@ -1,37 +1,298 @@
 import click
-import git
-import hashlib
+import csv
+import datetime
 import json
-import sqlite_utils
-import textwrap
+import sys
 from pathlib import Path
-from .utils import RESERVED_SET, fix_reserved_columns, jsonify_if_needed
+from .query import (
+    UnknownRef,
+    as_of_sql,
+    data_columns,
+    diff_commits,
+    iterate_items,
+    iterate_items_as_of,
+    iterate_versions,
+    resolve_commit_id,
+    resolve_ref_id,
+    version_columns,
+)
+from .utils import parse_timestamp
+
+# GitPython, sqlite-utils and the multiprocessing machinery are imported by
+# the commands that use them, so that --help and runs with nothing to do
+# start quickly
+
+
+# Fields read for each commit by log_commits(), as (key, git log placeholder)
+LOG_FIELDS = (
+    ("hash", "%H"),
+    ("parents", "%P"),
+    ("author_name", "%an"),
+    ("author_email", "%ae"),
+    ("authored_at", "%aI"),
+    ("committer_name", "%cn"),
+    ("committer_email", "%ce"),
+    ("commit_at", "%cI"),
+    ("message", "%B"),
+)
+# Commits start with a record separator and fields are split by a unit
+# separator, as neither of those turn up in commit messages
+LOG_FORMAT = "%x1e" + "%x1f".join(placeholder for _, placeholder in LOG_FIELDS)
+
+
+def log_commits(repo_path, filepath, ref="main", since=None, until=None, follow=False):
+    """
+    Yields a dictionary of metadata for each commit that changed filepath,
+    newest first, streamed from a single git log process. parents is a list
+    of hashes and the times are ISO 8601 strings with timezone offsets.
+
+    ref can be a list of refs, in which case every commit reachable from
+    any of them is included once.
+
+    follow=True continues with the previous path each time the file turns
+    out to have been renamed or moved - see git_history.follow - and adds a
+    "path" key with the path of the file in that commit.
+    """
+    import git
+
+    refs = [ref] if isinstance(ref, str) else list(ref)
+    path = Path(filepath).relative_to(repo_path).as_posix()
+    repo_git = git.Repo(repo_path).git
+    options = ["--format={}".format(LOG_FORMAT)]
+    # since and until are passed to git log, so it does the filtering
+    if since:
+        options.append("--since={}".format(since))
+    if until:
+        options.append("--until={}".format(until))
+    blobs = None
+    try:
+        while True:
+            oldest = None
+            for commit in _log_commits(repo_git, options, refs, path):
+                if follow:
+                    commit["path"] = path
+                yield commit
+                oldest = commit
+            if not follow or oldest is None:
+                break
+            if blobs is None:
+                from .blobs import BlobReader
+
+                blobs = BlobReader(repo_path)
+            from .follow import find_previous_path
+
+            previous_path = find_previous_path(repo_git, blobs, oldest, path)
+            if previous_path is None:
+                break
+            # Carry on from before the commit that moved it
+            path, refs = previous_path, oldest["parents"][:1]
+    finally:
+        if blobs is not None:
+            blobs.close()
+
+
+def _log_commits(repo_git, options, refs, path):
+    if len(refs) > 1:
+        # Never list a commit before one of its parents from another ref
+        options = options + ["--date-order"]
+    process = repo_git.log(*options, *refs, "--", path, as_process=True)
+    pending = b""
+    for chunk in iter(lambda: process.stdout.read(64 * 1024), b""):
+        records = (pending + chunk).split(b"\x1e")
+        pending = records.pop()
+        for record in records:
+            if record:
+                yield parse_log_record(record)
+    if pending:
+        yield parse_log_record(pending)
+    # Raises GitCommandError if git log failed, for example for a missing ref
+    process.wait()
+
+
+def ref_lineage(repo_path, paths, refs):
+    """
+    Returns {ref: (hash of the commit it points to, hashes of the commits
+    reachable from it that changed any of the paths)} - paths are relative
+    to the root of the repository
+    """
+    import git
+
+    repo_git = git.Repo(repo_path).git
+    return {
+        ref: (
+            repo_git.rev_parse(ref),
+            set(repo_git.rev_list(ref, "--", *paths).split()),
+        )
+        for ref in refs
+    }
+
+
+def rewritten_commits(repo_path, refs, hashes):
+    """
+    Given commit hashes in the order they were ingested, returns them from
+    the first one that can no longer be reached from any of the refs - for
+    example because the branch was rebased or force-pushed
+    """
+    import git
+    import subprocess
+
+    if not hashes:
+        return []
+    repo_git = git.Repo(repo_path).git
+    if len(refs) == 1:
+        # Every earlier commit is an ancestor of the last one, so if that is
+        # still there then nothing has changed
+        try:
+            repo_git.merge_base("--is-ancestor", hashes[-1], refs[0])
+            return []
+        except git.GitCommandError:
+            pass
+    if repo_git.rev_parse("--is-shallow-repository") == "true":
+        # Commits from before a shallow clone are missing but not rewritten
+        checked = subprocess.run(
+            ["git", "cat-file", "--batch-check"],
+            cwd=repo_path,
+            input="".join(commit_hash + "\n" for commit_hash in hashes).encode(),
+            stdout=subprocess.PIPE,
+            check=True,
+        ).stdout.splitlines()
+        hashes = [
+            commit_hash
+            for commit_hash, line in zip(hashes, checked)
+            if not line.endswith(b" missing")
+        ]
+    reachable = set(repo_git.rev_list(*refs).split())
+    for i, commit_hash in enumerate(hashes):
+        if commit_hash not in reachable:
+            return hashes[i:]
+    return []
+
+
+def parse_log_record(record):
+    values = record.decode("utf-8", errors="replace").split("\x1f")
+    commit = dict(zip((key for key, _ in LOG_FIELDS), values))
+    commit["parents"] = commit["parents"].split()
+    # git log adds a blank line after each commit
+    commit["message"] = commit["message"].rstrip("\n")
+    return commit
 
 
 def iterate_file_versions(
-    repo_path, filepath, ref="main", commits_to_skip=None, show_progress=False
+    repo_path,
+    filepath,
+    ref="main",
+    commits_to_skip=None,
+    show_progress=False,
+    every=None,
+    one_per=None,
+    since=None,
+    until=None,
+    commits=None,
+    stream=False,
 ):
-    relative_path = str(Path(filepath).relative_to(repo_path))
-    repo = git.Repo(repo_path, odbt=git.GitDB)
-    commits = reversed(list(repo.iter_commits(ref, paths=[relative_path])))
+    """
+    Yields (commit_at, commit_hash, content) for every version of filepath,
+    oldest first. ref can be a list of refs, as for log_commits() - commits
+    can be the output of that function for the same file, if that has
+    already been read.
+
+    content is a Blob - bytes with a sha attribute - unless stream=True, in
+    which case large files are yielded as a BlobStream instead. That can
+    only be read until the next version is requested.
+    """
+    from .blobs import BlobReader, STREAM_THRESHOLD
+
+    relative_path = Path(filepath).relative_to(repo_path).as_posix()
+    if commits is None:
+        commits = log_commits(repo_path, filepath, ref, since, until)
+    commits = reversed(list(commits))
+    # Sample before skipping, so later runs select the same commits
+    commits = sample_commits(commits, every, one_per)
     progress_bar = None
     if commits_to_skip:
         # Filter down to just the ones we haven't seen
         new_commits = [
-            commit for commit in commits if commit.hexsha not in commits_to_skip
+            commit for commit in commits if commit["hash"] not in commits_to_skip
         ]
         commits = new_commits
     if show_progress:
         progress_bar = click.progressbar(commits, show_pos=True, show_percent=True)
-    for commit in commits:
-        if progress_bar:
-            progress_bar.update(1)
-        try:
-            content = commit.tree[relative_path].data_stream.read()
-            yield commit.committed_datetime, commit.hexsha, content
-        except KeyError:
-            # This commit doesn't have a copy of the requested file
-            pass
+    with BlobReader(repo_path) as blobs:
+        for commit in commits:
+            if progress_bar:
+                progress_bar.update(1)
+            content = blobs.open(commit["hash"], commit.get("path", relative_path))
+            if content is None:
+                # This commit doesn't have a copy of the requested file
+                continue
+            if not stream or content.size < STREAM_THRESHOLD:
+                content = content.read_blob()
+            yield datetime.datetime.fromisoformat(commit["commit_at"]), commit[
+                "hash"
+            ], content
+
+
+# Number of parsed versions of the file to keep when using multiple branches
+BLOB_CACHE_SIZE = 8
+
+BUCKET_FORMATS = {"hour": "%Y-%m-%dT%H", "day": "%Y-%m-%d"}
+
+
+def sample_commits(commits, every=None, one_per=None, now=None):
+    """
+    Downsample a chronological list of commits, without reading any blobs.
+
+    every=N keeps the first of every N commits. one_per="hour" or "day" keeps
+    the last commit in each hour or day, in UTC. The hour or day containing
+    now - which defaults to the current time - is left out, since a later
+    run could find a later commit in it.
+    """
+    commits = list(commits)
+    if every:
+        commits = commits[::every]
+    if one_per:
+        bucket_format = BUCKET_FORMATS[one_per]
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        open_bucket = now.astimezone(datetime.timezone.utc).strftime(bucket_format)
+        last_in_bucket = {}
+        for commit in commits:
+            bucket = (
+                datetime.datetime.fromisoformat(commit["commit_at"])
+                .astimezone(datetime.timezone.utc)
+                .strftime(bucket_format)
+            )
+            if bucket >= open_bucket:
+                continue
+            last_in_bucket[bucket] = commit
+        commits = list(last_in_bucket.values())
+    return commits
+
+
+def validate_date(ctx, param, value):
+    "Turn an ISO date or datetime into an explicit UTC datetime string for git"
+    if value is None:
+        return None
+    try:
+        # A date on its own covers the whole of that day
+        date = parse_timestamp(value, end_of_day=param.name == "until")
+    except ValueError:
+        raise click.BadParameter("Use an ISO date or datetime, e.g. 2021-12-01")
+    return date.isoformat()
+
+
+def skip_until_start(versions, start_at=None, start_after=None):
+    can_proceed = not (start_after or start_at)
+    for git_commit_at, git_hash, content in versions:
+        if not can_proceed:
+            if git_hash == start_after:
+                can_proceed = True
+                # But skip this one and start at the next one
+                continue
+            elif git_hash == start_at:
+                can_proceed = True
+            else:
+                continue
+        yield git_commit_at, git_hash, content
 
 
 @click.group()
@@ -63,11 +324,47 @@ def cli():
     default="item",
     help="Used as part of the table names - defaults to item, but can be changed to use one database to store changes to more than one file",
 )
-@click.option("--branch", default="main", help="Git branch to use (defaults to main)")
+@click.option(
+    "--follow",
+    is_flag=True,
+    help="Follow the history of the file across renames and moves",
+)
+@click.option(
+    "--rewind",
+    is_flag=True,
+    help="If the branch has been rewritten, roll back to where it diverged",
+)
+@click.option(
+    "branches",
+    "--branch",
+    multiple=True,
+    default=("main",),
+    help="Git branch to use (defaults to main) - can be used more than once",
+)
 @click.option(
     "ids", "--id", multiple=True, help="Columns (can be multiple) to use as an ID"
 )
 @click.option("--start-at", help="Skip commits prior to this one")
+@click.option(
+    "--since",
+    callback=validate_date,
+    help="Only process commits made on or after this date, e.g. 2021-12-01",
+)
+@click.option(
+    "--until",
+    callback=validate_date,
+    help="Only process commits made on or before this date",
+)
+@click.option(
+    "--every",
+    type=click.IntRange(min=1),
+    help="Only process the first of every N commits",
+)
+@click.option(
+    "--one-per",
+    type=click.Choice(list(BUCKET_FORMATS)),
+    help="Only process the last commit in each hour or day",
+)
 @click.option(
     "--start-after", help="Skip commits up to this one, then start at the next one"
 )
@@ -79,6 +376,21 @@ def cli():
     is_flag=True,
     help="Record full copies in the item_version table, not just the columns that changed since the previous version",
 )
+@click.option(
+    "--keyframes",
+    type=click.IntRange(min=1),
+    help="Store a full copy of every Nth version of an item, to speed up as-of",
+)
+@click.option(
+    "--store-changed-columns",
+    is_flag=True,
+    help="Store a JSON list of changed columns on each version row, instead of calculating it in the item_version_detail view",
+)
+@click.option(
+    "--track-removals",
+    is_flag=True,
+    help="Record a version with _removed set to 1 when an item is no longer present",
+)
 @click.option("ignore", "--ignore", multiple=True, help="Columns to ignore")
 @click.option(
     "csv_",
@@ -107,6 +419,70 @@ def cli():
     is_flag=True,
     help="Keep going if same ID occurs more than once in a single version of a file",
 )
+@click.option(
+    "--compress",
+    type=click.Choice(["zlib", "zstd"]),
+    help="Compress large text values in the item and version tables",
+)
+@click.option(
+    "--compress-threshold",
+    type=click.IntRange(min=1),
+    default=1024,
+    help="Only compress values at least this many characters long",
+)
+@click.option(
+    "--compress-dictionary",
+    is_flag=True,
+    help="Train and use a shared zstd dictionary for this namespace",
+)
+@click.option(
+    "--intern-values",
+    is_flag=True,
+    help="Store each distinct large value once, referenced from items and versions",
+)
+@click.option(
+    "--intern-threshold",
+    type=click.IntRange(min=1),
+    default=1024,
+    help="Only intern values at least this many characters long",
+)
+@click.option(
+    "fts_columns",
+    "--fts",
+    multiple=True,
+    help="Columns to maintain a full-text search index on",
+)
+@click.option(
+    "--fts-versions",
+    is_flag=True,
+    help="Also index the version table for --fts",
+)
+@click.option(
+    "--commit-stats",
+    is_flag=True,
+    help="Record counts of new, changed and removed items for each commit",
+)
+@click.option(
+    "--shards",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Split items between this many worker processes by ID when diffing with --id",
+)
+@click.option(
+    "--pipeline",
+    is_flag=True,
+    help="Read from Git, parse and write to SQLite concurrently",
+)
+@click.option(
+    "--parse-workers",
+    type=click.IntRange(min=1),
+    help="Number of processes to use for parsing with --pipeline (default 2)",
+)
+@click.option(
+    "--optimize",
+    is_flag=True,
+    help="Create extra indexes and run ANALYZE once the import has finished",
+)
 @click.option(
     "--wal",
     is_flag=True,
@@ -128,18 +504,39 @@ def file(
     filepath,
     repo,
     namespace,
-    branch,
+    branches,
+    follow,
+    rewind,
     ids,
     ignore,
     start_at,
+    since,
+    until,
+    every,
+    one_per,
     start_after,
     skip_hashes,
     full_versions,
+    keyframes,
+    store_changed_columns,
+    track_removals,
     csv_,
     dialect,
     convert,
     imports,
     ignore_duplicate_ids,
+    compress,
+    compress_threshold,
+    compress_dictionary,
+    intern_values,
+    intern_threshold,
+    fts_columns,
+    fts_versions,
+    commit_stats,
+    shards,
+    pipeline,
+    parse_workers,
+    optimize,
     wal,
     debug,
     silent,
@@ -151,442 +548,609 @@ def file(
     if dialect:
         csv_ = True
 
+    if keyframes and full_versions:
+        raise click.ClickException("Cannot use --keyframes with --full-versions")
+
+    if compress_dictionary and compress != "zstd":
+        raise click.ClickException("--compress-dictionary requires --compress zstd")
+
+    if compress and not ids:
+        raise click.ClickException("--compress requires --id")
+
+    if intern_values and not ids:
+        raise click.ClickException("--intern-values requires --id")
+
+    if track_removals and not ids:
+        raise click.ClickException("--track-removals requires --id")
+
+    if fts_columns and not ids:
+        raise click.ClickException("--fts requires --id")
+
+    if commit_stats and not ids:
+        raise click.ClickException("--commit-stats requires --id")
+
+    if fts_versions and not fts_columns:
+        raise click.ClickException("--fts-versions requires --fts")
+
+    if parse_workers and not pipeline:
+        raise click.ClickException("--parse-workers requires --pipeline")
+    parse_workers = parse_workers or 2
+
+    if shards > 1 and debug:
+        raise click.ClickException("Cannot use --debug with --shards")
+
+    if shards > 1 and len(branches) > 1:
+        raise click.ClickException("Cannot use --shards with more than one --branch")
+
     if start_at and start_after:
         raise click.ClickException(
             "Cannot use --start-at and --start-after at the same time"
         )
 
+    import sqlite_utils
+    from .ingest import Ingestor
+    from .sinks import SQLiteSink
+
     db = sqlite_utils.Database(database)
     if wal:
         db.enable_wal()
 
-    namespace_id = db["namespaces"].lookup({"name": namespace})
+    try:
+        sink = SQLiteSink(
+            db,
+            namespace,
+            keyframes=keyframes,
+            store_changed_columns=store_changed_columns,
+            compress=compress,
+            compress_threshold=compress_threshold,
+            compress_dictionary=compress_dictionary,
+            intern_values=intern_values,
+            intern_threshold=intern_threshold,
+            fts_columns=fts_columns,
+            fts_versions=fts_versions,
+            commit_stats=commit_stats,
+        )
+    except ValueError as ex:
+        raise click.ClickException(str(ex))
+
+    resolved_filepath = str(Path(filepath).resolve())
+    resolved_repo = str(Path(repo).resolve())
+
+    rewritten = rewritten_commits(
+        resolved_repo,
+        branches,
+        sorted(sink.commit_hash_to_id, key=sink.commit_hash_to_id.get),
+    )
+    if rewritten and not rewind:
+        raise click.ClickException(
+            "{} previously imported commit{} no longer in the history of {}, "
+            "starting with {} - the branch may have been rebased or force-pushed. "
+            "Use --rewind to remove what {} recorded and import the new history.".format(
+                len(rewritten),
+                " is" if len(rewritten) == 1 else "s are",
+                ", ".join(branches),
+                rewritten[0],
+                "it" if len(rewritten) == 1 else "they",
+            )
+        )
+    sink.rollback(rewritten)
 
-    commits_to_skip = get_commit_hashes(db, namespace)
+    commits_to_skip = sink.seen_commits()
     if skip_hashes:
         commits_to_skip.update(skip_hashes)
 
-    item_table = namespace
-    version_table = "{}_version".format(namespace)
-    version_detail_view = "{}_version_detail".format(namespace)
-    changed_table = "{}_changed".format(namespace)
+    # Metadata for every commit is read in one pass, before any blobs
+    commits = list(
+        log_commits(resolved_repo, resolved_filepath, branches, since, until, follow)
+    )
+    sink.add_commit_metadata(commits)
+
+    lineage = None
+    if len(branches) > 1 or db["refs"].exists():
+        paths = {Path(resolved_filepath).relative_to(resolved_repo).as_posix()}
+        # Along with any earlier names found by --follow
+        paths.update(commit["path"] for commit in commits if "path" in commit)
+        lineage = ref_lineage(resolved_repo, sorted(paths), branches)
+
+    ingestor = Ingestor(
+        sink,
+        ids=ids,
+        ignore=ignore,
+        convert=convert,
+        imports=imports,
+        csv=csv_,
+        dialect=dialect,
+        full_versions=full_versions,
+        track_removals=track_removals,
+        ignore_duplicate_ids=ignore_duplicate_ids,
+        shards=shards,
+        parse_workers=parse_workers if pipeline else None,
+        # Branches often share identical versions of the file
+        blob_cache_size=BLOB_CACHE_SIZE if len(branches) > 1 else 0,
+        # So that each branch's versions record changes along that branch
+        refs=(
+            {ref: hashes for ref, (_, hashes) in lineage.items()}
+            if len(branches) > 1
+            else None
+        ),
+        debug=debug,
+    )
+    versions = skip_until_start(
+        iterate_file_versions(
+            resolved_repo,
+            resolved_filepath,
+            branches,
+            commits_to_skip=commits_to_skip,
+            show_progress=not silent,
+            every=every,
+            one_per=one_per,
+            commits=commits,
+            stream=ingestor.accepts_streams,
+        ),
+        start_at,
+        start_after,
+    )
+    with ingestor:
+        ingestor.ingest(versions)
+        if lineage is not None:
+            sink.record_refs(lineage)
 
-    if csv_:
-        convert = build_csv_convert_string(dialect)
-        imports = ["io", "csv"]
+    if optimize:
+        from .optimize import optimize as optimize_database
 
-    if not convert:
-        convert = "json.loads(content)"
+        optimize_database(db, [namespace])
+        if not silent:
+            output_index_sizes(db)
 
-    convert_function = compile_convert(convert, imports)
 
-    resolved_filepath = str(Path(filepath).resolve())
-    resolved_repo = str(Path(repo).resolve())
+@cli.command(name="as-of")
+@click.argument(
+    "database",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.argument("ref", required=False)
+@click.option(
+    "-n",
+    "--namespace",
+    default="item",
+    help="Namespace of the tables to query - defaults to item",
+)
+@click.option("--nl", is_flag=True, help="Output newline-delimited JSON")
+@click.option(
+    "--sql",
+    is_flag=True,
+    help="Output SQL that performs the reconstruction for a :commit parameter",
+)
+@click.option(
+    "--ref",
+    "ref_name",
+    help="Branch recorded by file to use, when it imported more than one",
+)
+def as_of(database, ref, namespace, nl, sql, ref_name):
+    """
+    Reconstruct every item as it was at a specific commit
 
-    # In-memory caches of the most recent version and last full hash for each item_id
-    item_id_to_version, item_id_to_last_full_hash = get_versions_and_hashes(
-        db, namespace
-    )
+    REF can be a commit hash, a unique prefix of a commit hash or an ISO
+    timestamp such as 2021-12-01 or 2021-12-01T10:00:00
+    """
+    import sqlite_utils
+
+    db = sqlite_utils.Database(database)
+    version_table = "{}_version".format(namespace)
+    if not db[version_table].exists():
+        raise click.ClickException(
+            "Table {} does not exist - as-of needs a database created using --id".format(
+                version_table
+            )
+        )
+    if sql:
+        click.echo(as_of_sql(db, namespace, ref=bool(ref_name)))
+        return
+    if not ref:
+        raise click.ClickException("A commit hash or timestamp is required")
+    try:
+        commit_id = resolve_commit_id(db, namespace, ref)
+        ref_id = resolve_ref_id(db, namespace, ref_name) if ref_name else None
+    except UnknownRef as ex:
+        raise click.ClickException(str(ex))
+    output_rows(iterate_items_as_of(db, namespace, commit_id, ref_id=ref_id), nl)
+
+
+@cli.command()
+@click.argument(
+    "database",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.argument("ref_a")
+@click.argument("ref_b")
+@click.option(
+    "-n",
+    "--namespace",
+    default="item",
+    help="Namespace of the tables to query - defaults to item",
+)
+@click.option(
+    "--ref",
+    "ref_name",
+    help="Branch recorded by file to use, when it imported more than one",
+)
+def diff(database, ref_a, ref_b, namespace, ref_name):
+    """
+    Show items that were added, changed or removed between two commits
 
-    # In-memory cache for db["columns"].lookup(...)
-    column_name_to_id = {}
+    REF_A and REF_B can be commit hashes, unique prefixes of commit hashes
+    or ISO timestamps
+    """
+    import sqlite_utils
 
-    def column_id(column):
-        if column not in column_name_to_id:
-            id = db["columns"].lookup(
-                {"namespace": namespace_id, "name": column},
-                foreign_keys=(("namespace", "namespaces", "id"),),
+    db = sqlite_utils.Database(database)
+    version_table = "{}_version".format(namespace)
+    if not db[version_table].exists():
+        raise click.ClickException(
+            "Table {} does not exist - diff needs a database created using --id".format(
+                version_table
             )
-            column_name_to_id[column] = id
-        return column_name_to_id[column]
+        )
+    try:
+        commit_a = resolve_commit_id(db, namespace, ref_a)
+        commit_b = resolve_commit_id(db, namespace, ref_b)
+        ref_id = resolve_ref_id(db, namespace, ref_name) if ref_name else None
+        changes = diff_commits(db, namespace, commit_a, commit_b, ref_id=ref_id)
+    except (UnknownRef, ValueError) as ex:
+        raise click.ClickException(str(ex))
+    click.echo(json.dumps(changes, indent=2, default=repr))
 
-    can_proceed = not (start_after or start_at)
 
-    for git_commit_at, git_hash, content in iterate_file_versions(
-        resolved_repo,
-        resolved_filepath,
-        branch,
-        commits_to_skip=commits_to_skip,
-        show_progress=not silent,
-    ):
-        if not can_proceed:
-            if git_hash == start_after:
-                can_proceed = True
-                # But skip this one and start at the next one
-                continue
-            elif git_hash == start_at:
-                can_proceed = True
-            else:
-                continue
+@cli.command(name="backfill-changed-columns")
+@click.argument(
+    "database",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.option(
+    "-n",
+    "--namespace",
+    default="item",
+    help="Namespace of the tables to update - defaults to item",
+)
+def backfill_changed_columns_command(database, namespace):
+    """
+    Add a materialized _changed_columns column to an existing version table
 
-        if True:  # with db.conn:  # One transaction per git commit processed
-            commit_pk = db["commits"].lookup(
-                {"namespace": namespace_id, "hash": git_hash},
-                {"commit_at": git_commit_at.isoformat()},
-                foreign_keys=(("namespace", "namespaces", "id"),),
+    The version_detail view is then redefined to use that column. Future
+    runs of the file command will keep the column up-to-date.
+    """
+    import sqlite_utils
+    from .sinks import backfill_changed_columns
+
+    db = sqlite_utils.Database(database)
+    version_table = "{}_version".format(namespace)
+    if not db[version_table].exists():
+        raise click.ClickException("Table {} does not exist".format(version_table))
+    backfill_changed_columns(db, namespace)
+
+
+@cli.command(name="optimize")
+@click.argument(
+    "database",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.option(
+    "-n",
+    "--namespace",
+    "namespaces",
+    multiple=True,
+    help="Namespaces to index - defaults to all of them",
+)
+def optimize_command(database, namespaces):
+    """
+    Add indexes for common queries and update the query planner statistics
+
+    Prints the size of every index in the database afterwards.
+    """
+    import sqlite_utils
+    from .optimize import optimize
+
+    db = sqlite_utils.Database(database)
+    optimize(db, namespaces or None)
+    output_index_sizes(db)
+
+
+@cli.command(name="compact")
+@click.argument(
+    "database",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.option(
+    "--before",
+    required=True,
+    callback=validate_date,
+    help="Compact versions from commits made before this ISO date or datetime",
+)
+@click.option(
+    "--per",
+    type=click.Choice(["day", "week"]),
+    default="day",
+    help="Keep at most one version of each item per day or per week (in UTC)",
+)
+@click.option(
+    "-n",
+    "--namespace",
+    "namespaces",
+    multiple=True,
+    help="Namespaces to compact - defaults to all of them",
+)
+@click.option(
+    "--no-vacuum",
+    is_flag=True,
+    help="Don't return the space that was freed to the file system",
+)
+def compact_command(database, before, per, namespaces, no_vacuum):
+    """
+    Collapse old versions into one per item per day or week
+
+    The last version in each period is kept, recording everything that
+    changed in that period. Prints the number of versions removed from each
+    namespace.
+    """
+    import sqlite_utils
+    from .compact import compact, incremental_vacuum
+
+    db = sqlite_utils.Database(database)
+    if not namespaces:
+        namespaces = [row[0] for row in db.execute("select name from namespaces")]
+    for namespace in namespaces:
+        if not db["{}_version".format(namespace)].exists():
+            raise click.ClickException(
+                "Table {}_version does not exist".format(namespace)
             )
-            if not content.strip():
-                # Skip empty files
-                continue
+    for namespace in namespaces:
+        removed = compact(db, namespace, before, per)
+        click.echo("{}: removed {:,} versions".format(namespace, removed))
+    if not no_vacuum:
+        incremental_vacuum(db)
 
-            # list() to resolve generators for repeated access later
-            try:
-                items = list(convert_function(content))
-            except Exception:
-                print("\nError in commit: {}".format(git_hash))
-                raise
-
-            # Remove any --ignore columns
-            items = remove_ignore_columns(items, ignore)
-
-            if not ids:
-                # no --id - so just populate item_table and add item["_commit"]
-                items = [
-                    {
-                        **jsonify_all(fix_reserved_columns(item)),
-                        "_commit": commit_pk,
-                    }
-                    for item in items
-                ]
-                db[item_table].insert_all(
-                    items,
-                    column_order=("_id",),
-                    alter=True,
-                    foreign_keys=(("_commit", "commits", "id"),),
-                )
-            else:
-                # --id is specified, so populate item_version with changes over time
-                # Any --id that is a reserved column needs to be renamed first
-                fixed_ids = set(
-                    fix_reserved_columns(
-                        {id: 1 for id in ids},
-                    ).keys()
-                )
-                # Validate all items in the commit have ID columns - raises ClickException if not
-                validate_items_have_id_columns(items, ids, git_hash)
-
-                # Use this to detect IDs that are duplicated in the same commit
-                item_ids_seen_in_this_commit = set()
-
-                # Which of these are new versions of things we have seen before?
-                for item in items:
-                    item = fix_reserved_columns(item)
-                    item_id = _hash(dict((id, item.get(id)) for id in fixed_ids))
-                    if item_id in item_ids_seen_in_this_commit:
-                        # Ensure there are not multiple items in this commit with the same ID
-                        if not ignore_duplicate_ids:
-                            raise DuplicateIdsException(
-                                git_hash, items, fixed_ids, item_id
-                            )
-                        else:
-                            # Skip this one
-                            continue
-
-                    item_ids_seen_in_this_commit.add(item_id)
-
-                    # Has it changed since last time we saw it?
-                    item_full_hash = _hash(item)
-
-                    # JSONify any lists/dicts to assist later comparison with row from DB
-                    item_flattened = jsonify_all(item)
-
-                    if debug:
-                        db["debug"].insert(
-                            {
-                                "hash": item_full_hash,
-                                "content": json.dumps(
-                                    item, default=repr, sort_keys=True
-                                ),
-                            },
-                            pk="hash",
-                            replace=True,
-                        )
-
-                    item_is_new = item_id not in item_id_to_last_full_hash
-                    item_full_hash_has_changed = (
-                        item_id_to_last_full_hash.get(item_id) != item_full_hash
-                    )
-
-                    updated_values = {}
-                    updated_columns = set()
-
-                    if item_is_new or item_full_hash_has_changed:
-                        # TODO: delete-me
-                        previous_item_hash = item_id_to_last_full_hash.get(item_id)
-
-                        # It's either new or the content has changed - so update item and insert an item_version
-                        item_id_to_last_full_hash[item_id] = item_full_hash
-                        version = item_id_to_version.get(item_id, 0) + 1
-                        item_id_to_version[item_id] = version
-
-                        previous_item = None
-                        if not item_is_new:
-                            previous_item = get_item(db, item_table, item_id)
-
-                        # Add or update item
-                        item_pk = db[item_table].lookup(
-                            {"_item_id": item_id},
-                            column_order=("_id", "_item_id"),
-                            foreign_keys=(("_commit", "commits", "id"),),
-                            pk="_id",
-                        )
-                        db[item_table].update(
-                            item_pk,
-                            dict(item_flattened, _item_id=item_id, _commit=commit_pk),
-                            alter=True,
-                        )
-
-                        if full_versions:
-                            # Record full copies in item_version
-                            item_version = dict(
-                                item_flattened,
-                                _item=item_pk,
-                                _version=version,
-                                _commit=commit_pk,
-                            )
-                        else:
-                            # Only record the columns that have changed
-                            if previous_item is not None:
-                                for column in (
-                                    item_flattened.keys() | previous_item.keys()
-                                ):
-                                    if column in RESERVED_SET:
-                                        continue
-                                    value = item_flattened.get(column)
-                                    if value != previous_item.get(column):
-                                        updated_values[column] = value
-                                        updated_columns.add(column)
-                            else:
-                                updated_values = item_flattened
-                                updated_columns.update(item_flattened.keys())
-
-                            item_version = dict(
-                                updated_values,
-                                _item=item_pk,
-                                _version=version,
-                                _commit=commit_pk,
-                                _item_full_hash=item_full_hash,
-                            )
-
-                        item_version_id = (
-                            db[version_table]
-                            .insert(
-                                item_version,
-                                pk="_id",
-                                alter=True,
-                                replace=True,
-                                column_order=("_item", "_version", "_commit"),
-                                foreign_keys=(
-                                    ("_item", item_table, "_id"),
-                                    ("_commit", "commits", "id"),
-                                ),
-                            )
-                            .last_pk
-                        )
-
-                        if updated_columns:
-                            # Record which columns changed in the changed m2m table
-                            db[changed_table].insert_all(
-                                (
-                                    {
-                                        "item_version": item_version_id,
-                                        "column": column_id(column),
-                                    }
-                                    for column in updated_columns
-                                ),
-                                pk=("item_version", "column"),
-                                foreign_keys=(
-                                    ("item_version", version_table, "_id"),
-                                    ("column", "columns", "id"),
-                                    ("namespace", "namespaces", "id"),
-                                ),
-                            )
-                        else:
-                            # ERROR: full has changed but no visible changes?
-                            if not item_is_new and not full_versions and debug:
-                                print(
-                                    "Potential bug: hashchanged but no updated_columns"
-                                )
-                                import pdb
-
-                                pdb.set_trace()
-                                assert False
-
-    # Create any necessary views
-    create_views(db, namespace)
-    # ... and indexes
-    if db[version_table].exists():
-        db[version_table].create_index(["_item"], if_not_exists=True)
-
-
-def _hash(record):
-    return hashlib.sha1(
-        json.dumps(record, separators=(",", ":"), sort_keys=True, default=repr).encode(
-            "utf8"
-        )
-    ).hexdigest()
 
+@cli.command(name="merge")
+@click.argument(
+    "database",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.argument(
+    "sources",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+    nargs=-1,
+    required=True,
+)
+@click.option(
+    "-n",
+    "--namespace",
+    "namespaces",
+    multiple=True,
+    help="Namespaces to copy from each source - defaults to all of them",
+)
+def merge_command(database, sources, namespaces):
+    """
+    Copy namespaces from other databases into one database
 
-def jsonify_all(item):
-    return {key: jsonify_if_needed(value) for key, value in item.items()}
+    Each namespace is copied with its commits, columns and indexes by SQLite
+    itself. The namespaces must not already be in DATABASE, which is created
+    if necessary.
 
+    Prints the namespaces copied from each source.
+    """
+    import sqlite_utils
+    from .merge import merge
 
-def get_item(db, item_table, item_id):
-    previous_items = list(
-        db.query(
-            """
-        select * from [{item_table}] where _item_id = ?
-        """.format(
-                item_table=item_table,
-            ),
-            [item_id],
-        )
-    )
-    if previous_items:
-        return previous_items[0]
-    else:
-        return None
+    db = sqlite_utils.Database(database)
+    for source in sources:
+        try:
+            merged = merge(db, source, namespaces or None)
+        except ValueError as ex:
+            raise click.ClickException(str(ex))
+        click.echo("{}: {}".format(source, ", ".join(merged)))
 
 
-def build_csv_convert_string(dialect):
-    return textwrap.dedent(
-        """
-        decoded = content.decode("utf-8")
-        dialect = {}
-        reader = csv.DictReader(io.StringIO(decoded), dialect=dialect)
-        return reader
-        """.format(
-            '"{}"'.format(dialect) if dialect else "csv.Sniffer().sniff(decoded[:1024])"
-        )
-    ).strip()
-
-
-def compile_convert(convert, imports):
-    # Clean up the provided code
-    # If single line and no 'return', add the return
-    if "\n" not in convert and not convert.strip().startswith("return "):
-        convert = "return {}".format(convert)
-    # Compile the code into a function body called fn(content)
-    new_code = ["def fn(content):"]
-    for line in convert.split("\n"):
-        new_code.append("    {}".format(line))
-    code_o = compile("\n".join(new_code), "<string>", "exec")
-    locals = {}
-    globals = {"json": json}
-    for import_ in imports:
-        globals[import_.split(".")[0]] = __import__(import_)
-    exec(code_o, globals, locals)
-    return locals["fn"]
-
-
-def remove_ignore_columns(items, ignore):
-    if ignore:
-        new_items = []
-        for item in items:
-            new_item = dict(
-                (key, value) for key, value in item.items() if key not in ignore
+@cli.command()
+@click.argument(
+    "catalog",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.argument(
+    "shards",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+    nargs=-1,
+)
+def catalog(catalog, shards):
+    """
+    Combine database files into one catalog database
+
+    Records the SHARDS in the CATALOG database, creating it if necessary.
+    attach_shards() in git_history.catalog then attaches all of them and adds
+    views that look like the tables of a single database.
+
+    Prints the namespaces in each shard.
+    """
+    import sqlite3
+    import sqlite_utils
+    from .catalog import add_shards, attach_shards
+
+    db = sqlite_utils.Database(catalog)
+    try:
+        add_shards(db, shards)
+        attached = attach_shards(db.conn)
+    except (ValueError, sqlite3.OperationalError) as ex:
+        raise click.ClickException(str(ex))
+    for schema, filename in attached.items():
+        has_namespaces = db.execute(
+            "select count(*) from [{}].sqlite_master where name = 'namespaces'".format(
+                schema
             )
-            new_items.append(new_item)
-        return new_items
-    else:
-        return items
-
-
-def create_views(db, namespace):
-    if db["{}_version".format(namespace)].exists():
-        sql = textwrap.dedent(
-            """
-            select
-              commits.commit_at as _commit_at,
-              commits.hash as _commit_hash,
-              {namespace}_version.*,
-              (
-                select json_group_array(name) from columns
-                where id in (
-                  select column from {namespace}_changed
-                  where item_version = {namespace}_version._id
+        ).fetchone()[0]
+        namespaces = (
+            [
+                row[0]
+                for row in db.execute(
+                    "select name from [{}].namespaces order by name".format(schema)
                 )
-            ) as _changed_columns
-            from {namespace}_version
-              join commits on commits.id = {namespace}_version._commit
-            """.format(
-                namespace=namespace
-            )
-        ).strip()
-        db.create_view(
-            "{namespace}_version_detail".format(namespace=namespace),
-            sql,
-            ignore=True,
+            ]
+            if has_namespaces
+            else []
         )
+        click.echo("{}: {} - {}".format(schema, filename, ", ".join(namespaces)))
 
 
-def get_commit_hashes(db, namespace):
-    return (
-        set(
-            r[0]
-            for r in db.execute(
-                """
-            select hash from commits
-            where namespace = (
-                select id from namespaces where name = ?
-            )
-        """,
-                [namespace],
-            ).fetchall()
-        )
-        if db["commits"].exists()
-        else set()
-    )
+@cli.command()
+@click.argument(
+    "database",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.argument("what", type=click.Choice(["items", "versions", "snapshot"]))
+@click.option(
+    "-n",
+    "--namespace",
+    default="item",
+    help="Namespace of the tables to export - defaults to item",
+)
+@click.option("--since", help="Only include commits after this hash or timestamp")
+@click.option(
+    "--until", help="Only include commits up to and including this hash or timestamp"
+)
+@click.option(
+    "--commit", help="Commit hash or timestamp for snapshot - defaults to the latest"
+)
+@click.option(
+    "--full",
+    is_flag=True,
+    help="Reconstruct the complete item for every exported version",
+)
+@click.option(
+    "--ref",
+    "ref_name",
+    help="Branch recorded by file to use, when it imported more than one",
+)
+@click.option("--csv", "csv_", is_flag=True, help="Output CSV instead of JSON lines")
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=1000,
+    help="Number of rows to fetch from the database at a time",
+)
+def export(
+    database, what, namespace, since, until, commit, full, ref_name, csv_, batch_size
+):
+    """
+    Stream items, versions or a snapshot as newline-delimited JSON or CSV
 
+    \b
+    items: the current row for every item
+    versions: every recorded version of every item
+    snapshot: every item as it was at --commit
+    """
+    import sqlite_utils
 
-def get_versions_and_hashes(db, namespace):
-    item_id_to_version = {}
-    item_id_to_last_full_hash = {}
-    if db[namespace + "_version"].exists():
-        sql = """
-        select
-            {namespace}._item_id as item_id,
-            max({namespace}_version._version) as max_version,
-            {namespace}_version._item_full_hash as item_full_hash
-        from
-            {namespace}_version
-            join {namespace} on {namespace}_version._item = {namespace}._id
-        group by
-            _item_id
-        """.format(
-            namespace=namespace
-        )
-        for row in db.query(sql):
-            item_id_to_version[row["item_id"]] = row["max_version"]
-            item_id_to_last_full_hash[row["item_id"]] = row["item_full_hash"]
-    return item_id_to_version, item_id_to_last_full_hash
-
-
-def validate_items_have_id_columns(items, ids, git_hash):
-    _ids_set = set(ids)
-    bad_items = [
-        bad_item for bad_item in items if not _ids_set.issubset(bad_item.keys())
-    ]
-    if bad_items:
+    db = sqlite_utils.Database(database)
+    if not db[namespace].exists():
+        raise click.ClickException("Table {} does not exist".format(namespace))
+    version_table = "{}_version".format(namespace)
+    if what != "items" and not db[version_table].exists():
         raise click.ClickException(
-            "Commit: {} - every item must have the --id keys. These items did not:\n{}".format(
-                git_hash, json.dumps(bad_items[:5], indent=4, default=str)
+            "Table {} does not exist - {} needs a database created using --id".format(
+                version_table, what
             )
         )
+    if commit and what != "snapshot":
+        raise click.ClickException("--commit can only be used with snapshot")
+    if (since or until) and what == "snapshot":
+        raise click.ClickException("Use --commit rather than --since or --until")
+    if full and what != "versions":
+        raise click.ClickException("--full can only be used with versions")
+    if ref_name and what == "items":
+        raise click.ClickException("--ref can only be used with versions or snapshot")
+    try:
+        ref_id = resolve_ref_id(db, namespace, ref_name) if ref_name else None
+        since_id = 0
+        if since:
+            # Commits made on a --since date are included
+            since_id = resolve_commit_id(
+                db, namespace, since, if_earlier=0, end_of_day=False
+            )
+        until_id = None
+        if until:
+            until_id = resolve_commit_id(db, namespace, until)
+        if what == "snapshot":
+            commit_id = (
+                resolve_commit_id(db, namespace, commit)
+                if commit
+                else db.execute(
+                    "select max(id) from commits where namespace = "
+                    "(select id from namespaces where name = ?)",
+                    [namespace],
+                ).fetchone()[0]
+            )
+    except UnknownRef as ex:
+        raise click.ClickException(str(ex))
+    if what == "items":
+        columns = list(db[namespace].columns_dict)
+        rows = iterate_items(db, namespace, since_id, until_id, batch_size)
+    elif what == "versions":
+        columns = version_columns(db, namespace)
+        rows = iterate_versions(
+            db, namespace, since_id, until_id, full, batch_size, ref_id=ref_id
+        )
+    else:
+        columns = ["_id", "_item_id", "_version", "_commit"]
+        columns += data_columns(db, namespace)
+        rows = iterate_items_as_of(db, namespace, commit_id, ref_id=ref_id)
+    if csv_:
+        output_csv(columns, rows)
+    else:
+        output_rows(rows, nl=True)
+
+
+def output_csv(columns, rows):
+    "Stream rows to stdout as CSV, JSON encoding any lists or dictionaries"
+    writer = csv.writer(sys.stdout)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(
+            [
+                json.dumps(value) if isinstance(value, (list, dict)) else value
+                for value in (row.get(column) for column in columns)
+            ]
+        )
 
 
-class DuplicateIdsException(click.ClickException):
-    def __init__(self, git_hash, items, fixed_ids, item_id):
-        message = "Commit: {} - found multiple items with the same ID:\n{}".format(
-            git_hash,
-            json.dumps(
-                [
-                    item
-                    for item in items
-                    if _hash(dict((id, item.get(id)) for id in fixed_ids)) == item_id
-                ][:5],
-                indent=4,
-                default=str,
-            ),
+def output_rows(rows, nl):
+    "Stream rows to stdout as a JSON array, or as newline-delimited JSON"
+    first = True
+    for row in rows:
+        line = json.dumps(row, default=repr)
+        if nl:
+            click.echo(line)
+        else:
+            click.echo(("[" if first else ",\n ") + line, nl=False)
+            first = False
+    if not nl:
+        click.echo("[]" if first else "]")
+
+
+def output_index_sizes(db):
+    "Print the size of every index in bytes, largest first"
+    from .optimize import index_sizes
+
+    for table, index, size in index_sizes(db):
+        click.echo(
+            "{}  {} on {}".format(
+                "{:>12,}".format(size) if size is not None else "{:>12}".format("?"),
+                index,
+                table,
+            )
         )
-        super().__init__(message)
@@ -0,0 +1,349 @@
+import json
+
+from .compression import register_functions
+from .query import data_columns, is_full_versions
+
+# SQL for the start of the period containing a commit_at value. SQLite's
+# date functions convert timestamps with an offset to UTC.
+PERIODS = {
+    "day": "date({})",
+    "week": "date({}, '-6 days', 'weekday 1')",
+}
+# Rows for the temporary tables are written in batches of this many
+BATCH_SIZE = 1000
+TEMP_TABLES = (
+    "compact_commits",
+    "compact_items",
+    "compact_deleted",
+    "compact_changed",
+    "compact_kept",
+    "compact_numbers",
+)
+
+
+def compact(db, namespace, before, period="day"):
+    """
+    Collapse the versions of each item recorded by commits made before the
+    before timestamp, so that at most one version is left per item for each
+    day or week. The one that is kept is the last of them, and afterwards
+    holds everything that changed over the period, so reconstructing an item
+    as of the end of each period gives the same result as before.
+
+    Versions are renumbered from 1, with the last version of each item - and
+    so the state used by incremental runs of the file command - unchanged.
+    Commits are kept, so they are not imported again.
+
+    Versions are read one item at a time and the changes are collected in
+    temporary tables, which SQLite moves to disk as they grow, before being
+    applied in one transaction. Returns the number of versions deleted.
+    """
+    version_table = "{}_version".format(namespace)
+    changed_table = "{}_changed".format(namespace)
+    full_versions = is_full_versions(db, namespace)
+    columns = data_columns(db, namespace)
+    version_columns = db[version_table].columns_dict
+    has_changed = not full_versions and db[changed_table].exists()
+    column_names = (
+        dict(
+            db.execute(
+                """
+                select columns.id, columns.name from columns
+                join namespaces on namespaces.id = columns.namespace
+                where namespaces.name = ?
+                """,
+                [namespace],
+            ).fetchall()
+        )
+        if has_changed
+        else {}
+    )
+    column_ids = {name: column_id for column_id, name in column_names.items()}
+
+    conn = db.conn
+    for table in TEMP_TABLES:
+        conn.execute("drop table if exists temp.[{}]".format(table))
+    conn.execute(
+        """
+        create temp table compact_commits as
+        select id, {} as period from commits
+        where namespace = (select id from namespaces where name = ?)
+          and datetime(commit_at) < datetime(?)
+        """.format(
+            PERIODS[period].format("commit_at")
+        ),
+        [namespace, before],
+    )
+    conn.execute("create unique index temp.compact_commits_id on compact_commits(id)")
+    # Items with more than one version in the same period
+    conn.execute(
+        """
+        create temp table compact_items as
+        select distinct v._item as item from [{}] v
+          join temp.compact_commits c on c.id = v._commit
+        group by v._item, c.period having count(*) > 1
+        """.format(
+            version_table
+        )
+    )
+    conn.execute("create temp table compact_deleted (_id integer primary key)")
+    conn.execute("create temp table compact_changed (item_version, [column])")
+    # The kept versions, with their new values
+    conn.execute(
+        "create temp table compact_kept as select * from [{}] where 0".format(
+            version_table
+        )
+    )
+
+    changed_sql = (
+        "(select group_concat([column]) from [{}] where item_version = v._id)".format(
+            changed_table
+        )
+        if has_changed
+        else "null"
+    )
+    rows = conn.execute(
+        """
+        select v.*, c.period as _period, {} as _changed_ids
+        from [{}] v left join temp.compact_commits c on c.id = v._commit
+        where v._item in (select item from temp.compact_items)
+        order by v._item, v._version
+        """.format(
+            changed_sql, version_table
+        )
+    )
+    names = [description[0] for description in rows.description]
+    deleted = []
+    changed = []
+    kept = []
+
+    def flush():
+        conn.executemany(
+            "insert into temp.compact_deleted (_id) values (?)",
+            ([version_id] for version_id in deleted),
+        )
+        conn.executemany(
+            "insert into temp.compact_changed (item_version, [column]) values (?, ?)",
+            changed,
+        )
+        conn.executemany(
+            "insert into temp.compact_kept ({}) values ({})".format(
+                ", ".join("[{}]".format(column) for column in version_columns),
+                ", ".join("?" for _ in version_columns),
+            ),
+            ([row[column] for column in version_columns] for row in kept),
+        )
+        deleted.clear()
+        changed.clear()
+        kept.clear()
+
+    def collapse(group, state):
+        "Keep the last version in the group, with all of the group's changes"
+        deleted.extend(group["ids"][:-1])
+        row = group["last"]
+        if not full_versions:
+            before_state = group["before_state"]
+            changed_columns = sorted(
+                column
+                for column in group["touched"]
+                if group["first"] or state.get(column) != before_state.get(column)
+            )
+            for column in columns:
+                row[column] = state.get(column) if column in changed_columns else None
+            changed.extend(
+                (row["_id"], column_ids[column]) for column in changed_columns
+            )
+            if "_changed_columns" in version_columns:
+                # Compact separators match SQLite's json_group_array()
+                row["_changed_columns"] = json.dumps(
+                    changed_columns, separators=(",", ":")
+                )
+        kept.append(row)
+        if len(deleted) + len(kept) >= BATCH_SIZE:
+            flush()
+
+    # Runs of consecutive versions of an item in the same period are
+    # collapsed, replaying the changes to know what each run changed overall
+    current_item = group = None
+    state = {}
+    for values in rows:
+        row = dict(zip(names, values))
+        if row["_item"] != current_item or (
+            group is not None and row["_period"] != group["period"]
+        ):
+            if group is not None and len(group["ids"]) > 1:
+                collapse(group, state)
+            group = None
+        if row["_item"] != current_item:
+            current_item = row["_item"]
+            state = {}
+            first = True
+        if row["_period"] is not None and group is None:
+            group = {
+                "period": row["_period"],
+                "ids": [],
+                "touched": set(),
+                "before_state": dict(state),
+                "first": first,
+            }
+        changed_here = [
+            column_names[int(column_id)]
+            for column_id in (row["_changed_ids"] or "").split(",")
+            if column_id
+        ]
+        for column in changed_here:
+            state[column] = row[column]
+        if group is not None:
+            group["ids"].append(row["_id"])
+            group["touched"].update(changed_here)
+            group["last"] = row
+        first = False
+    if group is not None and len(group["ids"]) > 1:
+        collapse(group, state)
+    flush()
+
+    deleted_count = conn.execute(
+        "select count(*) from temp.compact_deleted"
+    ).fetchone()[0]
+    with conn:
+        _apply(db, namespace, columns, version_columns, has_changed)
+    for table in TEMP_TABLES:
+        conn.execute("drop table if exists temp.[{}]".format(table))
+    return deleted_count
+
+
+def _apply(db, namespace, columns, version_columns, has_changed):
+    "Apply the changes collected in the temporary tables"
+    version_table = "{}_version".format(namespace)
+    changed_table = "{}_changed".format(namespace)
+    keyframe_table = "{}_keyframe".format(namespace)
+    fts_table = "{}_fts".format(version_table)
+    touched = """
+        select _id from temp.compact_deleted
+        union all select _id from temp.compact_kept
+    """
+    fts_columns = (
+        [column.name for column in db[fts_table].columns]
+        if db[fts_table].exists()
+        else []
+    )
+    fts_values = ", ".join(
+        "decompress([{}])".format(column) if column in version_columns else "null"
+        for column in fts_columns
+    )
+    fts_column_list = ", ".join("[{}]".format(column) for column in fts_columns)
+    if fts_columns:
+        register_functions(db.conn)
+        # Remove the old values from the external content index
+        db.execute(
+            """
+            insert into [{0}] ([{0}], rowid, {1})
+            select 'delete', _id, {2} from [{3}]
+            where _id in ({4}) and _id in (select id from [{0}_docsize])
+            """.format(
+                fts_table, fts_column_list, fts_values, version_table, touched
+            )
+        )
+    if has_changed:
+        db.execute(
+            "delete from [{}] where item_version in ({})".format(changed_table, touched)
+        )
+        db.execute(
+            """
+            insert into [{}] (item_version, [column])
+            select item_version, [column] from temp.compact_changed
+            """.format(
+                changed_table
+            )
+        )
+    if db[keyframe_table].exists():
+        db.execute(
+            "delete from [{}] where item_version in (select _id from temp.compact_deleted)".format(
+                keyframe_table
+            )
+        )
+    db.execute(
+        "delete from [{}] where _id in (select _id from temp.compact_deleted)".format(
+            version_table
+        )
+    )
+    if not is_full_versions(db, namespace):
+        db.execute(
+            """
+            update [{0}] set ({1}) = (
+              select {1} from temp.compact_kept where compact_kept._id = [{0}]._id
+            )
+            where _id in (select _id from temp.compact_kept)
+            """.format(
+                version_table,
+                ", ".join(
+                    "[{}]".format(column)
+                    for column in columns
+                    + (
+                        ["_changed_columns"]
+                        if "_changed_columns" in version_columns
+                        else []
+                    )
+                ),
+            )
+        )
+    # Number the remaining versions of each item from 1 again
+    db.execute(
+        """
+        create temp table compact_numbers as
+        select _id, row_number() over (partition by _item order by _version) as number
+        from [{}] where _item in (select item from temp.compact_items)
+        """.format(
+            version_table
+        )
+    )
+    db.execute(
+        """
+        update [{0}] set _version = (
+          select number from temp.compact_numbers where compact_numbers._id = [{0}]._id
+        )
+        where _item in (select item from temp.compact_items)
+        """.format(
+            version_table
+        )
+    )
+    if db[keyframe_table].exists():
+        db.execute(
+            """
+            update [{0}] set version = (
+              select _version from [{1}] where [{1}]._id = [{0}].item_version
+            )
+            where item in (select item from temp.compact_items)
+            """.format(
+                keyframe_table, version_table
+            )
+        )
+    if fts_columns:
+        db.execute(
+            """
+            insert into [{0}] (rowid, {1})
+            select _id, {2} from [{3}]
+            where _id in (select _id from temp.compact_kept){4}
+            """.format(
+                fts_table,
+                fts_column_list,
+                fts_values,
+                version_table,
+                # Removals are not indexed
+                " and _removed is not 1" if "_removed" in version_columns else "",
+            )
+        )
+
+
+def incremental_vacuum(db):
+    """
+    Return the pages freed by compact() to the file system. The first time
+    this switches the database to incremental auto-vacuum, which takes one
+    full VACUUM.
+    """
+    if db.execute("pragma auto_vacuum").fetchone()[0] != 2:
+        db.execute("pragma auto_vacuum = incremental")
+        db.execute("vacuum")
+    else:
+        # Each step of this pragma frees one page - executescript() steps
+        # it until it is done
+        db.conn.executescript("pragma incremental_vacuum")
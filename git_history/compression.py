@@ -0,0 +1,224 @@
+import collections
+import functools
+import hashlib
+import struct
+import zlib
+
+# Compressed values are stored as BLOBs starting with this prefix, followed
+# by a codec byte. zstd values then have a 4 byte dictionary ID, 0 for none.
+# Interned values are an 8 byte ID of a row in the interned_values table.
+PREFIX = b"\x00gh"
+ZLIB = b"z"
+ZSTD = b"s"
+REFERENCE = b"r"
+
+# Number of large values to collect before training a zstd dictionary
+DICTIONARY_SAMPLES = 1000
+DICTIONARY_SIZE = 110 * 1024
+
+
+def _zstandard():
+    # Imported on first use, as most runs never need it
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("zstd compression requires the zstandard package")
+    return zstandard
+
+
+class Compressor:
+    """
+    Compresses str values of at least threshold characters into prefixed BLOBs.
+
+    With codec="zstd" and train_dictionary=True, the first DICTIONARY_SAMPLES
+    large values are used to train a shared dictionary, which is then passed
+    to save_dictionary(bytes) - that should persist it and return its ID.
+    """
+
+    def __init__(
+        self,
+        codec="zlib",
+        threshold=1024,
+        dictionary=None,
+        dictionary_id=0,
+        train_dictionary=False,
+        save_dictionary=None,
+    ):
+        if codec == "zstd":
+            _zstandard()
+        self.codec = codec
+        self.threshold = threshold
+        self.train_dictionary = train_dictionary and dictionary is None
+        self.save_dictionary = save_dictionary
+        self._samples = []
+        self._use_dictionary(dictionary, dictionary_id)
+
+    def _use_dictionary(self, dictionary, dictionary_id):
+        self.dictionary_id = dictionary_id
+        if self.codec == "zstd":
+            zstandard = _zstandard()
+            if dictionary is not None:
+                self._zstd = zstandard.ZstdCompressor(
+                    dict_data=zstandard.ZstdCompressionDict(dictionary)
+                )
+            else:
+                self._zstd = zstandard.ZstdCompressor()
+
+    def encode(self, value):
+        if not isinstance(value, str) or len(value) < self.threshold:
+            return value
+        data = value.encode("utf-8")
+        if self.codec == "zlib":
+            return PREFIX + ZLIB + zlib.compress(data)
+        if self.train_dictionary:
+            self._samples.append(data)
+            if len(self._samples) >= DICTIONARY_SAMPLES:
+                self._train()
+        return (
+            PREFIX
+            + ZSTD
+            + struct.pack(">I", self.dictionary_id)
+            + self._zstd.compress(data)
+        )
+
+    def _train(self):
+        zstandard = _zstandard()
+        try:
+            dictionary = zstandard.train_dictionary(DICTIONARY_SIZE, self._samples)
+        except zstandard.ZstdError:
+            # Not enough distinct material yet - try again with more samples,
+            # but give up rather than holding on to samples indefinitely
+            if len(self._samples) >= DICTIONARY_SAMPLES * 10:
+                self.train_dictionary = False
+                self._samples = []
+            return
+        self.train_dictionary = False
+        self._samples = []
+        dictionary_bytes = dictionary.as_bytes()
+        self._use_dictionary(dictionary_bytes, self.save_dictionary(dictionary_bytes))
+
+
+class ValueInterner:
+    """
+    Replaces str values of at least threshold characters with a reference to
+    a row in the interned_values table, keyed by the SHA-1 of the value, so
+    a value that repeats across versions and items is only stored once.
+
+    The IDs of the cache_size most recently used hashes are kept in memory.
+    encode_value, if provided, is applied to the values that are stored in
+    interned_values and to any values that are too short to be interned.
+    """
+
+    def __init__(self, db, threshold=1024, encode_value=None, cache_size=10000):
+        self.db = db
+        self.threshold = threshold
+        self.encode_value = encode_value
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        if not db["interned_values"].exists():
+            db["interned_values"].create(
+                {"id": int, "hash": str, "value": str}, pk="id"
+            )
+            db["interned_values"].create_index(["hash"], unique=True)
+
+    def encode(self, value):
+        if not isinstance(value, str) or len(value) < self.threshold:
+            return self.encode_value(value) if self.encode_value else value
+        return PREFIX + REFERENCE + struct.pack(">Q", self._intern(value))
+
+    def _intern(self, value):
+        digest = hashlib.sha1(value.encode("utf-8")).hexdigest()
+        value_id = self.cache.get(digest)
+        if value_id is not None:
+            self.cache.move_to_end(digest)
+            return value_id
+        row = self.db.execute(
+            "select id from interned_values where hash = ?", [digest]
+        ).fetchone()
+        if row is not None:
+            value_id = row[0]
+        else:
+            # interned_values is shared by every namespace, so SQLite picks
+            # the id - this runs inside the transaction that writes a commit
+            value_id = self.db.execute(
+                "insert into interned_values (hash, value) values (?, ?)",
+                [digest, self.encode_value(value) if self.encode_value else value],
+            ).lastrowid
+        self.cache[digest] = value_id
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return value_id
+
+
+class Decompressor:
+    """
+    Reverses Compressor.encode() and ValueInterner.encode() - any other value
+    is returned unchanged.
+
+    conn is needed to load zstd dictionaries from the compression_dictionaries
+    table and interned values from the interned_values table.
+    """
+
+    def __init__(self, conn=None):
+        self.conn = conn
+        self._zstd = {}
+        self._interned_value = functools.lru_cache(maxsize=1000)(self._interned_value)
+
+    def decode(self, value):
+        if not isinstance(value, bytes) or value[:3] != PREFIX:
+            return value
+        codec = value[3:4]
+        if codec == ZLIB:
+            return zlib.decompress(value[4:]).decode("utf-8")
+        elif codec == ZSTD:
+            (dictionary_id,) = struct.unpack(">I", value[4:8])
+            return (
+                self._decompressor(dictionary_id).decompress(value[8:]).decode("utf-8")
+            )
+        elif codec == REFERENCE:
+            (value_id,) = struct.unpack(">Q", value[4:12])
+            return self._interned_value(value_id)
+        return value
+
+    def _interned_value(self, value_id):
+        (value,) = self.conn.execute(
+            "select value from interned_values where id = ?", [value_id]
+        ).fetchone()
+        return self.decode(value)
+
+    def decode_row(self, row):
+        return {key: self.decode(value) for key, value in row.items()}
+
+    def _decompressor(self, dictionary_id):
+        zstandard = _zstandard()
+        if dictionary_id not in self._zstd:
+            if dictionary_id:
+                dictionary = self.conn.execute(
+                    "select dictionary from compression_dictionaries where id = ?",
+                    [dictionary_id],
+                ).fetchone()[0]
+                self._zstd[dictionary_id] = zstandard.ZstdDecompressor(
+                    dict_data=zstandard.ZstdCompressionDict(dictionary)
+                )
+            else:
+                self._zstd[dictionary_id] = zstandard.ZstdDecompressor()
+        return self._zstd[dictionary_id]
+
+
+def register_functions(conn):
+    "Register a decompress(value) SQL function on a sqlite3 connection"
+    conn.create_function("decompress", 1, Decompressor(conn).decode)
+
+
+def load_dictionary(db, namespace_id):
+    "Returns (dictionary_bytes, id) for the namespace, or (None, 0)"
+    if not db["compression_dictionaries"].exists():
+        return None, 0
+    row = db.execute(
+        """
+        select dictionary, id from compression_dictionaries
+        where namespace = ? order by id desc limit 1
+        """,
+        [namespace_id],
+    ).fetchone()
+    return tuple(row) if row else (None, 0)
@@ -0,0 +1,88 @@
+import re
+import zlib
+
+# Deleted files are compared by content if none of them has exactly the same
+# blob as the added file. Files are split into pieces at newlines and at
+# JSON and CSV punctuation, ignoring whitespace, so that files on a single
+# line or with different indentation can be compared too. A deleted file
+# counts as the previous path of the added one if at least this share of
+# their sampled pieces are the same.
+SIMILARITY_THRESHOLD = 0.5
+SEPARATORS = re.compile(rb"[\n,;{}\[\]]")
+# For files with more than SAMPLE_ABOVE distinct pieces, one in every
+# SAMPLE_RATE pieces is compared, chosen by checksum so that the same
+# pieces are sampled from both files
+SAMPLE_ABOVE = 256
+SAMPLE_RATE = 4
+# Give up rather than comparing against more deleted files than this
+MAX_CANDIDATES = 20
+
+
+def find_previous_path(repo_git, blobs, commit, path):
+    """
+    If path was added by commit, return the path of the file it was moved or
+    renamed from, or None if it was not added by a move.
+
+    Rather than running Git's rename detection over the whole history, this
+    only looks at the files deleted by that one commit: a deleted file with
+    the same blob wins, then the most similar file by sampled content. repo_git
+    is a GitPython Repo.git and blobs a git_history.blobs.BlobReader.
+    """
+    if not commit["parents"]:
+        return None
+    added_sha = None
+    deleted = []
+    for status, old_sha, new_sha, changed_path in diff_tree(
+        repo_git, commit["parents"][0], commit["hash"]
+    ):
+        if changed_path == path:
+            if status != "A":
+                # It was already there, so this is not where it started
+                return None
+            added_sha = new_sha
+        elif status == "D":
+            deleted.append((old_sha, changed_path))
+    if added_sha is None:
+        return None
+    for old_sha, old_path in deleted:
+        if old_sha == added_sha:
+            return old_path
+    if not deleted or len(deleted) > MAX_CANDIDATES:
+        return None
+    added = piece_checksums(blobs.read_object(added_sha))
+    rate = SAMPLE_RATE if len(added) > SAMPLE_ABOVE else 1
+    added = sample(added, rate)
+    best_score, best_path = 0, None
+    for old_sha, old_path in deleted:
+        score = similarity(
+            added, sample(piece_checksums(blobs.read_object(old_sha)), rate)
+        )
+        if score > best_score:
+            best_score, best_path = score, old_path
+    return best_path if best_score >= SIMILARITY_THRESHOLD else None
+
+
+def diff_tree(repo_git, parent, commit):
+    "Yields (status, old_sha, new_sha, path) for each file changed by commit"
+    output = repo_git.diff_tree("-r", "--no-renames", "-z", parent, commit)
+    fields = output.split("\0")
+    for meta, path in zip(fields[::2], fields[1::2]):
+        # :old_mode new_mode old_sha new_sha status
+        _, _, old_sha, new_sha, status = meta.lstrip(":").split()
+        yield status, old_sha, new_sha, path
+
+
+def piece_checksums(content):
+    "The CRC-32 checksums of the distinct pieces of content"
+    return {zlib.crc32(piece.strip()) for piece in SEPARATORS.split(content)}
+
+
+def sample(checksums, rate):
+    return {checksum for checksum in checksums if checksum % rate == 0}
+
+
+def similarity(a, b):
+    "Share of the sampled pieces that are in both samples, from 0 to 1"
+    if not a and not b:
+        return 0
+    return len(a & b) / len(a | b)
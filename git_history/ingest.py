@@ -0,0 +1,591 @@
+import click
+import collections
+import importlib
+import json
+import textwrap
+from .utils import _hash, compute_delta, fix_reserved_columns, jsonify_all
+
+
+class Ingestor:
+    """
+    Turns versions of a file into items and item versions, and writes them
+    to a sink - see git_history.sinks. sink can also be a sqlite_utils
+    Database or the path to a database file, which uses an SQLiteSink.
+
+    The state needed to detect changes - the current version and last full
+    hash of every item - is loaded from the sink once and then kept in
+    memory, so one instance can be used for many calls to ingest().
+
+    ids, ignore, convert, imports, csv, dialect, full_versions,
+    track_removals, ignore_duplicate_ids, shards and debug match the options
+    of the file command. parse_workers turns on the --pipeline behaviour.
+
+    blob_cache_size keeps the items parsed from that many of the most
+    recent distinct Git blobs, so content with a sha attribute that has
+    been seen recently is not parsed again. It is not used with
+    parse_workers.
+
+    refs, when ingesting from several branches, is {ref: hashes of the
+    commits reachable from it}. Each version then records the changes from
+    the item's previous state on the refs its commit is on, rather than from
+    the latest version on any of them, so replaying the versions of one ref
+    gives that ref's history. Only the items whose state on a ref differs
+    from their latest version are kept in memory for it.
+    """
+
+    def __init__(
+        self,
+        sink,
+        ids=(),
+        ignore=(),
+        convert=None,
+        imports=(),
+        csv=False,
+        dialect=None,
+        full_versions=False,
+        track_removals=False,
+        ignore_duplicate_ids=False,
+        shards=1,
+        parse_workers=None,
+        blob_cache_size=0,
+        refs=None,
+        debug=False,
+    ):
+        from .sinks import Sink, SQLiteSink
+
+        if not isinstance(sink, Sink):
+            sink = SQLiteSink(sink)
+        if track_removals and not ids:
+            raise ValueError("track_removals requires ids")
+        if shards > 1 and not isinstance(sink, SQLiteSink):
+            raise ValueError("shards can only be used with an SQLiteSink")
+        if shards > 1 and refs:
+            raise ValueError("shards cannot be used with refs")
+        self.sink = sink
+        self.ids = ids
+        self.full_versions = full_versions
+        self.track_removals = track_removals
+        self.ignore_duplicate_ids = ignore_duplicate_ids
+        self.parse_workers = parse_workers
+        self.debug = debug
+        self.blob_cache = collections.OrderedDict() if blob_cache_size else None
+        self.blob_cache_size = blob_cache_size
+
+        # The built-in converters drop ignored columns themselves, and a
+        # custom one is wrapped to do so, so that work happens in the parse
+        # workers when using parse_workers, and parsed items can be cached
+        self.ignore_after_convert = ignore if convert else ()
+        # The CSV converter can also parse large files as they are read from
+        # Git, but content has to be bytes to reach parse workers. json.load()
+        # reads the whole file into a string anyway, so JSON gains nothing.
+        self.accepts_streams = bool(
+            (csv or dialect) and not convert and not parse_workers
+        )
+        imports = list(imports)
+        if csv or dialect:
+            convert = build_csv_convert_string(dialect, ignore)
+            imports = ["io", "csv", "itertools"]
+        if not convert:
+            convert = build_json_convert_string(ignore)
+        self.convert = convert
+        self.imports = imports
+        self.convert_function = compile_convert(
+            convert, imports, self.ignore_after_convert
+        )
+
+        # Any id that is a reserved column needs to be renamed first
+        self.fixed_ids = set(fix_reserved_columns({id: 1 for id in ids}).keys())
+
+        sink.open(self)
+        # In-memory caches of the most recent version and last full hash for each item_id
+        self.item_id_to_version, self.item_id_to_last_full_hash = sink.load_state()
+
+        # Compact 20 byte digests of the _item_id of every item that is currently present
+        self.live_digests = set()
+        if track_removals:
+            self.live_digests = {
+                bytes.fromhex(item_id) for item_id in sink.live_item_ids()
+            }
+
+        # {ref: {item_id: (full hash, item, live)}} for the items whose state
+        # on that ref is not their latest version
+        self.ref_states = None
+        if refs:
+            self.commit_refs = {}
+            for ref, commit_hashes in refs.items():
+                for commit_hash in commit_hashes:
+                    self.commit_refs.setdefault(commit_hash, set()).add(ref)
+            self.ref_states = {ref: {} for ref in refs}
+            self.ref_states.update(sink.load_ref_states(list(refs)))
+
+        self.shard_pool = None
+        if ids and shards > 1:
+            from .shards import ShardPool
+
+            self.shard_pool = ShardPool(
+                shards, sink.path, sink.item_table, full_versions
+            )
+
+    def ingest(self, versions):
+        """
+        Ingest an iterable of (commit_at, commit_hash, content) tuples, in order.
+        content is bytes, or a file-like object if accepts_streams is True.
+        """
+        if not self.accepts_streams:
+            versions = read_streams(versions)
+        if self.parse_workers:
+            from .pipeline import pipeline_versions
+
+            parsed_versions = pipeline_versions(
+                versions,
+                self.convert,
+                self.imports,
+                self.parse_workers,
+                ignore=self.ignore_after_convert,
+            )
+        else:
+            parsed_versions = parse_versions(
+                versions, self.convert_function, self.blob_cache, self.blob_cache_size
+            )
+        try:
+            for commit_at, commit_hash, content, items in parsed_versions:
+                self.ingest_items(commit_at, commit_hash, items)
+        finally:
+            parsed_versions.close()
+
+    def ingest_blob(self, commit_at, commit_hash, content):
+        "Parse and ingest a single version of the file"
+        versions = [(commit_at, commit_hash, content)]
+        if not self.accepts_streams:
+            versions = read_streams(versions)
+        for commit_at, commit_hash, content, items in parse_versions(
+            versions, self.convert_function, self.blob_cache, self.blob_cache_size
+        ):
+            self.ingest_items(commit_at, commit_hash, items)
+
+    def ingest_items(self, commit_at, commit_hash, items):
+        """
+        Ingest already-parsed items for a commit - None means the file was
+        empty. Ignored columns are dropped while parsing, so they should
+        already be missing from items.
+        """
+        self.sink.start_commit(commit_hash, commit_at)
+        if items is not None:
+            if not self.ids:
+                self.sink.add_items(
+                    [jsonify_all(fix_reserved_columns(item)) for item in items]
+                )
+            else:
+                self._ingest_items_with_ids(commit_hash, items)
+        self.sink.end_commit()
+
+    def _ingest_items_with_ids(self, commit_hash, items):
+        # Validate all items in the commit have ID columns - raises ClickException if not
+        validate_items_have_id_columns(items, self.ids, commit_hash)
+
+        # Use this to detect IDs that are duplicated in the same commit
+        item_ids_seen_in_this_commit = set()
+
+        # Which of these are new versions of things we have seen before?
+        keyed_items = []
+        for item in items:
+            item = fix_reserved_columns(item)
+            item_id = _hash(dict((id, item.get(id)) for id in self.fixed_ids))
+            if item_id in item_ids_seen_in_this_commit:
+                # Ensure there are not multiple items in this commit with the same ID
+                if not self.ignore_duplicate_ids:
+                    raise DuplicateIdsException(
+                        commit_hash, items, self.fixed_ids, item_id
+                    )
+                else:
+                    # Skip this one
+                    continue
+
+            item_ids_seen_in_this_commit.add(item_id)
+            keyed_items.append((item_id, item))
+
+        refs = None
+        if self.ref_states is not None:
+            refs = self.commit_refs.get(commit_hash, set(self.ref_states))
+        if self.shard_pool is not None:
+            changes = self.shard_pool.diff(self.changed_items(keyed_items))
+        elif refs is not None:
+            changes = self.iterate_ref_changes(refs, keyed_items)
+        else:
+            changes = self.iterate_changes(keyed_items)
+
+        new_count = changed_count = removed_count = 0
+        for (
+            item_id,
+            item_full_hash,
+            item_flattened,
+            updated_values,
+            item_is_new,
+        ) in changes:
+            if item_is_new:
+                new_count += 1
+            else:
+                changed_count += 1
+            # It's either new or the content has changed
+            self.item_id_to_last_full_hash[item_id] = item_full_hash
+            version = self.item_id_to_version.get(item_id, 0) + 1
+            self.item_id_to_version[item_id] = version
+            self.sink.add_version(
+                item_id, version, item_flattened, updated_values, item_full_hash
+            )
+            if refs is not None and self.track_removals:
+                self.live_digests.add(bytes.fromhex(item_id))
+
+        if self.track_removals:
+            # Anything live before this commit but not seen in it was removed
+            seen_digests = {
+                bytes.fromhex(item_id) for item_id in item_ids_seen_in_this_commit
+            }
+            if refs is None:
+                live_digests = self.live_digests
+                self.live_digests = seen_digests
+            else:
+                live_digests = set()
+                for ref in refs:
+                    live_digests |= self._live_digests_on(ref)
+            removed_item_ids = sorted(
+                digest.hex() for digest in live_digests - seen_digests
+            )
+            for item_id in removed_item_ids:
+                if refs is not None:
+                    self._diverge(refs, item_id, self._current_state(item_id))
+                    self.live_digests.discard(bytes.fromhex(item_id))
+                version = self.item_id_to_version[item_id] + 1
+                self.item_id_to_version[item_id] = version
+                # So that it counts as changed if it comes back
+                self.item_id_to_last_full_hash[item_id] = None
+                self.sink.remove_item(item_id, version)
+            removed_count = len(removed_item_ids)
+
+        self.sink.record_commit_stats(
+            seen=len(keyed_items),
+            new=new_count,
+            changed=changed_count,
+            unchanged=len(keyed_items) - new_count - changed_count,
+            removed=removed_count,
+        )
+
+    def changed_items(self, keyed_items):
+        """
+        Yields (item_id, item, item_full_hash, is_new) for each of the
+        (item_id, item) pairs that is new or has changed
+        """
+        for item_id, item in keyed_items:
+            # Has it changed since last time we saw it?
+            item_full_hash = _hash(item)
+
+            if self.debug:
+                self.sink.record_debug(item_full_hash, item)
+
+            item_is_new = item_id not in self.item_id_to_last_full_hash
+            if (
+                not item_is_new
+                and self.item_id_to_last_full_hash[item_id] == item_full_hash
+            ):
+                continue
+            yield item_id, item, item_full_hash, item_is_new
+
+    def iterate_changes(self, keyed_items):
+        """
+        Yields (item_id, item_full_hash, item_flattened, updated_values, is_new)
+        for each of the (item_id, item) pairs that is new or has changed
+        """
+        for item_id, item, item_full_hash, item_is_new in self.changed_items(
+            keyed_items
+        ):
+            # JSONify any lists/dicts to assist later comparison with row from DB
+            item_flattened = jsonify_all(item)
+
+            updated_values = None
+            if not self.full_versions:
+                previous_item = None
+                if not item_is_new:
+                    previous_item = self.sink.get_item(item_id)
+                updated_values = compute_delta(item_flattened, previous_item)
+                if not updated_values and not item_is_new and self.debug:
+                    # ERROR: full has changed but no visible changes?
+                    print("Potential bug: hashchanged but no updated_columns")
+                    import pdb
+
+                    pdb.set_trace()
+                    assert False
+
+            yield item_id, item_full_hash, item_flattened, updated_values, item_is_new
+
+    def iterate_ref_changes(self, refs, keyed_items):
+        """
+        iterate_changes() for a commit on several refs: an item has changed
+        if it differs from its state on any of refs, and updated_values holds
+        the changes from each of those states
+        """
+        ref_states = self.ref_states
+        for item_id, item in keyed_items:
+            item_full_hash = _hash(item)
+            if self.debug:
+                self.sink.record_debug(item_full_hash, item)
+            states = [ref_states[ref].get(item_id) for ref in refs]
+            latest_hash = self.item_id_to_last_full_hash.get(item_id)
+            if all(
+                (state[0] if state else latest_hash) == item_full_hash
+                for state in states
+            ):
+                continue
+            current = self._current_state(item_id)
+            states = [state or current for state in states]
+            item_flattened = jsonify_all(item)
+            updated_values = None
+            if not self.full_versions:
+                updated_values = {}
+                for full_hash, previous_item, _ in states:
+                    if full_hash != item_full_hash:
+                        updated_values.update(
+                            compute_delta(item_flattened, previous_item)
+                        )
+            item_is_new = all(previous_item is None for _, previous_item, _ in states)
+            self._diverge(refs, item_id, current)
+            yield item_id, item_full_hash, item_flattened, updated_values, item_is_new
+
+    def _current_state(self, item_id):
+        "(full hash, item, live) for the latest version of an item"
+        item = None
+        if item_id in self.item_id_to_version:
+            item = self.sink.get_item(item_id)
+        return (
+            self.item_id_to_last_full_hash.get(item_id),
+            item,
+            bytes.fromhex(item_id) in self.live_digests,
+        )
+
+    def _diverge(self, refs, item_id, current):
+        """
+        Called before a new version of an item is recorded in a commit on
+        refs: the other refs keep the current state of the item
+        """
+        for ref, states in self.ref_states.items():
+            if ref in refs:
+                states.pop(item_id, None)
+            else:
+                states.setdefault(item_id, current)
+
+    def _live_digests_on(self, ref):
+        live_digests = set(self.live_digests)
+        for item_id, (_, _, live) in self.ref_states[ref].items():
+            if live:
+                live_digests.add(bytes.fromhex(item_id))
+            else:
+                live_digests.discard(bytes.fromhex(item_id))
+        return live_digests
+
+    def close(self):
+        "Shut down any worker processes and let the sink finish up"
+        self._close_workers()
+        self.sink.close()
+
+    def _close_workers(self):
+        if self.shard_pool is not None:
+            self.shard_pool.close()
+            self.shard_pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self._close_workers()
+
+
+def read_streams(versions):
+    "Read any file-like content into bytes"
+    for commit_at, commit_hash, content in versions:
+        if not isinstance(content, bytes):
+            content = content.read()
+        yield commit_at, commit_hash, content
+
+
+def parse_versions(versions, convert_function, cache=None, cache_size=0):
+    """
+    Yields (commit_at, hash, content, items) - items is None for empty files
+
+    cache is an OrderedDict of items keyed by the sha attribute of content,
+    holding up to cache_size entries - items must not be modified.
+    """
+    for git_commit_at, git_hash, content in versions:
+        sha = getattr(content, "sha", None)
+        if cache is not None and sha in cache:
+            cache.move_to_end(sha)
+            yield git_commit_at, git_hash, content, cache[sha]
+            continue
+        items = None
+        # Only small files are read into bytes, so streams are never empty
+        if not isinstance(content, bytes) or content.strip():
+            # list() to resolve generators for repeated access later
+            try:
+                items = list(convert_function(content))
+            except Exception:
+                print("\nError in commit: {}".format(git_hash))
+                raise
+        if cache is not None and sha is not None:
+            cache[sha] = items
+            if len(cache) > cache_size:
+                cache.popitem(last=False)
+        yield git_commit_at, git_hash, content, items
+
+
+def build_csv_convert_string(dialect, ignore=()):
+    # content can be a file-like object for large files - see git_history.blobs
+    if dialect:
+        read_dialect = 'dialect = "{}"'.format(dialect)
+    else:
+        # Sniff the first 1024 characters, then carry on from where that stopped
+        read_dialect = textwrap.dedent(
+            """
+            sample = text.read(1024)
+            dialect = csv.Sniffer().sniff(sample)
+            text = itertools.chain(io.StringIO(sample + text.readline()), text)
+            """
+        ).strip()
+    if not ignore:
+        parse = "return csv.DictReader(text, dialect=dialect)"
+    else:
+        # Only build dictionaries from the columns that are not being ignored
+        parse = textwrap.dedent(
+            """
+            rows = csv.reader(text, dialect=dialect)
+            fieldnames = next(rows, [])
+            keep = [(i, name) for i, name in enumerate(fieldnames) if name not in {!r}]
+            return [
+                {{name: row[i] if i < len(row) else None for i, name in keep}}
+                for row in rows
+                if row
+            ]
+            """.format(
+                set(ignore)
+            )
+        ).strip()
+    return "\n".join(
+        [
+            "if isinstance(content, bytes):",
+            '    text = io.StringIO(content.decode("utf-8"))',
+            "else:",
+            '    text = io.TextIOWrapper(content, encoding="utf-8", newline="")',
+            read_dialect,
+            parse,
+        ]
+    )
+
+
+def build_json_convert_string(ignore=()):
+    load = "json.loads(content)"
+    if not ignore:
+        return load
+    # Drop ignored keys as soon as each item is parsed, rather than copying it
+    return textwrap.dedent(
+        """
+        items = {}
+        for item in items:
+            for key in {!r}:
+                item.pop(key, None)
+        return items
+        """.format(
+            load, sorted(set(ignore))
+        )
+    ).strip()
+
+
+def compile_convert(convert, imports, ignore=()):
+    """
+    Compile convert code into a function of content. ignore is a list of
+    keys to drop from each item it returns, for code that does not do that
+    itself.
+    """
+    # Clean up the provided code
+    # If single line and no 'return', add the return
+    if "\n" not in convert and not convert.strip().startswith("return "):
+        convert = "return {}".format(convert)
+    # Compile the code into a function body called fn(content)
+    new_code = ["def fn(content):"]
+    for line in convert.split("\n"):
+        new_code.append("    {}".format(line))
+    code_o = compile("\n".join(new_code), "<string>", "exec")
+    locals = {}
+    globals = {"json": json}
+    for import_ in imports:
+        name = import_.split(".")[0]
+        if name not in globals:
+            globals[name] = LazyModule(name)
+        globals[name].imports.append(import_)
+    exec(code_o, globals, locals)
+    fn = locals["fn"]
+    if not ignore:
+        return fn
+
+    def fn_with_ignore(content):
+        # These items were just created, so nothing else holds them yet
+        return remove_ignore_columns(list(fn(content)), ignore)
+
+    return fn_with_ignore
+
+
+class LazyModule:
+    """
+    Stands in for a module passed to --import, importing it the first time
+    one of its attributes is used - so modules are never imported in a
+    process that does not call the convert function.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.imports = []
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            for import_ in self.imports:
+                importlib.import_module(import_)
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+
+def remove_ignore_columns(items, ignore):
+    "Remove the ignored keys from each freshly parsed item in place"
+    for item in items:
+        for key in ignore:
+            item.pop(key, None)
+    return items
+
+
+def validate_items_have_id_columns(items, ids, git_hash):
+    _ids_set = set(ids)
+    bad_items = [
+        bad_item for bad_item in items if not _ids_set.issubset(bad_item.keys())
+    ]
+    if bad_items:
+        raise click.ClickException(
+            "Commit: {} - every item must have the --id keys. These items did not:\n{}".format(
+                git_hash, json.dumps(bad_items[:5], indent=4, default=str)
+            )
+        )
+
+
+class DuplicateIdsException(click.ClickException):
+    def __init__(self, git_hash, items, fixed_ids, item_id):
+        message = "Commit: {} - found multiple items with the same ID:\n{}".format(
+            git_hash,
+            json.dumps(
+                [
+                    item
+                    for item in items
+                    if _hash(dict((id, item.get(id)) for id in fixed_ids)) == item_id
+                ][:5],
+                indent=4,
+                default=str,
+            ),
+        )
+        super().__init__(message)
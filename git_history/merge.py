@@ -0,0 +1,341 @@
+import json
+import struct
+
+from .catalog import GLOBAL_TABLES, id_columns, namespace_of, schema_tables
+from .compression import PREFIX, REFERENCE, ZSTD
+
+# Copied rows of the GLOBAL_TABLES get new ids. The new ids are then looked
+# up by these columns, which are unique in every database, to fill in the
+# temporary tables that map old ids to new ones.
+NATURAL_KEYS = {
+    "namespaces": ("name",),
+    "commits": ("namespace", "hash"),
+    "columns": ("namespace", "name"),
+    "refs": ("namespace", "name"),
+}
+# Interned values and zstd compressed values contain the id of a row in one
+# of these tables, so those values are rewritten with the new ids as they
+# are copied.
+ENCODING_TABLES = ("compression_dictionaries", "interned_values")
+
+
+def merge(db, path, namespaces=None):
+    """
+    Copy namespaces from the database file at path into db, a sqlite_utils
+    Database, along with their commits, columns, refs, full-text search
+    indexes, compression dictionaries and interned values.
+
+    Every table is copied by SQLite with a single INSERT ... SELECT. Rows in
+    GLOBAL_TABLES get new ids, and the columns that refer to them are
+    translated through temporary tables mapping old ids to new. Item and
+    version ids, _item_id and _version values are copied unchanged.
+
+    namespaces defaults to every namespace in the source. Raises ValueError
+    if any of them is missing from the source or already in db, in which
+    case nothing is copied. Returns the list of namespaces that were copied.
+    """
+    conn = db.conn
+    conn.execute("attach database ? as source", [path])
+    try:
+        master = conn.execute(
+            "select type, name, tbl_name, sql from source.sqlite_master"
+        ).fetchall()
+        source_tables = schema_tables(conn, "source")
+        if "namespaces" not in source_tables:
+            raise ValueError("{} does not have a namespaces table".format(path))
+        available = [
+            row[0]
+            for row in conn.execute("select name from source.namespaces order by id")
+        ]
+        if namespaces is None:
+            namespaces = available
+        namespaces = list(namespaces)
+        missing = [namespace for namespace in namespaces if namespace not in available]
+        if missing:
+            raise ValueError(
+                "{} does not have namespace {}".format(path, ", ".join(missing))
+            )
+        tables = [
+            table
+            for table in source_tables
+            if table not in GLOBAL_TABLES
+            and table not in ENCODING_TABLES
+            and namespace_of(table, available) in namespaces
+        ]
+        fts_tables = [
+            name
+            for type_, name, _, sql in master
+            if type_ == "table"
+            and (sql or "").upper().startswith("CREATE VIRTUAL")
+            and name.endswith("_fts")
+            and name[: -len("_fts")] in tables
+        ]
+        views = [
+            (name, sql)
+            for type_, name, _, sql in master
+            if type_ == "view" and namespace_of(name, available) in namespaces
+        ]
+        _check_destination(db, path, namespaces, tables + fts_tables, views)
+        encoded = [table for table in ENCODING_TABLES if table in source_tables]
+
+        conn.create_function("merge_encode_id", 2, _encode_id)
+        conn.execute("begin")
+        with conn:
+            for table in GLOBAL_TABLES + tuple(encoded):
+                if table in source_tables:
+                    _create_or_extend(db, master, table)
+            for table in GLOBAL_TABLES:
+                if table in source_tables:
+                    _copy_global_table(conn, table, namespaces)
+            if "compression_dictionaries" in encoded:
+                _copy_dictionaries(conn)
+            if "interned_values" in encoded:
+                _copy_interned_values(conn, encoded)
+            for table in tables:
+                _execute_schema(conn, master, table)
+                columns = id_columns(conn, "source", table)
+                conn.execute(
+                    "insert into main.[{}] ({}) select {} from source.[{}]".format(
+                        table,
+                        ", ".join("[{}]".format(column) for column in columns),
+                        ", ".join(_remapped(columns, encoded)),
+                        table,
+                    )
+                )
+            for fts_table in fts_tables:
+                # Item and version ids are unchanged, so the index itself can
+                # be copied rather than built again from decoded values
+                _execute_schema(conn, master, fts_table)
+                for type_, name, _, _ in master:
+                    if type_ == "table" and name.startswith(fts_table + "_"):
+                        conn.execute("delete from main.[{}]".format(name))
+                        conn.execute(
+                            "insert into main.[{0}] select * from source.[{0}]".format(
+                                name
+                            )
+                        )
+            for _, sql in views:
+                conn.execute(sql)
+            for table in GLOBAL_TABLES + tuple(encoded):
+                conn.execute("drop table if exists temp.[merge_{}]".format(table))
+    finally:
+        conn.execute("detach database source")
+    return namespaces
+
+
+def _check_destination(db, path, namespaces, tables, views):
+    if db["namespaces"].exists():
+        existing = [
+            row[0]
+            for row in db.execute(
+                "select name from namespaces where name in (select value from json_each(?))",
+                [json.dumps(namespaces)],
+            )
+        ]
+        if existing:
+            raise ValueError(
+                "Namespace {} from {} is already in the destination".format(
+                    ", ".join(existing), path
+                )
+            )
+    names = set(db.table_names()) | set(db.view_names())
+    clashes = [name for name in tables + [name for name, _ in views] if name in names]
+    if clashes:
+        raise ValueError(
+            "Table {} from {} is already in the destination".format(
+                ", ".join(clashes), path
+            )
+        )
+
+
+def _create_or_extend(db, master, table):
+    "Create table like the source one, or add any columns it is missing"
+    if not db[table].exists():
+        _execute_schema(db.conn, master, table)
+        return
+    existing = db[table].columns_dict
+    for row in db.execute("pragma source.table_info([{}])".format(table)):
+        if row[1] not in existing:
+            db.execute(
+                "alter table main.[{}] add column [{}] {}".format(table, row[1], row[2])
+            )
+
+
+def _execute_schema(conn, master, table):
+    "Run the CREATE statements for table and its indexes from the source"
+    for type_, name, tbl_name, sql in master:
+        if type_ == "table" and name == table:
+            conn.execute(sql)
+    for type_, name, tbl_name, sql in master:
+        if type_ == "index" and tbl_name == table and sql:
+            conn.execute(sql)
+
+
+def _copy_global_table(conn, table, namespaces):
+    "Copy the rows for namespaces, then record their new ids in merge_{table}"
+    columns = id_columns(conn, "source", table)
+    # The table's own id is left out, so the copies are numbered after the
+    # rows already in the destination, in their original order
+    copied = {column: target for column, target in columns.items() if target != table}
+    if table == "namespaces":
+        where = " where name in (select value from json_each(?))"
+        params = [json.dumps(namespaces)]
+    else:
+        where = _where_mapped(copied)
+        params = []
+    conn.execute(
+        "insert into main.[{}] ({}) select {} from source.[{}]{} order by rowid".format(
+            table,
+            ", ".join("[{}]".format(column) for column in copied),
+            ", ".join(_remapped(copied)),
+            table,
+            where,
+        ),
+        params,
+    )
+    if table not in NATURAL_KEYS:
+        return
+    conn.execute(
+        "create temp table [merge_{}] (old integer primary key, new integer)".format(
+            table
+        )
+    )
+    conn.execute(
+        """
+        insert into temp.[merge_{0}] (old, new)
+        select source_row.id, main_row.id
+        from source.[{0}] as source_row join main.[{0}] as main_row on {1}
+        """.format(
+            table,
+            " and ".join(
+                "main_row.[{}] = {}".format(
+                    column, _remap(column, columns[column], "source_row")
+                )
+                for column in NATURAL_KEYS[table]
+            ),
+        )
+    )
+
+
+def _copy_dictionaries(conn):
+    """
+    Copy the zstd dictionaries of the copied namespaces, recording the
+    4 byte ids that appear in compressed values in merge_compression_dictionaries
+    """
+    conn.execute(
+        """
+        insert into main.compression_dictionaries (namespace, dictionary)
+        select {0}, dictionary from source.compression_dictionaries
+        where {0} is not null order by id
+        """.format(
+            _remap("namespace", "namespaces")
+        )
+    )
+    conn.execute(
+        "create temp table merge_compression_dictionaries (old blob primary key, new blob)"
+    )
+    conn.execute(
+        """
+        insert into temp.merge_compression_dictionaries (old, new)
+        select merge_encode_id(source_row.id, 4), merge_encode_id(main_row.id, 4)
+        from source.compression_dictionaries as source_row
+          join main.compression_dictionaries as main_row
+            on main_row.namespace = {}
+            and main_row.dictionary = source_row.dictionary
+        """.format(
+            _remap("namespace", "namespaces", "source_row")
+        )
+    )
+
+
+def _copy_interned_values(conn, encoded):
+    """
+    Copy the interned values that are not already in the destination, then
+    record the references to every one of them in merge_interned_values
+    """
+    conn.execute(
+        """
+        insert into main.interned_values (hash, value)
+        select hash, {} from source.interned_values
+        where hash not in (select hash from main.interned_values) order by id
+        """.format(
+            # Values can be compressed before they are interned
+            _reencode(
+                "[value]", [table for table in encoded if table != "interned_values"]
+            )
+        )
+    )
+    conn.execute(
+        "create temp table merge_interned_values (old blob primary key, new blob)"
+    )
+    conn.execute(
+        """
+        insert into temp.merge_interned_values (old, new)
+        select merge_encode_id(source_row.id, 8), merge_encode_id(main_row.id, 8)
+        from source.interned_values as source_row
+          join main.interned_values as main_row on main_row.hash = source_row.hash
+        """
+    )
+
+
+def _encode_id(value_id, size):
+    "The id as it appears in a dictionary (4 bytes) or interned value (8 bytes)"
+    return struct.pack(">I" if size == 4 else ">Q", value_id)
+
+
+def _reencode(reference, encoded):
+    "SQL for a value that may be encoded, with its ids translated"
+    cases = []
+    if "interned_values" in encoded:
+        cases.append(
+            """
+            when substr({0}, 1, 4) = x'{1}' then cast(x'{1}' || coalesce(
+              (select new from temp.merge_interned_values where old = substr({0}, 5)),
+              substr({0}, 5)
+            ) as blob)""".format(
+                reference, (PREFIX + REFERENCE).hex()
+            )
+        )
+    if "compression_dictionaries" in encoded:
+        cases.append(
+            """
+            when substr({0}, 1, 4) = x'{1}' then cast(x'{1}' || coalesce(
+              (
+                select new from temp.merge_compression_dictionaries
+                where old = substr({0}, 5, 4)
+              ),
+              substr({0}, 5, 4)
+            ) || substr({0}, 9) as blob)""".format(
+                reference, (PREFIX + ZSTD).hex()
+            )
+        )
+    if not cases:
+        return reference
+    return "case {} else {} end".format("".join(cases), reference)
+
+
+def _remap(column, target, alias=None):
+    "SQL for the value of column, translated to the new id if it holds an id"
+    reference = (
+        "[{}]".format(column) if alias is None else "{}.[{}]".format(alias, column)
+    )
+    if target is None:
+        return reference
+    return "(select new from temp.[merge_{}] where old = {})".format(target, reference)
+
+
+def _remapped(columns, encoded=()):
+    return [
+        _remap(column, target) if target else _reencode("[{}]".format(column), encoded)
+        for column, target in columns.items()
+    ]
+
+
+def _where_mapped(columns):
+    "Only the rows that refer to copied rows in GLOBAL_TABLES"
+    conditions = [
+        "{} is not null".format(_remap(column, target))
+        for column, target in columns.items()
+        if target is not None
+    ]
+    return " where " + " and ".join(conditions) if conditions else ""
@@ -0,0 +1,100 @@
+import sqlite3
+
+# Indexes for the queries issued by the generated views, the as-of, diff
+# and export commands and typical Datasette browsing, keyed by table suffix.
+# Each one starts with the columns those queries filter on, followed by the
+# ones they compare or sort by - the rows themselves are still read from the
+# table, since as-of and export need every column of a version.
+NAMESPACE_INDEXES = {
+    "": (
+        # Items last changed by a commit
+        ("_commit",),
+    ),
+    "_version": (
+        # Most recent version of an item as of a commit
+        ("_item", "_commit", "_version"),
+        # Versions in a range of commits
+        ("_commit", "_item", "_version"),
+    ),
+    "_changed": (
+        # Versions that changed a specific column
+        ("column", "item_version"),
+    ),
+}
+COMMIT_INDEXES = (
+    # Resolving a timestamp to a commit, and listing commits by time
+    ("namespace", "commit_at", "id"),
+)
+
+
+def optimize(db, namespaces=None):
+    """
+    Create the indexes in NAMESPACE_INDEXES and COMMIT_INDEXES, drop any
+    index made redundant by one of them, then update the statistics used by
+    the query planner.
+
+    namespaces defaults to every namespace in the namespaces table. Tables
+    that do not exist are skipped, and existing indexes are left alone, so
+    this is safe to run repeatedly.
+    """
+    if namespaces is None:
+        namespaces = (
+            [row[0] for row in db.execute("select name from namespaces")]
+            if db["namespaces"].exists()
+            else []
+        )
+    if db["commits"].exists():
+        for columns in COMMIT_INDEXES:
+            db["commits"].create_index(columns, if_not_exists=True)
+    for namespace in namespaces:
+        for suffix, indexes in NAMESPACE_INDEXES.items():
+            table = namespace + suffix
+            if not db[table].exists():
+                continue
+            for columns in indexes:
+                db[table].create_index(columns, if_not_exists=True)
+            drop_prefix_indexes(db, table)
+    db.execute("analyze")
+    db.execute("pragma optimize")
+
+
+def drop_prefix_indexes(db, table):
+    """
+    Drop the non-unique indexes on table whose columns are the leading
+    columns of another index, such as the _item and _commit indexes that
+    earlier versions of the file command created, since SQLite can use the
+    longer index for the same lookups
+    """
+    indexes = [index for index in db[table].indexes if index.origin == "c"]
+    for index in indexes:
+        if index.unique:
+            continue
+        if any(
+            len(other.columns) > len(index.columns)
+            and other.columns[: len(index.columns)] == index.columns
+            for other in indexes
+        ):
+            db.execute("drop index [{}]".format(index.name))
+
+
+def index_sizes(db):
+    """
+    Returns a list of (table, index, size in bytes) for every index, largest
+    first. size is None if SQLite was compiled without the dbstat table.
+    """
+    indexes = db.execute(
+        """
+        select tbl_name, name from sqlite_master
+        where type = 'index' and tbl_name not like 'sqlite_%'
+        """
+    ).fetchall()
+    try:
+        sizes = dict(
+            db.execute("select name, sum(pgsize) from dbstat group by name").fetchall()
+        )
+    except sqlite3.OperationalError:
+        sizes = {}
+    return sorted(
+        ((table, index, sizes.get(index)) for table, index in indexes),
+        key=lambda row: (-(row[2] or 0), row[0], row[1]),
+    )
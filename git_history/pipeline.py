@@ -0,0 +1,115 @@
+from concurrent.futures import ProcessPoolExecutor
+import collections
+import queue
+import threading
+
+_DONE = object()
+
+# Set in each parse worker process by _init_parse_worker()
+_convert_function = None
+
+
+def _init_parse_worker(convert, imports, ignore):
+    global _convert_function
+    from .ingest import compile_convert
+
+    _convert_function = compile_convert(convert, imports, ignore)
+
+
+def _parse(content):
+    return list(_convert_function(content))
+
+
+class _Failure:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def read_ahead(iterator, queue_size):
+    """
+    Run iterator in a background thread, yielding its values through a
+    bounded queue - the thread blocks once queue_size values are waiting
+    """
+    values = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def put(value):
+        while not stop.is_set():
+            try:
+                values.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def reader():
+        try:
+            for value in iterator:
+                if not put(value):
+                    return
+        except Exception as ex:
+            put(_Failure(ex))
+        else:
+            put(_DONE)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            value = values.get()
+            if value is _DONE:
+                break
+            if isinstance(value, _Failure):
+                raise value.exception
+            yield value
+    finally:
+        stop.set()
+
+
+def pipeline_versions(
+    versions, convert, imports, parse_workers, queue_size=None, ignore=()
+):
+    """
+    Pipelined equivalent of parse_versions(): git reads happen in a reader
+    thread, parsing happens in a pool of parse_workers processes and the
+    parsed (commit_at, hash, content, items) tuples are yielded in their
+    original commit order to the caller, which does all of the writing.
+
+    At most queue_size blobs are buffered between the reader and the
+    parsers, and at most queue_size parse results are in flight. ignore is
+    passed to compile_convert() in each parser.
+    """
+    queue_size = queue_size or parse_workers * 2
+    in_flight = collections.deque()
+    executor = ProcessPoolExecutor(
+        max_workers=parse_workers,
+        initializer=_init_parse_worker,
+        initargs=(convert, imports, ignore),
+    )
+    try:
+        for git_commit_at, git_hash, content in read_ahead(versions, queue_size):
+            if content.strip():
+                future = executor.submit(_parse, content)
+            else:
+                future = None
+            in_flight.append((git_commit_at, git_hash, content, future))
+            if len(in_flight) >= queue_size:
+                yield _resolve(*in_flight.popleft())
+        while in_flight:
+            yield _resolve(*in_flight.popleft())
+    finally:
+        for *_, future in in_flight:
+            if future is not None:
+                future.cancel()
+        executor.shutdown(wait=True)
+
+
+def _resolve(git_commit_at, git_hash, content, future):
+    items = None
+    if future is not None:
+        try:
+            items = future.result()
+        except Exception:
+            print("\nError in commit: {}".format(git_hash))
+            raise
+    return git_commit_at, git_hash, content, items
@@ -0,0 +1,526 @@
+import json
+import textwrap
+from .compression import Decompressor
+from .utils import RESERVED_SET, parse_timestamp
+
+
+# The commits on the branch whose id in the refs table is :ref
+REF_COMMITS = "select [commit] from ref_commits where ref = :ref"
+
+
+class UnknownRef(Exception):
+    pass
+
+
+def resolve_commit_id(db, namespace, ref, if_earlier=None, end_of_day=True):
+    """
+    Turn a commit hash (or unique prefix of one) or an ISO timestamp into the
+    id of the most recent commit in the commits table at or before that point
+
+    Timestamps without a UTC offset are taken to be in UTC, and a date on its
+    own means the end of that day - or the start, with end_of_day=False.
+    Raises UnknownRef for anything that is neither a known commit nor a
+    timestamp. if_earlier is returned for timestamps before the first commit,
+    instead of raising UnknownRef
+    """
+    matches = [
+        row[0]
+        for row in db.execute(
+            """
+            select commits.id from commits
+            join namespaces on namespaces.id = commits.namespace
+            where namespaces.name = ? and commits.hash like ? || '%'
+            """,
+            [namespace, ref],
+        ).fetchall()
+    ]
+    if len(matches) == 1:
+        return matches[0]
+    elif len(matches) > 1:
+        raise UnknownRef("Commit hash prefix '{}' is ambiguous".format(ref))
+    try:
+        timestamp = parse_timestamp(ref, end_of_day)
+    except ValueError:
+        raise UnknownRef("Unknown commit '{}'".format(ref))
+    # datetime() converts both sides to UTC, so offsets compare correctly
+    commit_id = db.execute(
+        """
+        select max(commits.id) from commits
+        join namespaces on namespaces.id = commits.namespace
+        where namespaces.name = ?
+          and datetime(commits.commit_at) <= datetime(?)
+        """,
+        [namespace, timestamp.isoformat()],
+    ).fetchone()[0]
+    if commit_id is None:
+        if if_earlier is not None:
+            return if_earlier
+        raise UnknownRef(
+            "'{}' is earlier than any commit in '{}'".format(ref, namespace)
+        )
+    return commit_id
+
+
+def resolve_ref_id(db, namespace, ref):
+    """
+    Turn the name of a branch or other ref into the id of its row in the refs
+    table, which is only created by runs of the file command with more than
+    one --branch
+    """
+    row = None
+    if db["refs"].exists():
+        row = db.execute(
+            """
+            select refs.id from refs
+            join namespaces on namespaces.id = refs.namespace
+            where namespaces.name = ? and refs.name = ?
+            """,
+            [namespace, ref],
+        ).fetchone()
+    if row is None:
+        raise UnknownRef("No ref called '{}' in '{}'".format(ref, namespace))
+    return row[0]
+
+
+def _ref_filter(alias, ref_id):
+    "SQL restricting the versions aliased as alias to the commits in :ref"
+    if ref_id is None:
+        return ""
+    return "and {}._commit in ({})".format(alias, REF_COMMITS)
+
+
+def data_columns(db, namespace):
+    "Columns in the version table that came from the original data"
+    return [
+        column
+        for column in db["{}_version".format(namespace)].columns_dict
+        if column not in RESERVED_SET
+    ]
+
+
+def is_full_versions(db, namespace):
+    return "_item_full_hash" not in db["{}_version".format(namespace)].columns_dict
+
+
+def iterate_items_as_of(
+    db, namespace, commit_id, item_ids=None, include_removed=False, ref_id=None
+):
+    """
+    Yield the reconstructed state of every item as of commit_id, ordered by
+    item _id. Each yielded dict has _id, _item_id, _version and _commit keys
+    followed by every data column. Items that had been removed by that
+    commit are skipped.
+
+    In delta mode this replays changes since the most recent keyframe for
+    each item, using a single query ordered by (_item, _version).
+
+    item_ids optionally restricts this to a list of item _id values.
+
+    include_removed=True yields removed items as well, with the values they
+    had when they were removed, and adds a _removed key to every item.
+
+    ref_id restricts this to the versions recorded in commits reachable from
+    that row of the refs table - see resolve_ref_id() - giving the items as
+    they were on that branch.
+    """
+    columns = data_columns(db, namespace)
+    decode = Decompressor(db.conn).decode
+    item_filter = ""
+    params = {"commit": commit_id, "ref": ref_id}
+    if item_ids is not None:
+        item_filter = "and v._item in (select value from json_each(:item_ids))"
+        params["item_ids"] = json.dumps(list(item_ids))
+
+    if is_full_versions(db, namespace):
+        sql = textwrap.dedent(
+            """
+            select {namespace}._item_id, v.* from [{namespace}_version] v
+              join [{namespace}] on {namespace}._id = v._item
+            where v._id in (
+              select v._id from [{namespace}_version] v
+              where v._commit <= :commit {ref_filter} {item_filter}
+              and v._version = (
+                select max(_version) from [{namespace}_version] v2
+                where v2._item = v._item and v2._commit <= :commit {ref_filter2}
+              )
+            )
+            order by v._item
+            """.format(
+                namespace=namespace,
+                item_filter=item_filter,
+                ref_filter=_ref_filter("v", ref_id),
+                ref_filter2=_ref_filter("v2", ref_id),
+            )
+        )
+        for row in db.query(sql, params):
+            if include_removed or not row.get("_removed"):
+                yield _item_state(
+                    row,
+                    {column: decode(row[column]) for column in columns},
+                    include_removed,
+                )
+        return
+
+    column_names = {
+        row[0]: row[1]
+        for row in db.execute(
+            """
+            select columns.id, columns.name from columns
+            join namespaces on namespaces.id = columns.namespace
+            where namespaces.name = ?
+            """,
+            [namespace],
+        ).fetchall()
+    }
+    keyframe_join = ""
+    keyframe_column = "null as _keyframe"
+    version_filter = ""
+    if db["{}_keyframe".format(namespace)].exists():
+        keyframe_join = textwrap.dedent(
+            """
+            left join (
+              select k.item, max(k.version) as version
+              from [{namespace}_keyframe] k
+                join [{namespace}_version] kv on kv._id = k.item_version
+              where kv._commit <= :commit {ref_filter}
+              group by k.item
+            ) latest_keyframe on latest_keyframe.item = v._item
+            left join [{namespace}_keyframe] k on k.item_version = v._id
+            """.format(
+                namespace=namespace, ref_filter=_ref_filter("kv", ref_id)
+            )
+        )
+        keyframe_column = "k.content as _keyframe"
+        version_filter = "and v._version >= coalesce(latest_keyframe.version, 1)"
+    sql = textwrap.dedent(
+        """
+        select
+          {namespace}._item_id,
+          v.*,
+          {keyframe_column},
+          (
+            select group_concat(column) from [{namespace}_changed]
+            where item_version = v._id
+          ) as _changed_ids
+        from [{namespace}_version] v
+          join [{namespace}] on {namespace}._id = v._item
+          {keyframe_join}
+        where v._commit <= :commit {ref_filter} {version_filter} {item_filter}
+        order by v._item, v._version
+        """.format(
+            namespace=namespace,
+            keyframe_column=keyframe_column,
+            keyframe_join=keyframe_join,
+            ref_filter=_ref_filter("v", ref_id),
+            version_filter=version_filter,
+            item_filter=item_filter,
+        )
+    )
+    current_item = None
+    state = None
+    last_row = None
+    for row in db.query(sql, params):
+        if row["_item"] != current_item:
+            if last_row is not None and (
+                include_removed or not last_row.get("_removed")
+            ):
+                yield _item_state(last_row, state, include_removed)
+            current_item = row["_item"]
+            state = {column: None for column in columns}
+        if row["_keyframe"] is not None:
+            state.update(json.loads(row["_keyframe"]))
+        elif row["_changed_ids"]:
+            for column_id in row["_changed_ids"].split(","):
+                column = column_names[int(column_id)]
+                state[column] = decode(row[column])
+        last_row = row
+    if last_row is not None and (include_removed or not last_row.get("_removed")):
+        yield _item_state(last_row, state, include_removed)
+
+
+def diff_commits(db, namespace, commit_a, commit_b, ref_id=None):
+    """
+    Compare every item between two commit ids, returning a dictionary with
+    "added", "changed" and "removed" lists. Changed items include a
+    {column: {"from": ..., "to": ...}} dictionary of their changes.
+
+    Only items with versions recorded in (commit_a, commit_b] are
+    reconstructed, so the cost scales with the number of changes. ref_id
+    compares the items on one branch, as for iterate_items_as_of().
+    """
+    if commit_a > commit_b:
+        raise ValueError("The first commit must be earlier than the second")
+    item_ids = [
+        row[0]
+        for row in db.execute(
+            """
+            select distinct _item from [{}_version] v
+            where _commit > :a and _commit <= :b {}
+            """.format(
+                namespace, _ref_filter("v", ref_id)
+            ),
+            {"a": commit_a, "b": commit_b, "ref": ref_id},
+        ).fetchall()
+    ]
+    before = {
+        item["_id"]: item
+        for item in iterate_items_as_of(
+            db, namespace, commit_a, item_ids, ref_id=ref_id
+        )
+    }
+    added, changed = [], []
+    for after in iterate_items_as_of(db, namespace, commit_b, item_ids, ref_id=ref_id):
+        previous = before.pop(after["_id"], None)
+        if previous is None:
+            added.append(after)
+            continue
+        changes = {
+            column: {"from": previous.get(column), "to": value}
+            for column, value in after.items()
+            if column not in RESERVED_SET and previous.get(column) != value
+        }
+        if changes:
+            changed.append(
+                {
+                    "_id": after["_id"],
+                    "_item_id": after["_item_id"],
+                    "_version": after["_version"],
+                    "changes": changes,
+                }
+            )
+    # Anything left in before had a version in the range but no longer exists
+    removed = list(before.values())
+    return {"added": added, "changed": changed, "removed": removed}
+
+
+def _item_state(row, state, include_removed=False):
+    item = {
+        "_id": row["_item"],
+        "_item_id": row["_item_id"],
+        "_version": row["_version"],
+        "_commit": row["_commit"],
+    }
+    if include_removed:
+        item["_removed"] = bool(row.get("_removed"))
+    item.update(state)
+    return item
+
+
+def as_of_sql(db, namespace, ref=False):
+    """
+    SQL that reconstructs every item as of the commit with id :commit, using
+    indexed lookups rather than a replay - suitable for a Datasette canned query
+
+    ref=True adds a :ref parameter, the id of a row in the refs table, to
+    only use the versions on that branch
+    """
+    ref_filter = _ref_filter("v", True if ref else None)
+    columns = data_columns(db, namespace)
+    full_versions = is_full_versions(db, namespace)
+    selects = [
+        "{}._id".format(namespace),
+        "{}._item_id".format(namespace),
+        "latest._version",
+        "latest._commit",
+    ]
+    for column in columns:
+        if full_versions:
+            selects.append("latest.[{}]".format(column))
+        else:
+            selects.append(
+                textwrap.dedent(
+                    """
+                    (
+                        select v.[{column}] from [{namespace}_version] v
+                          join [{namespace}_changed] c on c.item_version = v._id
+                          join columns on columns.id = c.column
+                        where v._item = {namespace}._id and v._commit <= :commit
+                          and columns.name = '{quoted}' {ref_filter}
+                        order by v._version desc limit 1
+                      ) as [{column}]"""
+                )
+                .strip()
+                .format(
+                    namespace=namespace,
+                    column=column,
+                    quoted=column.replace("'", "''"),
+                    ref_filter=ref_filter,
+                )
+            )
+    removed_filter = ""
+    if "_removed" in db["{}_version".format(namespace)].columns_dict:
+        removed_filter = "\n  and latest._removed is null"
+    return (
+        textwrap.dedent(
+            """
+        select
+          {selects}
+        from [{namespace}]
+          join [{namespace}_version] latest on latest._item = {namespace}._id
+        where latest._version = (
+          select max(_version) from [{namespace}_version] v
+          where v._item = {namespace}._id and v._commit <= :commit {ref_filter}
+        ){removed_filter}
+        order by {namespace}._id
+        """
+        )
+        .strip()
+        .format(
+            namespace=namespace,
+            selects=",\n  ".join(selects),
+            ref_filter=ref_filter,
+            removed_filter=removed_filter,
+        )
+    )
+
+
+def iterate_items(db, namespace, since_id=0, until_id=None, batch_size=1000):
+    """
+    Yield every row of the item table, optionally just those last changed in
+    the commit range (since_id, until_id]. Uses keyset pagination on rowid,
+    so at most batch_size rows are held in memory at a time.
+    """
+    decode = Decompressor(db.conn).decode
+    where = ["rowid > :key"]
+    params = {"key": 0, "limit": batch_size}
+    if since_id:
+        where.append("_commit > :since")
+        params["since"] = since_id
+    if until_id is not None:
+        where.append("_commit <= :until")
+        params["until"] = until_id
+    sql = "select rowid as [__key], * from [{}] where {} order by rowid limit :limit".format(
+        namespace, " and ".join(where)
+    )
+    while True:
+        rows = list(db.query(sql, params))
+        for row in rows:
+            params["key"] = row.pop("__key")
+            yield {key: decode(value) for key, value in row.items()}
+        if len(rows) < batch_size:
+            return
+
+
+def version_columns(db, namespace):
+    "Column names of the rows yielded by iterate_versions(), in order"
+    version_columns = db["{}_version".format(namespace)].columns_dict
+    columns = ["_id", "_item", "_item_id", "_version", "_commit", "_commit_at"]
+    columns += ["_commit_hash"] + data_columns(db, namespace)
+    if "_removed" in version_columns:
+        columns.append("_removed")
+    if not is_full_versions(db, namespace):
+        columns.append("_changed_columns")
+    return columns
+
+
+def iterate_versions(
+    db, namespace, since_id=0, until_id=None, full=False, batch_size=1000, ref_id=None
+):
+    """
+    Yield every row of the version table with its _item_id, _commit_at and
+    _commit_hash, optionally restricted to commits in (since_id, until_id]
+    and to the commits on one branch, as for iterate_items_as_of().
+
+    In delta mode each row has a _changed_columns list, and the other data
+    columns are None unless full=True, in which case each item is replayed
+    so every row has the complete state of the item at that version.
+
+    Uses keyset pagination - on _id, or on (_item, _version) for full=True
+    so that only one item is replayed at a time - holding at most
+    batch_size rows in memory.
+    """
+    decode = Decompressor(db.conn).decode
+    columns = version_columns(db, namespace)
+    data = data_columns(db, namespace)
+    full = full and not is_full_versions(db, namespace)
+    column_names = {}
+    changed_ids = "null"
+    if not is_full_versions(db, namespace):
+        column_names = {
+            row[0]: row[1]
+            for row in db.execute(
+                """
+                select columns.id, columns.name from columns
+                join namespaces on namespaces.id = columns.namespace
+                where namespaces.name = ?
+                """,
+                [namespace],
+            ).fetchall()
+        }
+        if db["{}_changed".format(namespace)].exists():
+            changed_ids = (
+                "(select group_concat(column) from [{}_changed] "
+                "where item_version = v._id)".format(namespace)
+            )
+    where = []
+    params = {"limit": batch_size}
+    if ref_id is not None:
+        where.append("v._commit in ({})".format(REF_COMMITS))
+        params["ref"] = ref_id
+    if since_id and not full:
+        # Replays need the earlier versions, so those are filtered out below
+        where.append("v._commit > :since")
+        params["since"] = since_id
+    if until_id is not None:
+        where.append("v._commit <= :until")
+        params["until"] = until_id
+    if full:
+        where.append("(v._item, v._version) > (:item, :version)")
+        params.update({"item": 0, "version": 0})
+        order_by = "v._item, v._version"
+    else:
+        where.append("v._id > :key")
+        params["key"] = 0
+        order_by = "v._id"
+    sql = textwrap.dedent(
+        """
+        select
+          v.*,
+          {namespace}._item_id,
+          commits.commit_at as _commit_at,
+          commits.hash as _commit_hash,
+          {changed_ids} as __changed_ids
+        from [{namespace}_version] v
+          join [{namespace}] on {namespace}._id = v._item
+          join commits on commits.id = v._commit
+        where {where}
+        order by {order_by}
+        limit :limit
+        """.format(
+            namespace=namespace,
+            changed_ids=changed_ids,
+            where=" and ".join(where),
+            order_by=order_by,
+        )
+    )
+    current_item = None
+    state = None
+    while True:
+        rows = list(db.query(sql, params))
+        for row in rows:
+            if full:
+                params["item"], params["version"] = row["_item"], row["_version"]
+            else:
+                params["key"] = row["_id"]
+            changed = [
+                column_names[int(column_id)]
+                for column_id in (row["__changed_ids"] or "").split(",")
+                if column_id
+            ]
+            if full:
+                if row["_item"] != current_item:
+                    current_item = row["_item"]
+                    state = {column: None for column in data}
+                for column in changed:
+                    state[column] = decode(row[column])
+                if row["_commit"] <= since_id:
+                    continue
+                values = dict(row, **state)
+            else:
+                values = {column: decode(row[column]) for column in data}
+                values = dict(row, **values)
+            if "_changed_columns" in columns:
+                values["_changed_columns"] = sorted(changed)
+            yield {column: values.get(column) for column in columns}
+        if len(rows) < batch_size:
+            return
@@ -0,0 +1,191 @@
+import multiprocessing
+import sqlite3
+import traceback
+from .compression import Decompressor
+from .utils import compute_delta, jsonify_all
+
+
+def shard_for_item_id(item_id, shard_count):
+    # item_id is a hex SHA-1, so its leading bytes are already uniformly distributed
+    return int(item_id[:8], 16) % shard_count
+
+
+def shard_sql(column, shard_count):
+    """
+    SQL equivalent of shard_for_item_id() for a column of item_ids, so rows
+    can be filtered by shard inside SQLite
+    """
+    digits = " + ".join(
+        "(instr('0123456789abcdef', substr({}, {}, 1)) - 1) * {}".format(
+            column, position + 1, 16 ** (7 - position)
+        )
+        for position in range(8)
+    )
+    return "({}) % {}".format(digits, shard_count)
+
+
+class ShardState:
+    """
+    Per-shard diffing state: the most recent stored row for every item that
+    belongs to this shard, or nothing with full_versions. Across all the
+    shards this is a copy of the whole item table.
+    """
+
+    def __init__(self, previous_items, full_versions):
+        self.previous_items = previous_items
+        self.full_versions = full_versions
+
+    @classmethod
+    def load(cls, database, item_table, shard, shard_count, full_versions):
+        previous_items = {}
+        if full_versions:
+            return cls(previous_items, full_versions)
+        conn = sqlite3.connect(database)
+        conn.row_factory = sqlite3.Row
+        try:
+            table_exists = conn.execute(
+                "select 1 from sqlite_master where type = 'table' and name = ?",
+                [item_table],
+            ).fetchone()
+            if table_exists:
+                decompressor = Decompressor(conn)
+                for row in conn.execute(
+                    "select * from [{}] where {} = ?".format(
+                        item_table, shard_sql("_item_id", shard_count)
+                    ),
+                    [shard],
+                ):
+                    previous_items[row["_item_id"]] = decompressor.decode_row(dict(row))
+        finally:
+            conn.close()
+        return cls(previous_items, full_versions)
+
+    def diff(self, batch):
+        """
+        batch is a list of (index, item_id, item, is_new) tuples for items
+        that are new or whose full hash has changed. Returns a list of
+        (index, item_flattened, updated_values) for each of them.
+        """
+        changes = []
+        for index, item_id, item, item_is_new in batch:
+            item_flattened = jsonify_all(item)
+            updated_values = None
+            if not self.full_versions:
+                previous_item = self.previous_items.get(item_id)
+                updated_values = compute_delta(
+                    item_flattened, None if item_is_new else previous_item
+                )
+                # The item table row is updated rather than replaced, so
+                # columns missing from this version keep their previous values
+                self.previous_items[item_id] = dict(
+                    previous_item or {}, **item_flattened
+                )
+            changes.append((index, item_flattened, updated_values))
+        return changes
+
+
+def _shard_worker(inbox, outbox, load_args):
+    try:
+        state = ShardState.load(*load_args)
+    except Exception:
+        outbox.put(("error", traceback.format_exc()))
+        return
+    outbox.put(("ready", None))
+    for batch in iter(inbox.get, None):
+        try:
+            outbox.put(("ok", state.diff(batch)))
+        except Exception:
+            outbox.put(("error", traceback.format_exc()))
+
+
+class ShardError(Exception):
+    pass
+
+
+class ShardPool:
+    """
+    Partitions items by _item_id into shard_count worker processes, each of
+    which holds the diffing state for its own shard.
+
+    The caller compares full hashes itself, so only new and changed items
+    are sent to the workers. Results are merged back into their original
+    order so the caller can assign _id and _version values exactly as the
+    single-process loop would.
+    """
+
+    def __init__(self, shard_count, database, item_table, full_versions):
+        self.shard_count = shard_count
+        self.inboxes = []
+        self.outboxes = []
+        self.processes = []
+        for shard in range(shard_count):
+            inbox = multiprocessing.Queue()
+            outbox = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=_shard_worker,
+                args=(
+                    inbox,
+                    outbox,
+                    (database, item_table, shard, shard_count, full_versions),
+                ),
+                daemon=True,
+            )
+            process.start()
+            self.inboxes.append(inbox)
+            self.outboxes.append(outbox)
+            self.processes.append(process)
+        for outbox in self.outboxes:
+            self._receive(outbox)
+
+    def _receive(self, outbox):
+        status, payload = outbox.get()
+        if status == "error":
+            self.close()
+            raise ShardError(payload)
+        return payload
+
+    def diff(self, changed_items):
+        """
+        changed_items is a list of (item_id, item, item_full_hash, is_new) for
+        the items that are new or have changed. Returns (item_id,
+        item_full_hash, item_flattened, updated_values, is_new) for each of
+        them, in the same order.
+        """
+        changed_items = list(changed_items)
+        batches = [[] for _ in range(self.shard_count)]
+        for index, (item_id, item, _, item_is_new) in enumerate(changed_items):
+            batches[shard_for_item_id(item_id, self.shard_count)].append(
+                (index, item_id, item, item_is_new)
+            )
+        # Workers with nothing to do are left alone
+        busy = [shard for shard, batch in enumerate(batches) if batch]
+        for shard in busy:
+            self.inboxes[shard].put(batches[shard])
+        results = [None] * len(changed_items)
+        for shard in busy:
+            for index, item_flattened, updated_values in self._receive(
+                self.outboxes[shard]
+            ):
+                results[index] = (item_flattened, updated_values)
+        return [
+            (item_id, item_full_hash, item_flattened, updated_values, item_is_new)
+            for (item_id, _, item_full_hash, item_is_new), (
+                item_flattened,
+                updated_values,
+            ) in zip(changed_items, results)
+        ]
+
+    def close(self):
+        for inbox, process in zip(self.inboxes, self.processes):
+            if process.is_alive():
+                inbox.put(None)
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,1107 @@
+import collections
+import json
+import textwrap
+from .compression import Compressor, Decompressor, ValueInterner, load_dictionary
+from .utils import RESERVED_SET
+
+
+class Sink:
+    """
+    Receives the items and versions produced by an Ingestor.
+
+    For each commit the Ingestor calls start_commit(), then either
+    add_items() (when no ids were specified) or any number of add_version()
+    and remove_item() calls, then end_commit(). close() is called once
+    everything has been ingested.
+    """
+
+    def open(self, ingestor):
+        "Called once by the Ingestor that will be writing to this sink"
+        self.track_removals = ingestor.track_removals
+
+    def seen_commits(self):
+        "Hashes of commits that have already been ingested"
+        return set()
+
+    def add_commit_metadata(self, commits):
+        """
+        Called with dictionaries of metadata for commits that are about to
+        be ingested - see git_history.cli.log_commits()
+        """
+        pass
+
+    def load_state(self):
+        "Returns ({item_id: latest version}, {item_id: last full hash})"
+        return {}, {}
+
+    def live_item_ids(self):
+        "item_ids of the items that are present as of the last commit"
+        return set()
+
+    def load_ref_states(self, refs):
+        """
+        Returns {ref: {item_id: (full hash, item, live)}} with the state on
+        each of refs of the items whose state there is not their latest
+        version - see the refs argument of Ingestor
+        """
+        return {}
+
+    def get_item(self, item_id):
+        "The current flattened state of an item, used to calculate deltas"
+        return None
+
+    def record_debug(self, item_full_hash, item):
+        pass
+
+    def start_commit(self, commit_hash, commit_at):
+        raise NotImplementedError
+
+    def add_items(self, items):
+        raise NotImplementedError
+
+    def add_version(
+        self, item_id, version, item_flattened, updated_values, item_full_hash
+    ):
+        """
+        Record a new version of an item. updated_values is the dictionary of
+        columns that changed, or None in full versions mode.
+        """
+        raise NotImplementedError
+
+    def remove_item(self, item_id, version):
+        raise NotImplementedError
+
+    def record_commit_stats(self, seen, new, changed, unchanged, removed):
+        "Called with the number of items in each state before end_commit()"
+        pass
+
+    def record_refs(self, refs):
+        """
+        Called after ingesting from several refs with {ref: (hash the ref
+        points to, set of hashes of the commits reachable from it)}
+        """
+        pass
+
+    def end_commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteSink(Sink):
+    """
+    Writes to the tables described in the README. db can be a sqlite_utils
+    Database or a path to a database file.
+
+    fts_columns maintains an FTS5 index on those columns of the item table,
+    and fts_versions=True maintains one on the version table too.
+
+    commit_stats=True records the number of items seen, new, changed,
+    unchanged and removed in each commit in a {namespace}_commit_stats
+    table, and how many times each column changed in
+    {namespace}_commit_column_stats.
+    """
+
+    def __init__(
+        self,
+        db,
+        namespace="item",
+        keyframes=None,
+        store_changed_columns=False,
+        compress=None,
+        compress_threshold=1024,
+        compress_dictionary=False,
+        intern_values=False,
+        intern_threshold=1024,
+        fts_columns=(),
+        fts_versions=False,
+        commit_stats=False,
+    ):
+        import sqlite_utils
+        from .writer import BatchWriter
+
+        if not isinstance(db, sqlite_utils.Database):
+            db = sqlite_utils.Database(db)
+        self.db = db
+        self.namespace = namespace
+        self.keyframes = keyframes
+        self.track_removals = False
+        self.namespace_id = db["namespaces"].lookup({"name": namespace})
+        self.item_table = namespace
+        self.version_table = "{}_version".format(namespace)
+        self.changed_table = "{}_changed".format(namespace)
+        self.keyframe_table = "{}_keyframe".format(namespace)
+        self.commit_stats_table = "{}_commit_stats".format(namespace)
+        self.commit_column_stats_table = "{}_commit_column_stats".format(namespace)
+        self.commit_stats = commit_stats
+
+        # Columns and commits are loaded once, then new ones are added to
+        # these as they are written
+        self.column_name_to_id = {}
+        if db["columns"].exists():
+            self.column_name_to_id = dict(
+                db.execute(
+                    "select name, id from columns where namespace = ?",
+                    [self.namespace_id],
+                )
+            )
+        create_commits_table(db)
+        self.commit_hash_to_id = dict(
+            db.execute(
+                "select hash, id from commits where namespace = ?", [self.namespace_id]
+            )
+        )
+        self.commit_metadata = {}
+
+        version_table = self.version_table
+        if db[version_table].exists() and (
+            "_changed_columns" in db[version_table].columns_dict
+        ):
+            # Keep materializing if a previous run started doing so
+            store_changed_columns = True
+        elif store_changed_columns and db[version_table].exists():
+            backfill_changed_columns(db, namespace)
+        self.store_changed_columns = store_changed_columns
+
+        compressor = None
+        if compress:
+            dictionary, dictionary_id = load_dictionary(db, self.namespace_id)
+            compressor = Compressor(
+                compress,
+                compress_threshold,
+                dictionary=dictionary,
+                dictionary_id=dictionary_id,
+                train_dictionary=compress_dictionary,
+                save_dictionary=self._save_dictionary,
+            )
+
+        encode_value = compressor.encode if compressor else None
+        if intern_values:
+            encode_value = ValueInterner(db, intern_threshold, encode_value).encode
+
+        self.writer = BatchWriter(
+            db, self.item_table, version_table, encode_value=encode_value
+        )
+        self.decompressor = Decompressor(db.conn)
+
+        self.item_fts = self.version_fts = None
+        if fts_columns:
+            decode = self.decompressor.decode
+            self.item_fts = FtsIndex(db, self.item_table, fts_columns, decode)
+            if fts_versions:
+                self.version_fts = FtsIndex(db, version_table, fts_columns, decode)
+
+    @property
+    def path(self):
+        "Filename of the database, used by shard worker processes"
+        return self.db.execute("pragma database_list").fetchone()[2]
+
+    def _save_dictionary(self, dictionary):
+        # Called while a commit is being written, so this must not commit
+        if not self.db["compression_dictionaries"].exists():
+            self.db.create_table(
+                "compression_dictionaries",
+                {"id": int, "namespace": int, "dictionary": bytes},
+                pk="id",
+                foreign_keys=(("namespace", "namespaces", "id"),),
+            )
+        return self.db.execute(
+            "insert into compression_dictionaries (namespace, dictionary) values (?, ?)",
+            [self.namespace_id, dictionary],
+        ).lastrowid
+
+    def column_id(self, column):
+        if column not in self.column_name_to_id:
+            id = self.db["columns"].lookup(
+                {"namespace": self.namespace_id, "name": column},
+                foreign_keys=(("namespace", "namespaces", "id"),),
+            )
+            self.column_name_to_id[column] = id
+        return self.column_name_to_id[column]
+
+    def seen_commits(self):
+        return set(self.commit_hash_to_id)
+
+    def add_commit_metadata(self, commits):
+        self.commit_metadata.update(
+            (commit["hash"], commit)
+            for commit in commits
+            if commit["hash"] not in self.commit_hash_to_id
+        )
+
+    def load_state(self):
+        return get_versions_and_hashes(self.db, self.namespace)
+
+    def live_item_ids(self):
+        columns = self.db[self.item_table].columns_dict
+        if "_item_id" not in columns:
+            return set()
+        where = ""
+        if "_removed" in columns:
+            where = "where not coalesce(_removed, 0)"
+        return {
+            row[0]
+            for row in self.db.execute(
+                "select _item_id from [{}] {}".format(self.item_table, where)
+            )
+        }
+
+    def load_ref_states(self, refs):
+        from .query import REF_COMMITS, UnknownRef, iterate_items_as_of, resolve_ref_id
+
+        db = self.db
+        if not db[self.version_table].exists():
+            return {}
+        last_commit = max(self.commit_hash_to_id.values(), default=0)
+        full_versions = "_item_full_hash" not in db[self.version_table].columns_dict
+        ref_states = {}
+        for ref in refs:
+            try:
+                ref_id = resolve_ref_id(db, self.namespace, ref)
+            except UnknownRef:
+                # Not recorded by an earlier run, so it follows the latest versions
+                continue
+            states = ref_states[ref] = {}
+            diverged = {}
+            for item_pk, item_id, version, full_hash in db.execute(
+                """
+                select i._id, i._item_id, on_ref._version, on_ref.{full_hash}
+                from [{item_table}] i
+                  left join [{version_table}] on_ref on on_ref._id = (
+                    select _id from [{version_table}] v
+                    where v._item = i._id and v._commit in ({ref_commits})
+                    order by v._version desc limit 1
+                  )
+                where on_ref._version is null or on_ref._version < (
+                  select max(_version) from [{version_table}] where _item = i._id
+                )
+                """.format(
+                    full_hash="null" if full_versions else "_item_full_hash",
+                    item_table=self.item_table,
+                    version_table=self.version_table,
+                    ref_commits=REF_COMMITS,
+                ),
+                {"ref": ref_id},
+            ):
+                if version is None:
+                    # Never on this ref
+                    states[item_id] = (None, None, False)
+                else:
+                    # Full versions do not store the hash, so these items
+                    # count as changed the next time they are seen
+                    diverged[item_pk] = full_hash
+            for item in iterate_items_as_of(
+                db,
+                self.namespace,
+                last_commit,
+                list(diverged),
+                include_removed=True,
+                ref_id=ref_id,
+            ):
+                states[item["_item_id"]] = (
+                    diverged[item["_id"]],
+                    item,
+                    not item["_removed"],
+                )
+        return ref_states
+
+    def get_item(self, item_id):
+        item = get_item(self.db, self.item_table, item_id)
+        if item is not None:
+            item = self.decompressor.decode_row(item)
+        return item
+
+    def record_debug(self, item_full_hash, item):
+        self.db["debug"].insert(
+            {
+                "hash": item_full_hash,
+                "content": json.dumps(item, default=repr, sort_keys=True),
+            },
+            pk="hash",
+            replace=True,
+        )
+
+    def start_commit(self, commit_hash, commit_at):
+        self.commit_pk = self.commit_hash_to_id.get(commit_hash)
+        if self.commit_pk is None:
+            # Written by the BatchWriter along with the rest of the commit
+            row = {
+                "namespace": self.namespace_id,
+                "hash": commit_hash,
+                "commit_at": commit_at.isoformat(),
+            }
+            metadata = self.commit_metadata.pop(commit_hash, None)
+            if metadata:
+                row["parents"] = json.dumps(metadata["parents"])
+                row.update(
+                    (column, metadata[column]) for column in COMMIT_METADATA_COLUMNS
+                )
+            self.commit_pk = self.writer.add_commit(row)
+            self.commit_hash_to_id[commit_hash] = self.commit_pk
+        self.changed_rows = []
+        self.fts_new_items = {}
+        self.fts_changed_items = {}
+        self.fts_version_rows = {}
+        self.keyframe_rows = []
+        self.stats = None
+
+    def add_items(self, items):
+        # No ids - so just populate item_table and add item["_commit"]
+        self.writer.add_rows(
+            self.item_table,
+            (dict(item, _commit=self.commit_pk) for item in items),
+            column_order=("_id",),
+            foreign_keys=(("_commit", "commits", "id"),),
+        )
+
+    def add_version(
+        self, item_id, version, item_flattened, updated_values, item_full_hash
+    ):
+        # Add or update item
+        item_pk = self.writer.item_pk(item_id)
+        item_row = dict(item_flattened, _commit=self.commit_pk)
+        if self.track_removals:
+            item_row["_removed"] = 0
+        self.writer.update_item(item_pk, item_row)
+        if self.item_fts:
+            # Updates only change the columns present in this version
+            fts_values = {
+                column: item_flattened[column]
+                for column in self.item_fts.columns
+                if column in item_flattened
+            }
+            if item_pk in self.writer.new_items:
+                self.fts_new_items.setdefault(item_pk, {}).update(fts_values)
+            else:
+                self.fts_changed_items.setdefault(item_pk, {}).update(fts_values)
+
+        if updated_values is None:
+            # Record full copies in item_version
+            item_version = dict(
+                item_flattened,
+                _item=item_pk,
+                _version=version,
+                _commit=self.commit_pk,
+            )
+        else:
+            # Only record the columns that have changed
+            item_version = dict(
+                updated_values,
+                _item=item_pk,
+                _version=version,
+                _commit=self.commit_pk,
+                _item_full_hash=item_full_hash,
+            )
+
+        if self.store_changed_columns:
+            # Compact separators match SQLite's json_group_array()
+            item_version["_changed_columns"] = json.dumps(
+                sorted(updated_values or ()), separators=(",", ":")
+            )
+
+        item_version_id = self.writer.add_version(item_version)
+        if self.version_fts:
+            self.fts_version_rows[item_version_id] = item_version
+
+        if updated_values:
+            # Record which columns changed in the changed m2m table
+            self.changed_rows.extend(
+                (item_version_id, column) for column in updated_values
+            )
+
+        if self.keyframes and version % self.keyframes == 0:
+            # Store a full copy to bound the cost of as-of replays
+            self.keyframe_rows.append(
+                {
+                    "item_version": item_version_id,
+                    "item": item_pk,
+                    "version": version,
+                    "content": json.dumps(item_flattened, default=repr, sort_keys=True),
+                }
+            )
+
+    def remove_item(self, item_id, version):
+        item_pk = self.writer.item_pk(item_id)
+        tombstone = {
+            "_item": item_pk,
+            "_version": version,
+            "_commit": self.commit_pk,
+            "_removed": 1,
+        }
+        if self.store_changed_columns:
+            tombstone["_changed_columns"] = "[]"
+        self.writer.add_version(tombstone)
+        self.writer.update_item(item_pk, {"_commit": self.commit_pk, "_removed": 1})
+
+    def record_commit_stats(self, seen, new, changed, unchanged, removed):
+        if self.commit_stats:
+            self.stats = {
+                "commit": self.commit_pk,
+                "seen": seen,
+                "new": new,
+                "changed": changed,
+                "unchanged": unchanged,
+                "removed": removed,
+            }
+
+    def rollback(self, commit_hashes):
+        """
+        Delete everything recorded for these commits, which must be the most
+        recently ingested ones, and restore every item they changed to its
+        state as of the commit before them - used when history is rewritten
+        """
+        from .query import iterate_items_as_of
+
+        db = self.db
+        commit_ids = sorted(
+            self.commit_hash_to_id.pop(commit_hash)
+            for commit_hash in commit_hashes
+            if commit_hash in self.commit_hash_to_id
+        )
+        if not commit_ids:
+            return
+        previous_commit = max(self.commit_hash_to_id.values(), default=0)
+        commit_ids_json = json.dumps(commit_ids)
+        in_commits = "in (select value from json_each(?))"
+        item_columns = db[self.item_table].columns_dict
+        if "_item_id" not in item_columns:
+            # Without ids each commit has its own rows in the item table
+            with db.conn:
+                db.execute(
+                    "delete from [{}] where _commit {}".format(
+                        self.item_table, in_commits
+                    ),
+                    [commit_ids_json],
+                )
+        elif db[self.version_table].exists():
+            versions = [
+                row[0]
+                for row in db.execute(
+                    "select _id from [{}] where _commit {}".format(
+                        self.version_table, in_commits
+                    ),
+                    [commit_ids_json],
+                )
+            ]
+            affected = {
+                row[0]: row[1]
+                for row in db.execute(
+                    """
+                    select _id, _item_id from [{}] where _id in (
+                      select _item from [{}] where _commit {}
+                    )
+                    """.format(
+                        self.item_table, self.version_table, in_commits
+                    ),
+                    [commit_ids_json],
+                )
+            }
+            restored = {
+                item["_id"]: item
+                for item in iterate_items_as_of(
+                    db,
+                    self.namespace,
+                    previous_commit,
+                    list(affected),
+                    include_removed=True,
+                )
+            }
+            item_fts, version_fts = self._existing_fts_indexes()
+            previous_item_fts = item_fts.current_values(affected) if item_fts else {}
+            previous_version_fts = (
+                version_fts.current_values(versions) if version_fts else {}
+            )
+            versions_json = json.dumps(versions)
+            deleted_items = [pk for pk in affected if pk not in restored]
+            with db.conn:
+                for table in (self.changed_table, self.keyframe_table):
+                    if db[table].exists():
+                        db.execute(
+                            "delete from [{}] where item_version in (select value from json_each(?))".format(
+                                table
+                            ),
+                            [versions_json],
+                        )
+                db.execute(
+                    "delete from [{}] where _commit {}".format(
+                        self.version_table, in_commits
+                    ),
+                    [commit_ids_json],
+                )
+                db.execute(
+                    "delete from [{}] where _id in (select value from json_each(?))".format(
+                        self.item_table
+                    ),
+                    [json.dumps(deleted_items)],
+                )
+            for pk in deleted_items:
+                # So the item gets a new row if it is seen again
+                self.writer.item_id_to_pk.pop(affected[pk], None)
+            for pk, item in restored.items():
+                row = {
+                    column: value
+                    for column, value in item.items()
+                    if column in item_columns and column not in RESERVED_SET
+                }
+                row["_commit"] = item["_commit"]
+                if "_removed" in item_columns:
+                    row["_removed"] = int(item["_removed"])
+                self.writer.update_item(pk, row)
+
+            def update_fts():
+                if item_fts:
+                    item_fts.replace(
+                        previous_item_fts,
+                        {
+                            pk: {
+                                column: item.get(column) for column in item_fts.columns
+                            }
+                            for pk, item in restored.items()
+                        },
+                    )
+                if version_fts:
+                    version_fts.replace(previous_version_fts, {})
+
+            self.writer.flush(after=update_fts)
+        with db.conn:
+            for table, column in (
+                (self.commit_stats_table, "commit"),
+                (self.commit_column_stats_table, "commit"),
+                ("ref_commits", "commit"),
+                ("commits", "id"),
+            ):
+                if db[table].exists():
+                    db.execute(
+                        "delete from [{}] where [{}] {}".format(
+                            table, column, in_commits
+                        ),
+                        [commit_ids_json],
+                    )
+
+    def _existing_fts_indexes(self):
+        "FtsIndex objects for the item and version tables, if they are indexed"
+        indexes = []
+        for index, table in (
+            (self.item_fts, self.item_table),
+            (self.version_fts, self.version_table),
+        ):
+            fts_table = "{}_fts".format(table)
+            if index is None and self.db[fts_table].exists():
+                columns = [column.name for column in self.db[fts_table].columns]
+                index = FtsIndex(self.db, table, columns, self.decompressor.decode)
+            indexes.append(index)
+        return indexes
+
+    def record_refs(self, refs):
+        db = self.db
+        if not db["refs"].exists():
+            db["refs"].create(
+                {"id": int, "namespace": int, "name": str, "hash": str},
+                pk="id",
+                foreign_keys=(("namespace", "namespaces", "id"),),
+            )
+            db["refs"].create_index(["namespace", "name"], unique=True)
+            db["ref_commits"].create(
+                {"ref": int, "commit": int},
+                pk=("ref", "commit"),
+                foreign_keys=(("ref", "refs", "id"), ("commit", "commits", "id")),
+            )
+        with db.conn:
+            for name, (ref_hash, commit_hashes) in refs.items():
+                ref_id = db["refs"].lookup(
+                    {"namespace": self.namespace_id, "name": name}
+                )
+                db.execute("update refs set hash = ? where id = ?", [ref_hash, ref_id])
+                # The ref may have been moved or rewritten since the last run
+                db.execute("delete from ref_commits where ref = ?", [ref_id])
+                db.conn.executemany(
+                    "insert into ref_commits (ref, [commit]) values (?, ?)",
+                    [
+                        (ref_id, commit_id)
+                        for commit_id in sorted(
+                            self.commit_hash_to_id[commit_hash]
+                            for commit_hash in commit_hashes
+                            if commit_hash in self.commit_hash_to_id
+                        )
+                    ],
+                )
+
+    def end_commit(self):
+        previous_fts_values = {}
+        if self.fts_changed_items:
+            # Read the indexed values before the item rows are overwritten
+            previous_fts_values = self.item_fts.current_values(self.fts_changed_items)
+        self.writer.add_rows(
+            self.changed_table,
+            (
+                {"item_version": item_version_id, "column": self.column_id(column)}
+                for item_version_id, column in self.changed_rows
+            ),
+            pk=("item_version", "column"),
+            foreign_keys=(
+                ("item_version", self.version_table, "_id"),
+                ("column", "columns", "id"),
+            ),
+        )
+        self.writer.add_rows(
+            self.keyframe_table,
+            self.keyframe_rows,
+            pk="item_version",
+            foreign_keys=(
+                ("item_version", self.version_table, "_id"),
+                ("item", self.item_table, "_id"),
+            ),
+        )
+        if self.stats:
+            self._add_commit_stats()
+
+        def update_fts():
+            if self.fts_new_items or self.fts_changed_items:
+                new_fts_values = dict(self.fts_new_items)
+                for pk, values in self.fts_changed_items.items():
+                    new_fts_values[pk] = dict(previous_fts_values.get(pk, {}), **values)
+                self.item_fts.replace(previous_fts_values, new_fts_values)
+            if self.fts_version_rows:
+                self.version_fts.replace({}, self.fts_version_rows)
+
+        renumbered = self.writer.flush(after=update_fts)
+        if renumbered:
+            # Another run added commits to the database in the meantime
+            for commit_hash, commit_pk in self.commit_hash_to_id.items():
+                if commit_pk in renumbered:
+                    self.commit_hash_to_id[commit_hash] = renumbered[commit_pk]
+            self.commit_pk = renumbered.get(self.commit_pk, self.commit_pk)
+
+    def _add_commit_stats(self):
+        # replace=True so that re-processing a commit does not fail
+        self.writer.add_rows(
+            self.commit_stats_table,
+            [self.stats],
+            replace=True,
+            pk="commit",
+            foreign_keys=(("commit", "commits", "id"),),
+        )
+        column_changes = collections.Counter(column for _, column in self.changed_rows)
+        self.writer.add_rows(
+            self.commit_column_stats_table,
+            (
+                {
+                    "commit": self.commit_pk,
+                    "column": self.column_id(column),
+                    "changes": changes,
+                }
+                for column, changes in sorted(column_changes.items())
+            ),
+            replace=True,
+            pk=("commit", "column"),
+            foreign_keys=(("commit", "commits", "id"), ("column", "columns", "id")),
+        )
+
+    def close(self):
+        db = self.db
+        # Create any necessary views
+        create_views(db, self.namespace)
+        # ... and indexes
+        if db[self.version_table].exists():
+            # Also serves lookups on _item alone
+            db[self.version_table].create_index(
+                ["_item", "_version"], if_not_exists=True
+            )
+            # Used by diff to find versions in a commit range, and to replay them
+            db[self.version_table].create_index(
+                ["_commit", "_item", "_version"], if_not_exists=True
+            )
+        if db[self.keyframe_table].exists():
+            db[self.keyframe_table].create_index(
+                ["item", "version"], if_not_exists=True
+            )
+
+
+class MemorySink(Sink):
+    """
+    Keeps everything in memory, for tests and for callers that want to
+    process the changes themselves.
+
+    commits is a list of (commit_hash, commit_at) tuples. Without ids, rows
+    is a list of every item with a _commit hash. With ids, items maps each
+    item_id to its current state and versions is a list of dictionaries
+    with _item_id, _version, _commit and _item_full_hash keys plus the
+    changed columns - or every column in full versions mode. Removals are
+    recorded as versions with "_removed": True. commit_stats maps each commit
+    hash to the counts passed to record_commit_stats(), and refs is what was
+    passed to record_refs().
+    """
+
+    def __init__(self):
+        self.commits = []
+        self.rows = []
+        self.items = {}
+        self.versions = []
+        self.item_id_to_version = {}
+        self.item_id_to_last_full_hash = {}
+        self.removed = set()
+        self.commit_stats = {}
+        self.refs = {}
+
+    def seen_commits(self):
+        return {commit_hash for commit_hash, _ in self.commits}
+
+    def load_state(self):
+        return dict(self.item_id_to_version), dict(self.item_id_to_last_full_hash)
+
+    def live_item_ids(self):
+        return set(self.items) - self.removed
+
+    def get_item(self, item_id):
+        return self.items.get(item_id)
+
+    def start_commit(self, commit_hash, commit_at):
+        self.commit = (commit_hash, commit_at)
+        self.commits.append(self.commit)
+
+    def add_items(self, items):
+        for item in items:
+            self.store_row(dict(item, _commit=self.commit[0]))
+
+    def add_version(
+        self, item_id, version, item_flattened, updated_values, item_full_hash
+    ):
+        # Columns missing from this version keep their previous values
+        self.items[item_id] = dict(self.items.get(item_id) or {}, **item_flattened)
+        self.removed.discard(item_id)
+        self.item_id_to_version[item_id] = version
+        self.item_id_to_last_full_hash[item_id] = item_full_hash
+        self.store_version(
+            dict(
+                item_flattened if updated_values is None else updated_values,
+                _item_id=item_id,
+                _version=version,
+                _commit=self.commit[0],
+                _item_full_hash=item_full_hash,
+            )
+        )
+
+    def remove_item(self, item_id, version):
+        self.removed.add(item_id)
+        self.item_id_to_version[item_id] = version
+        self.item_id_to_last_full_hash[item_id] = None
+        self.store_version(
+            {
+                "_item_id": item_id,
+                "_version": version,
+                "_commit": self.commit[0],
+                "_item_full_hash": None,
+                "_removed": True,
+            }
+        )
+
+    def record_commit_stats(self, seen, new, changed, unchanged, removed):
+        self.commit_stats[self.commit[0]] = {
+            "seen": seen,
+            "new": new,
+            "changed": changed,
+            "unchanged": unchanged,
+            "removed": removed,
+        }
+
+    def record_refs(self, refs):
+        self.refs.update(refs)
+
+    def store_row(self, row):
+        self.rows.append(row)
+
+    def store_version(self, version):
+        self.versions.append(version)
+
+
+class JSONLSink(MemorySink):
+    """
+    Writes each row or version as a line of JSON to the file-like object fp,
+    with an extra _commit_at key. Only the current state of each item is
+    kept in memory.
+    """
+
+    def __init__(self, fp):
+        super().__init__()
+        self.fp = fp
+
+    def store_row(self, row):
+        self._write(row)
+
+    def store_version(self, version):
+        self._write(version)
+
+    def _write(self, row):
+        row["_commit_at"] = self.commit[1].isoformat()
+        self.fp.write(json.dumps(row, default=repr) + "\n")
+
+
+class FtsIndex:
+    """
+    An FTS5 index on some columns of a table, using the same schema as
+    sqlite-utils enable_fts() but updated in batches by SQLiteSink rather
+    than by triggers. Values are decoded before they are indexed, so
+    compressed and interned values can be searched.
+    """
+
+    def __init__(self, db, table, columns, decode):
+        self.db = db
+        self.table = table
+        self.columns = list(columns)
+        self.decode = decode
+        self.fts_table = "{}_fts".format(table)
+        if db[self.fts_table].exists():
+            existing = [column.name for column in db[self.fts_table].columns]
+            if existing != self.columns:
+                raise ValueError(
+                    "{} already indexes {} - drop it to index different columns".format(
+                        self.fts_table, ", ".join(existing)
+                    )
+                )
+        elif db[table].exists():
+            # Index existing rows once, so later runs only handle changes
+            self.create()
+            with db.conn:
+                self._insert(
+                    (row[0], row[1:])
+                    for row in db.execute(
+                        "select rowid, {} from [{}]".format(
+                            self._column_list(db[table].columns_dict), table
+                        )
+                    )
+                )
+
+    def _column_list(self, table_columns):
+        return ", ".join(
+            "[{}]".format(column) if column in table_columns else "null"
+            for column in self.columns
+        )
+
+    def create(self):
+        # execute() rather than executescript(), which would commit
+        self.db.execute(
+            textwrap.dedent(
+                """
+                CREATE VIRTUAL TABLE [{table}_fts] USING FTS5 (
+                    {columns},
+                    content=[{table}]
+                )
+                """
+            )
+            .strip()
+            .format(
+                table=self.table,
+                columns=", ".join("[{}]".format(c) for c in self.columns),
+            )
+        )
+
+    def current_values(self, pks):
+        """
+        Returns {pk: {column: value}} of the indexed columns for these rows,
+        leaving out rows that are not in the index, such as removal versions
+        """
+        pks = list(pks)
+        if not pks or not self.db[self.fts_table].exists():
+            return {}
+        return {
+            row[0]: dict(zip(self.columns, (self.decode(v) for v in row[1:])))
+            for row in self.db.execute(
+                """
+                select rowid, {} from [{}]
+                where rowid in (select value from json_each(?))
+                  and rowid in (select id from [{}_docsize])
+                """.format(
+                    self._column_list(self.db[self.table].columns_dict),
+                    self.table,
+                    self.fts_table,
+                ),
+                [json.dumps(pks)],
+            )
+        }
+
+    def replace(self, previous_values, new_values):
+        """
+        previous_values and new_values are {pk: {column: value}} - the
+        previous values are removed from the index, then the new ones added.
+        This does not commit, so it can be part of the transaction that
+        writes the rows.
+        """
+        if not self.db[self.fts_table].exists():
+            self.create()
+        self.db.conn.executemany(
+            "insert into [{fts}] ([{fts}], rowid, {columns}) values ('delete', ?, {params})".format(
+                fts=self.fts_table,
+                columns=self._column_list(self.columns),
+                params=", ".join("?" for _ in self.columns),
+            ),
+            [
+                [pk] + [values[column] for column in self.columns]
+                for pk, values in previous_values.items()
+            ],
+        )
+        self._insert(
+            (pk, [values.get(column) for column in self.columns])
+            for pk, values in new_values.items()
+        )
+
+    def _insert(self, rows):
+        self.db.conn.executemany(
+            "insert into [{}] (rowid, {}) values (?, {})".format(
+                self.fts_table,
+                self._column_list(self.columns),
+                ", ".join("?" for _ in self.columns),
+            ),
+            ([pk] + [self.decode(value) for value in values] for pk, values in rows),
+        )
+
+
+def get_item(db, item_table, item_id):
+    previous_items = list(
+        db.query(
+            """
+        select * from [{item_table}] where _item_id = ?
+        """.format(
+                item_table=item_table,
+            ),
+            [item_id],
+        )
+    )
+    if previous_items:
+        return previous_items[0]
+    else:
+        return None
+
+
+def create_views(db, namespace):
+    version_table = "{}_version".format(namespace)
+    if not db[version_table].exists():
+        return
+    if "_changed_columns" in db[version_table].columns_dict:
+        # Changed columns have been materialized, so no subquery is needed
+        sql = textwrap.dedent(
+            """
+            select
+              commits.commit_at as _commit_at,
+              commits.hash as _commit_hash,
+              {namespace}_version.*
+            from {namespace}_version
+              join commits on commits.id = {namespace}_version._commit
+            """.format(
+                namespace=namespace
+            )
+        ).strip()
+        db.create_view(
+            "{namespace}_version_detail".format(namespace=namespace),
+            sql,
+            replace=True,
+        )
+        return
+    sql = textwrap.dedent(
+        """
+        select
+          commits.commit_at as _commit_at,
+          commits.hash as _commit_hash,
+          {namespace}_version.*,
+          (
+            select json_group_array(name) from columns
+            where id in (
+              select column from {namespace}_changed
+              where item_version = {namespace}_version._id
+            )
+        ) as _changed_columns
+        from {namespace}_version
+          join commits on commits.id = {namespace}_version._commit
+        """.format(
+            namespace=namespace
+        )
+    ).strip()
+    db.create_view(
+        "{namespace}_version_detail".format(namespace=namespace),
+        sql,
+        ignore=True,
+    )
+
+
+def backfill_changed_columns(db, namespace):
+    "Populate a _changed_columns JSON array column on every row of the version table"
+    version_table = "{}_version".format(namespace)
+    changed_table = "{}_changed".format(namespace)
+    if "_changed_columns" not in db[version_table].columns_dict:
+        db[version_table].add_column("_changed_columns", str)
+    with db.conn:
+        if db[changed_table].exists():
+            db.execute(
+                textwrap.dedent(
+                    """
+                    update [{version_table}] set _changed_columns = (
+                      select json_group_array(name) from (
+                        select columns.name from [{changed_table}]
+                          join columns on columns.id = [{changed_table}].column
+                        where [{changed_table}].item_version = [{version_table}]._id
+                        order by columns.name
+                      )
+                    ) where _changed_columns is null
+                    """.format(
+                        version_table=version_table, changed_table=changed_table
+                    )
+                )
+            )
+        else:
+            db.execute(
+                "update [{}] set _changed_columns = '[]' where _changed_columns is null".format(
+                    version_table
+                )
+            )
+    create_views(db, namespace)
+
+
+# Columns populated from git_history.cli.log_commits(), apart from parents
+COMMIT_METADATA_COLUMNS = (
+    "author_name",
+    "author_email",
+    "authored_at",
+    "committer_name",
+    "committer_email",
+    "message",
+)
+
+
+def create_commits_table(db):
+    "Create the commits table, or add the metadata columns if they are missing"
+    columns = {"id": int, "namespace": int, "hash": str, "commit_at": str}
+    columns["parents"] = str
+    columns.update((column, str) for column in COMMIT_METADATA_COLUMNS)
+    if not db["commits"].exists():
+        db["commits"].create(
+            columns, pk="id", foreign_keys=(("namespace", "namespaces", "id"),)
+        )
+        db["commits"].create_index(["namespace", "hash"], unique=True)
+    else:
+        existing = db["commits"].columns_dict
+        for column, column_type in columns.items():
+            if column not in existing:
+                db["commits"].add_column(column, column_type)
+
+
+def get_versions_and_hashes(db, namespace):
+    item_id_to_version = {}
+    item_id_to_last_full_hash = {}
+    if db[namespace + "_version"].exists():
+        sql = """
+        select
+            {namespace}._item_id as item_id,
+            max({namespace}_version._version) as max_version,
+            {namespace}_version._item_full_hash as item_full_hash
+        from
+            {namespace}_version
+            join {namespace} on {namespace}_version._item = {namespace}._id
+        group by
+            _item_id
+        """.format(
+            namespace=namespace
+        )
+        for row in db.query(sql):
+            item_id_to_version[row["item_id"]] = row["max_version"]
+            item_id_to_last_full_hash[row["item_id"]] = row["item_full_hash"]
+    return item_id_to_version, item_id_to_last_full_hash
@@ -1,3 +1,5 @@
+import datetime
+import hashlib
 import json
 import re
 
@@ -12,6 +14,8 @@ RESERVED = (
     "_commit_at",
     "_commit_hash",
     "_changed_columns",
+    # Even without track_removals, since queries read it as the removal flag
+    "_removed",
     "rowid",
 )
 reserved_with_suffix_re = re.compile("^({})_*$".format("|".join(RESERVED)))
@@ -33,8 +37,50 @@ def _fix_key(key):
         return key
 
 
+def parse_timestamp(value, end_of_day=False):
+    """
+    Parse an ISO date or datetime into an aware datetime, taking timestamps
+    without a UTC offset to be in UTC. Raises ValueError if it is neither.
+
+    end_of_day=True makes a date on its own mean the end of that day rather
+    than the start, so that it covers every commit made on it.
+    """
+    timestamp = datetime.datetime.fromisoformat(value)
+    if end_of_day and len(value) == 10:
+        timestamp = timestamp.replace(hour=23, minute=59, second=59)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return timestamp
+
+
 def jsonify_if_needed(value):
     if isinstance(value, (dict, list, tuple)):
         return json.dumps(value, default=repr, ensure_ascii=False, sort_keys=True)
     else:
         return value
+
+
+def _hash(record):
+    return hashlib.sha1(
+        json.dumps(record, separators=(",", ":"), sort_keys=True, default=repr).encode(
+            "utf8"
+        )
+    ).hexdigest()
+
+
+def jsonify_all(item):
+    return {key: jsonify_if_needed(value) for key, value in item.items()}
+
+
+def compute_delta(item_flattened, previous_item):
+    "Return {column: value} for columns that differ from previous_item"
+    if previous_item is None:
+        return item_flattened
+    updated_values = {}
+    for column in item_flattened.keys() | previous_item.keys():
+        if column in RESERVED_SET:
+            continue
+        value = item_flattened.get(column)
+        if value != previous_item.get(column):
+            updated_values[column] = value
+    return updated_values
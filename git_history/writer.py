@@ -0,0 +1,272 @@
+import itertools
+
+from sqlite_utils.db import COLUMN_TYPE_MAPPING
+from sqlite_utils.utils import suggest_column_types
+from .utils import RESERVED_SET
+
+
+# Columns that hold the id of a row in the commits table
+COMMIT_COLUMNS = ("_commit", "commit")
+
+
+class BatchWriter:
+    """
+    Buffers the item and version rows produced by one commit, then writes
+    them with prepared statements grouped by column set.
+
+    The columns of each table are kept in memory, lowercased as SQLite
+    compares them, so new columns are added with one batch of ALTER TABLE
+    statements per commit instead of sqlite-utils introspecting the table
+    schema for every row. Primary keys for new items,
+    versions and commits are allocated here, so callers can reference them
+    before the rows have been written.
+
+    The commits table is shared by every namespace, so other runs can add
+    commits at the same time. flush() therefore takes the write lock before
+    it checks the commit ids. If another run has taken them, the commits
+    are renumbered and every column in COMMIT_COLUMNS is updated to match.
+
+    Rows for the other tables written for a commit, such as item_changed,
+    are buffered with add_rows(). flush() writes everything in a single
+    transaction, so a commit is either recorded in full or not at all.
+
+    encode_value, if provided, is applied to every data column value (but not
+    to reserved columns such as _item_id) as it is written.
+    """
+
+    def __init__(self, db, item_table, version_table, encode_value=None):
+        self.db = db
+        self.encode_value = encode_value
+        self.item_table = item_table
+        self.version_table = version_table
+        self.known_columns = {}
+        for table in (item_table, version_table):
+            if db[table].exists():
+                self.known_columns[table] = self._columns(table)
+        self.item_id_to_pk = {}
+        if "_item_id" in self.known_columns.get(item_table, ()):
+            self.item_id_to_pk = dict(
+                db.execute("select _item_id, _id from [{}]".format(item_table))
+            )
+        self.next_item_pk = self._next_pk(item_table)
+        self.next_version_pk = self._next_pk(version_table)
+        self.next_commit_pk = self._next_commit_pk()
+        self.new_items = {}
+        self.item_updates = []
+        self.versions = []
+        self.commits = []
+        # table -> (rows, replace, create_table() arguments)
+        self.rows = {}
+
+    def _next_pk(self, table):
+        if table not in self.known_columns:
+            return 1
+        return (
+            self.db.execute("select max(_id) from [{}]".format(table)).fetchone()[0]
+            or 0
+        ) + 1
+
+    def _next_commit_pk(self):
+        if not self.db["commits"].exists():
+            return 1
+        return (self.db.execute("select max(id) from commits").fetchone()[0] or 0) + 1
+
+    def item_pk(self, item_id):
+        "Return the _id for this _item_id, allocating one if it is new"
+        pk = self.item_id_to_pk.get(item_id)
+        if pk is None:
+            pk = self.next_item_pk
+            self.next_item_pk += 1
+            self.item_id_to_pk[item_id] = pk
+            self.new_items[pk] = {"_id": pk, "_item_id": item_id}
+        return pk
+
+    def update_item(self, pk, row):
+        if pk in self.new_items:
+            self.new_items[pk].update(row)
+        else:
+            self.item_updates.append((pk, row))
+
+    def add_version(self, row):
+        "Buffer a version row, returning the _id it will be written with"
+        pk = self.next_version_pk
+        self.next_version_pk += 1
+        self.versions.append(dict(row, _id=pk))
+        return pk
+
+    def add_commit(self, row):
+        """
+        Buffer a row for the commits table, which must already exist,
+        returning the id it will be written with unless flush() says otherwise
+        """
+        pk = self.next_commit_pk
+        self.next_commit_pk += 1
+        self.commits.append(dict(row, id=pk))
+        return pk
+
+    def add_rows(self, table, rows, replace=False, **create):
+        """
+        Buffer rows for another table. The table is created with create -
+        such as pk and foreign_keys - if it does not exist. replace=True
+        replaces existing rows with the same primary key.
+        """
+        rows = list(rows)
+        if rows:
+            self.rows.setdefault(table, ([], replace, create))[0].extend(rows)
+
+    def flush(self, after=None):
+        """
+        Write everything that has been buffered in one transaction. after,
+        if provided, is called inside that transaction once the rows have
+        been written.
+
+        Returns {id returned by add_commit(): id written} for any commits
+        that had to be renumbered.
+        """
+        renumbered = {}
+        # sqlite-utils Table methods can commit partway through, so tables
+        # are created with Database.create_table() and everything else is
+        # plain SQL on the connection
+        with self.db.conn:
+            if not self.db.conn.in_transaction:
+                self.db.execute("begin immediate")
+            if self.commits:
+                renumbered = self._renumber_commits()
+            # Commit metadata is never encoded
+            self._insert("commits", self.commits, encode=False)
+            new_items = list(self.new_items.values())
+            if new_items or self.item_updates:
+                if self.item_table not in self.known_columns:
+                    self.db.create_table(
+                        self.item_table,
+                        {"_id": int, "_item_id": str},
+                        pk="_id",
+                        column_order=("_id", "_item_id"),
+                    )
+                    # In the same form as sqlite-utils create_index()
+                    self.db.conn.execute(
+                        "CREATE UNIQUE INDEX [idx_{0}__item_id]\n"
+                        "    ON [{0}] ([_item_id]);".format(self.item_table)
+                    )
+                    self.known_columns[self.item_table] = {"_id", "_item_id"}
+                self._add_missing_columns(
+                    self.item_table, new_items + [row for _, row in self.item_updates]
+                )
+                self._insert(self.item_table, new_items)
+                self._update(self.item_table, self.item_updates)
+            if self.versions:
+                if self.version_table not in self.known_columns:
+                    first = dict(self.versions[0])
+                    first.pop("_id")
+                    self.db.create_table(
+                        self.version_table,
+                        suggest_column_types([first]),
+                        pk="_id",
+                        column_order=("_item", "_version", "_commit"),
+                        foreign_keys=(
+                            ("_item", self.item_table, "_id"),
+                            ("_commit", "commits", "id"),
+                        ),
+                    )
+                    self.known_columns[self.version_table] = self._columns(
+                        self.version_table
+                    )
+                self._add_missing_columns(self.version_table, self.versions)
+                self._insert(self.version_table, self.versions)
+            for table, (rows, replace, create) in self.rows.items():
+                if table not in self.known_columns:
+                    if not self.db[table].exists():
+                        self.db.create_table(
+                            table, suggest_column_types(rows), **create
+                        )
+                    self.known_columns[table] = self._columns(table)
+                self._add_missing_columns(table, rows)
+                self._insert(table, rows, encode=False, replace=replace)
+            if after is not None:
+                after()
+        self.new_items = {}
+        self.item_updates = []
+        self.versions = []
+        self.commits = []
+        self.rows = {}
+        return renumbered
+
+    def _renumber_commits(self):
+        "Give the buffered commits the next ids, now that nothing else can"
+        first = self._next_commit_pk()
+        renumbered = {
+            row["id"]: first + i
+            for i, row in enumerate(self.commits)
+            if row["id"] != first + i
+        }
+        self.next_commit_pk = first + len(self.commits)
+        if renumbered:
+            rows = itertools.chain(
+                self.new_items.values(),
+                (row for _, row in self.item_updates),
+                self.versions,
+                *(rows for rows, _, _ in self.rows.values()),
+            )
+            for row in self.commits:
+                row["id"] = renumbered.get(row["id"], row["id"])
+            for row in rows:
+                for column in COMMIT_COLUMNS:
+                    if row.get(column) in renumbered:
+                        row[column] = renumbered[row[column]]
+        return renumbered
+
+    def _columns(self, table):
+        return {column.lower() for column in self.db[table].columns_dict}
+
+    def _add_missing_columns(self, table, rows):
+        known = self.known_columns[table]
+        rows_with_new_columns = [
+            row for row in rows if not known.issuperset(map(str.lower, row))
+        ]
+        if not rows_with_new_columns:
+            return
+        for column, column_type in suggest_column_types(rows_with_new_columns).items():
+            if column.lower() not in known:
+                self.db.conn.execute(
+                    "ALTER TABLE [{}] ADD COLUMN [{}] {};".format(
+                        table, column, COLUMN_TYPE_MAPPING[column_type]
+                    )
+                )
+                known.add(column.lower())
+
+    def _values(self, row):
+        if self.encode_value is None:
+            return tuple(row.values())
+        return tuple(
+            value if column in RESERVED_SET else self.encode_value(value)
+            for column, value in row.items()
+        )
+
+    def _insert(self, table, rows, encode=True, replace=False):
+        groups = {}
+        for row in rows:
+            groups.setdefault(tuple(row), []).append(
+                self._values(row) if encode else tuple(row.values())
+            )
+        for columns, values in groups.items():
+            self.db.conn.executemany(
+                "insert {}into [{}] ({}) values ({})".format(
+                    "or replace " if replace else "",
+                    table,
+                    ", ".join("[{}]".format(column) for column in columns),
+                    ", ".join("?" for _ in columns),
+                ),
+                values,
+            )
+
+    def _update(self, table, updates):
+        groups = {}
+        for pk, row in updates:
+            groups.setdefault(tuple(row), []).append(self._values(row) + (pk,))
+        for columns, values in groups.items():
+            self.db.conn.executemany(
+                "update [{}] set {} where _id = ?".format(
+                    table, ", ".join("[{}] = ?".format(column) for column in columns)
+                ),
+                values,
+            )
@@ -1,10 +1,25 @@
 from click.testing import CliRunner
 from git_history.cli import cli
+from git_history.catalog import attach_shards
+from git_history.ingest import Ingestor, LazyModule, compile_convert
+from git_history.query import UnknownRef, iterate_items_as_of, resolve_commit_id
+from git_history.sinks import JSONLSink, MemorySink, SQLiteSink
+from git_history.writer import BatchWriter
+from git_history import compression
+from git_history.compression import register_functions
 from git_history.utils import RESERVED
+from unittest.mock import ANY
+import collections
+import datetime
+import io
 import itertools
 import json
+import os
 import pytest
+import shutil
+import sqlite3
 import subprocess
+import sys
 import sqlite_utils
 import textwrap
 
@@ -196,6 +211,19 @@ def expected_create_view(namespace):
     ).strip()
 
 
+def expected_indexes(namespace):
+    return textwrap.dedent(
+        """
+        CREATE INDEX [idx_{namespace}_version__item__version]
+            ON [{namespace}_version] ([_item], [_version]);
+        CREATE INDEX [idx_{namespace}_version__commit__item__version]
+            ON [{namespace}_version] ([_commit], [_item], [_version]);
+    """.format(
+            namespace=namespace
+        )
+    ).strip()
+
+
 @pytest.mark.parametrize("namespace", (None, "custom"))
 def test_file_without_id(repo, tmpdir, namespace):
     runner = CliRunner()
@@ -218,7 +246,14 @@ def test_file_without_id(repo, tmpdir, namespace):
         "   [id] INTEGER PRIMARY KEY,\n"
         "   [namespace] INTEGER REFERENCES [namespaces]([id]),\n"
         "   [hash] TEXT,\n"
-        "   [commit_at] TEXT\n"
+        "   [commit_at] TEXT,\n"
+        "   [parents] TEXT,\n"
+        "   [author_name] TEXT,\n"
+        "   [author_email] TEXT,\n"
+        "   [authored_at] TEXT,\n"
+        "   [committer_name] TEXT,\n"
+        "   [committer_email] TEXT,\n"
+        "   [message] TEXT\n"
         ");\n"
         "CREATE UNIQUE INDEX [idx_commits_namespace_hash]\n"
         "    ON [commits] ([namespace], [hash]);\n"
@@ -276,10 +311,24 @@ CREATE TABLE [commits] (
    [id] INTEGER PRIMARY KEY,
    [namespace] INTEGER REFERENCES [namespaces]([id]),
    [hash] TEXT,
-   [commit_at] TEXT
+   [commit_at] TEXT,
+   [parents] TEXT,
+   [author_name] TEXT,
+   [author_email] TEXT,
+   [authored_at] TEXT,
+   [committer_name] TEXT,
+   [committer_email] TEXT,
+   [message] TEXT
 );
 CREATE UNIQUE INDEX [idx_commits_namespace_hash]
     ON [commits] ([namespace], [hash]);
+CREATE TABLE [columns] (
+   [id] INTEGER PRIMARY KEY,
+   [namespace] INTEGER REFERENCES [namespaces]([id]),
+   [name] TEXT
+);
+CREATE UNIQUE INDEX [idx_columns_namespace_name]
+    ON [columns] ([namespace], [name]);
 CREATE TABLE [{namespace}] (
    [_id] INTEGER PRIMARY KEY,
    [_item_id] TEXT
@@ -295,24 +344,17 @@ CREATE TABLE [{namespace}_version] (
    [name] TEXT,
    [_item_full_hash] TEXT
 );
-CREATE TABLE [columns] (
-   [id] INTEGER PRIMARY KEY,
-   [namespace] INTEGER REFERENCES [namespaces]([id]),
-   [name] TEXT
-);
-CREATE UNIQUE INDEX [idx_columns_namespace_name]
-    ON [columns] ([namespace], [name]);
 CREATE TABLE [{namespace}_changed] (
    [item_version] INTEGER REFERENCES [{namespace}_version]([_id]),
    [column] INTEGER REFERENCES [columns]([id]),
    PRIMARY KEY ([item_version], [column])
 );
 {view}
-CREATE INDEX [idx_{namespace}_version__item]
-    ON [{namespace}_version] ([_item]);
+{indexes}
 """.strip().format(
             namespace=namespace or "item",
             view=expected_create_view(namespace or "item"),
+            indexes=expected_indexes(namespace or "item"),
         )
     )
     assert db["commits"].count == 2
@@ -563,7 +605,14 @@ def test_file_with_id_full_versions(repo, tmpdir, namespace):
         "   [id] INTEGER PRIMARY KEY,\n"
         "   [namespace] INTEGER REFERENCES [namespaces]([id]),\n"
         "   [hash] TEXT,\n"
-        "   [commit_at] TEXT\n"
+        "   [commit_at] TEXT,\n"
+        "   [parents] TEXT,\n"
+        "   [author_name] TEXT,\n"
+        "   [author_email] TEXT,\n"
+        "   [authored_at] TEXT,\n"
+        "   [committer_name] TEXT,\n"
+        "   [committer_email] TEXT,\n"
+        "   [message] TEXT\n"
         ");\n"
         "CREATE UNIQUE INDEX [idx_commits_namespace_hash]\n"
         "    ON [commits] ([namespace], [hash]);\n"
@@ -581,8 +630,8 @@ def test_file_with_id_full_versions(repo, tmpdir, namespace):
         "   [name] TEXT\n"
         ");\n"
         + expected_create_view(namespace or "item")
-        + "\nCREATE INDEX [idx_{}__item]\n".format(version_table)
-        + "    ON [{}] ([_item]);".format(version_table)
+        + "\n"
+        + expected_indexes(namespace or "item")
     )
     assert db["commits"].count == 2
     # Should have no duplicates
@@ -633,7 +682,14 @@ def test_file_with_reserved_columns(repo, tmpdir):
            [id] INTEGER PRIMARY KEY,
            [namespace] INTEGER REFERENCES [namespaces]([id]),
            [hash] TEXT,
-           [commit_at] TEXT
+           [commit_at] TEXT,
+           [parents] TEXT,
+           [author_name] TEXT,
+           [author_email] TEXT,
+           [authored_at] TEXT,
+           [committer_name] TEXT,
+           [committer_email] TEXT,
+           [message] TEXT
         );
         CREATE UNIQUE INDEX [idx_commits_namespace_hash]
             ON [commits] ([namespace], [hash]);
@@ -657,8 +713,8 @@ def test_file_with_reserved_columns(repo, tmpdir):
         )
         + "\n"
         + expected_create_view("item")
-        + "\nCREATE INDEX [idx_item_version__item]\n"
-        "    ON [item_version] ([_item]);"
+        + "\n"
+        + expected_indexes("item")
     ).strip()
 
     assert db.schema == expected_schema
@@ -736,7 +792,14 @@ def test_csv_tsv(repo, tmpdir, file):
            [id] INTEGER PRIMARY KEY,
            [namespace] INTEGER REFERENCES [namespaces]([id]),
            [hash] TEXT,
-           [commit_at] TEXT
+           [commit_at] TEXT,
+           [parents] TEXT,
+           [author_name] TEXT,
+           [author_email] TEXT,
+           [authored_at] TEXT,
+           [committer_name] TEXT,
+           [committer_email] TEXT,
+           [message] TEXT
         );
         CREATE UNIQUE INDEX [idx_commits_namespace_hash]
             ON [commits] ([namespace], [hash]);
@@ -757,8 +820,8 @@ def test_csv_tsv(repo, tmpdir, file):
         ).strip()
         + "\n"
         + expected_create_view("item")
-        + "\nCREATE INDEX [idx_item_version__item]\n"
-        "    ON [item_version] ([_item]);"
+        + "\n"
+        + expected_indexes("item")
     )
 
 
@@ -952,6 +1015,8 @@ def test_reserved_columns_are_reserved(tmpdir, repo):
             str(repo),
             "--id",
             "product_id",
+            # Options that add further reserved columns
+            "--track-removals",
         ],
     )
     # Find all columns with _ prefixes and no suffix
@@ -986,3 +1051,1831 @@ def test_wal(repo, tmpdir, use_wal):
     db = sqlite_utils.Database(db_path)
     expected_journal_mode = "wal" if use_wal else "delete"
     assert db.journal_mode == expected_journal_mode
+
+
+def test_shards(repo, tmpdir, monkeypatch):
+    from git_history.shards import ShardPool
+
+    runner = CliRunner()
+    diff = ShardPool.diff
+    sent = []
+
+    def record_diff(self, changed_items):
+        changed_items = list(changed_items)
+        sent.extend(item for _, item, _, _ in changed_items)
+        return diff(self, changed_items)
+
+    monkeypatch.setattr(ShardPool, "diff", record_diff)
+
+    def run(db_path, extra):
+        result = runner.invoke(
+            cli,
+            [
+                "file",
+                db_path,
+                str(repo / "items.json"),
+                "--repo",
+                str(repo),
+                "--id",
+                "product_id",
+            ]
+            + extra,
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0
+        return sqlite_utils.Database(db_path)
+
+    serial_db = run(str(tmpdir / "serial.db"), [])
+    sharded_path = str(tmpdir / "sharded.db")
+    sharded_db = run(sharded_path, ["--shards", "3"])
+    # Add another commit and resume, to exercise state loaded by each shard
+    (repo / "items.json").write_text(
+        json.dumps(
+            [
+                {"product_id": 1, "name": "Gin"},
+                {"product_id": 2, "name": "Tonic 3"},
+                {"product_id": 3, "name": "Rum Pony"},
+            ]
+        ),
+        "utf-8",
+    )
+    subprocess.call(git_commit + ["-a", "-m", "another"], cwd=str(repo))
+    run(str(tmpdir / "serial.db"), [])
+    sent.clear()
+    run(sharded_path, ["--shards", "3"])
+    # Unchanged items are never sent to the workers
+    assert sent == [
+        {"product_id": 2, "name": "Tonic 3"},
+        {"product_id": 3, "name": "Rum Pony"},
+    ]
+    for table in ("item", "item_version", "item_changed"):
+        assert list(sharded_db[table].rows) == list(serial_db[table].rows)
+    assert [r["_version"] for r in sharded_db["item_version"].rows] == [
+        1,
+        1,
+        2,
+        1,
+        3,
+        2,
+    ]
+
+
+@pytest.mark.parametrize("use_id", (False, True))
+@pytest.mark.parametrize(
+    "options", ([], ["--convert", "json.loads(content)", "--ignore", "name"])
+)
+def test_pipeline(repo, tmpdir, use_id, options):
+    runner = CliRunner()
+
+    def run(db_path, extra):
+        result = runner.invoke(
+            cli,
+            ["file", db_path, str(repo / "items.json"), "--repo", str(repo)]
+            + (["--id", "product_id"] if use_id else [])
+            + options
+            + extra,
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0
+        return sqlite_utils.Database(db_path)
+
+    db = run(str(tmpdir / "serial.db"), [])
+    pipelined_db = run(
+        str(tmpdir / "pipelined.db"), ["--pipeline", "--parse-workers", "3"]
+    )
+    assert pipelined_db.schema == db.schema
+    assert ("name" in db["item"].columns_dict) == (not options)
+    for table in db.table_names():
+        assert list(pipelined_db[table].rows) == list(db[table].rows)
+
+
+def test_pipeline_convert_error(repo, tmpdir):
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        [
+            "file",
+            str(tmpdir / "db.db"),
+            str(repo / "items.json"),
+            "--repo",
+            str(repo),
+            "--pipeline",
+            "--convert",
+            "json.loads(content)['missing']",
+        ],
+    )
+    assert result.exit_code == 1
+    assert "Error in commit" in result.output
+    assert isinstance(result.exception, TypeError)
+
+
+def make_tonic_commits(repo, names):
+    "Commit a new items.json for each name, changing product_id=2 every time"
+    for i, name in enumerate(names):
+        (repo / "items.json").write_text(
+            json.dumps(
+                [
+                    {"product_id": 1, "name": "Gin"},
+                    {"product_id": 2, "name": name, "extra": i},
+                ]
+            ),
+            "utf-8",
+        )
+        subprocess.call(git_commit + ["-a", "-m", name], cwd=str(repo))
+
+
+@pytest.mark.parametrize(
+    "options", ([], ["--keyframes", "2"], ["--keyframes", "1"], ["--full-versions"])
+)
+def test_as_of(repo, tmpdir, options):
+    make_tonic_commits(repo, ["Tonic 3", "Tonic 4", "Tonic 5"])
+    runner = CliRunner()
+    db_path = str(tmpdir / "db.db")
+    result = runner.invoke(
+        cli,
+        ["file", db_path, str(repo / "items.json"), "--repo", str(repo)]
+        + ["--id", "product_id"]
+        + options,
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    db = sqlite_utils.Database(db_path)
+    hashes = [r["hash"] for r in db["commits"].rows]
+    assert len(hashes) == 5
+    result = runner.invoke(cli, ["as-of", db_path, hashes[3][:10]])
+    assert result.exit_code == 0
+    rows = json.loads(result.output)
+    assert [
+        {k: v for k, v in row.items() if not k.startswith("_")} for row in rows
+    ] == [
+        {"product_id": 1, "name": "Gin", "extra": None},
+        {"product_id": 2, "name": "Tonic 4", "extra": 1},
+        {"product_id": 3, "name": "Rum", "extra": None},
+    ]
+    assert [row["_version"] for row in rows] == [1, 4, 1]
+    # The generated SQL should return the same rows
+    sql = runner.invoke(cli, ["as-of", db_path, "--sql"]).output
+    commit_id = db.execute("select id from commits where hash = ?", [hashes[3]])
+    assert list(db.query(sql, {"commit": commit_id.fetchone()[0]})) == rows
+    # Timestamps work too, newline-delimited output
+    result = runner.invoke(cli, ["as-of", db_path, "2099-01-01", "--nl"])
+    lines = [json.loads(line) for line in result.output.strip().split("\n")]
+    assert [line["name"] for line in lines] == ["Gin", "Tonic 5", "Rum"]
+    result = runner.invoke(cli, ["as-of", db_path, "1999-01-01"])
+    assert result.exit_code == 1
+    assert "earlier than any commit" in result.output
+    # Hashes that are not in the database are not treated as timestamps
+    for ref in ("deadbeef", "0000abcd"):
+        result = runner.invoke(cli, ["as-of", db_path, ref])
+        assert result.exit_code == 1
+        assert result.output.strip() == "Error: Unknown commit '{}'".format(ref)
+
+
+def test_resolve_commit_id():
+    db = sqlite_utils.Database(memory=True)
+    db["namespaces"].insert({"id": 1, "name": "item"})
+    db["commits"].insert_all(
+        [
+            {
+                "id": 1,
+                "namespace": 1,
+                "hash": "aaa1",
+                "commit_at": "2021-01-04T08:00:00+00:00",
+            },
+            # 18:00 UTC
+            {
+                "id": 2,
+                "namespace": 1,
+                "hash": "bbb2",
+                "commit_at": "2021-01-04T10:00:00-08:00",
+            },
+        ]
+    )
+    assert resolve_commit_id(db, "item", "bbb") == 2
+    assert resolve_commit_id(db, "item", "2021-01-04T12:00:00+00:00") == 1
+    assert resolve_commit_id(db, "item", "2021-01-04T12:00:00-08:00") == 2
+    # Timestamps without an offset are UTC
+    assert resolve_commit_id(db, "item", "2021-01-04T17:59:59") == 1
+    assert resolve_commit_id(db, "item", "2021-01-05") == 2
+    # A date on its own covers the whole day, as for file --until
+    assert resolve_commit_id(db, "item", "2021-01-04") == 2
+    # ... unless it marks the start of a range, as for export --since
+    assert (
+        resolve_commit_id(db, "item", "2021-01-04", if_earlier=0, end_of_day=False) == 0
+    )
+    assert resolve_commit_id(db, "item", "2021-01-01", if_earlier=0) == 0
+    with pytest.raises(UnknownRef, match="earlier than any commit"):
+        resolve_commit_id(db, "item", "2021-01-01")
+    for ref in ("deadbeef", "ccc", "2021-13-01"):
+        with pytest.raises(UnknownRef, match="Unknown commit"):
+            resolve_commit_id(db, "item", ref)
+
+
+@pytest.mark.parametrize("backfill", (False, True))
+def test_store_changed_columns(repo, tmpdir, backfill):
+    runner = CliRunner()
+    db_path = str(tmpdir / "db.db")
+    options = ["file", db_path, str(repo / "items.json"), "--repo", str(repo)]
+    options += ["--id", "product_id"]
+    if not backfill:
+        options.append("--store-changed-columns")
+    result = runner.invoke(cli, options, catch_exceptions=False)
+    assert result.exit_code == 0
+    db = sqlite_utils.Database(db_path)
+    if backfill:
+        assert "_changed_columns" not in db["item_version"].columns_dict
+        result = runner.invoke(cli, ["backfill-changed-columns", db_path])
+        assert result.exit_code == 0
+    view_sql = db["item_version_detail"].schema
+    assert "item_changed" not in view_sql
+    expected = [
+        ("Gin", '["name","product_id"]'),
+        ("Tonic", '["name","product_id"]'),
+        ("Tonic 2", '["name"]'),
+        ("Rum", '["name","product_id"]'),
+    ]
+    assert [
+        (r["name"], r["_changed_columns"])
+        for r in db.query("select name, _changed_columns from item_version_detail")
+    ] == expected
+    # Subsequent runs without the option should keep populating the column
+    make_tonic_commits(repo, ["Tonic 3"])
+    options = [o for o in options if o != "--store-changed-columns"]
+    result = runner.invoke(cli, options, catch_exceptions=False)
+    assert result.exit_code == 0
+    assert list(
+        db.query("select name, _changed_columns from item_version order by _id desc")
+    )[0] == {"name": "Tonic 3", "_changed_columns": '["extra","name"]'}
+
+
+def test_diff(repo, tmpdir):
+    make_tonic_commits(repo, ["Tonic 3", "Tonic 4"])
+    runner = CliRunner()
+    db_path = str(tmpdir / "db.db")
+    result = runner.invoke(
+        cli,
+        ["file", db_path, str(repo / "items.json"), "--repo", str(repo)]
+        + ["--id", "product_id"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    db = sqlite_utils.Database(db_path)
+    hashes = [r["hash"] for r in db["commits"].rows]
+    result = runner.invoke(cli, ["diff", db_path, hashes[0], hashes[3]])
+    assert result.exit_code == 0
+    diff = json.loads(result.output)
+    assert [item["name"] for item in diff["added"]] == ["Rum"]
+    assert diff["changed"] == [
+        {
+            "_id": 2,
+            "_item_id": diff["changed"][0]["_item_id"],
+            "_version": 4,
+            "changes": {
+                "name": {"from": "Tonic", "to": "Tonic 4"},
+                "extra": {"from": None, "to": 1},
+            },
+        }
+    ]
+    assert diff["removed"] == []
+    # Nothing changed between a commit and itself
+    result = runner.invoke(cli, ["diff", db_path, hashes[1], hashes[1]])
+    assert json.loads(result.output) == {"added": [], "changed": [], "removed": []}
+    # Out of order
+    result = runner.invoke(cli, ["diff", db_path, hashes[3], hashes[0]])
+    assert result.exit_code == 1
+    assert "must be earlier" in result.output
+
+
+def test_shard_sql():
+    from git_history.shards import shard_for_item_id, shard_sql
+    from git_history.utils import _hash
+
+    conn = sqlite3.connect(":memory:")
+    item_ids = [_hash({"id": i}) for i in range(200)] + ["ffffffff" + "0" * 32]
+    for shard_count in (1, 3, 7):
+        assert [
+            conn.execute(
+                "select {}".format(shard_sql(":item_id", shard_count)),
+                {"item_id": item_id},
+            ).fetchone()[0]
+            for item_id in item_ids
+        ] == [shard_for_item_id(item_id, shard_count) for item_id in item_ids]
+
+
+@pytest.mark.parametrize("shards", ("1", "2"))
+def test_track_removals(repo, tmpdir, shards):
+    runner = CliRunner()
+    db_path = str(tmpdir / "db.db")
+    options = ["file", db_path, str(repo / "items.json"), "--repo", str(repo)]
+    options += ["--id", "product_id", "--track-removals", "--shards", shards]
+    result = runner.invoke(cli, options, catch_exceptions=False)
+    assert result.exit_code == 0
+    # Remove Gin and Rum, then bring Rum back unchanged in a separate run
+    (repo / "items.json").write_text(
+        json.dumps([{"product_id": 2, "name": "Tonic 2"}]), "utf-8"
+    )
+    subprocess.call(git_commit + ["-a", "-m", "remove"], cwd=str(repo))
+    result = runner.invoke(cli, options, catch_exceptions=False)
+    assert result.exit_code == 0
+    (repo / "items.json").write_text(
+        json.dumps(
+            [{"product_id": 2, "name": "Tonic 2"}, {"product_id": 3, "name": "Rum"}]
+        ),
+        "utf-8",
+    )
+    subprocess.call(git_commit + ["-a", "-m", "restore"], cwd=str(repo))
+    result = runner.invoke(cli, options, catch_exceptions=False)
+    assert result.exit_code == 0
+    db = sqlite_utils.Database(db_path)
+    assert (
+        list(
+            db.query(
+                """
+            select
+              item.product_id,
+              item_version_detail._version,
+              item_version_detail._removed,
+              item_version_detail._changed_columns
+            from item_version_detail join item on item._id = item_version_detail._item
+            order by item_version_detail._item, _version
+            """
+            )
+        )
+        == [
+            {"product_id": 1, "_version": 1, "_removed": None, "_changed_columns": ANY},
+            {"product_id": 1, "_version": 2, "_removed": 1, "_changed_columns": "[]"},
+            {"product_id": 2, "_version": 1, "_removed": None, "_changed_columns": ANY},
+            {"product_id": 2, "_version": 2, "_removed": None, "_changed_columns": ANY},
+            {"product_id": 3, "_version": 1, "_removed": None, "_changed_columns": ANY},
+            {"product_id": 3, "_version": 2, "_removed": 1, "_changed_columns": "[]"},
+            {
+                "product_id": 3,
+                "_version": 3,
+                "_removed": None,
+                "_changed_columns": "[]",
+            },
+        ]
+    )
+    assert [(r["product_id"], r["_removed"]) for r in db["item"].rows] == [
+        (1, 1),
+        (2, 0),
+        (3, 0),
+    ]
+    hashes = [r["hash"] for r in db["commits"].rows]
+    as_of = json.loads(runner.invoke(cli, ["as-of", db_path, hashes[2]]).output)
+    assert [r["name"] for r in as_of] == ["Tonic 2"]
+    as_of = json.loads(runner.invoke(cli, ["as-of", db_path, hashes[3]]).output)
+    assert [r["name"] for r in as_of] == ["Tonic 2", "Rum"]
+    diff = json.loads(
+        runner.invoke(cli, ["diff", db_path, hashes[1], hashes[2]]).output
+    )
+    assert [r["name"] for r in diff["removed"]] == ["Gin", "Rum"]
+    assert diff["added"] == diff["changed"] == []
+
+
+@pytest.mark.parametrize("codec", ("zlib", "zstd"))
+def test_compress(repo, tmpdir, codec):
+    if codec == "zstd":
+        pytest.importorskip("zstandard")
+    make_tonic_commits(repo, ["Tonic 3"])
+    runner = CliRunner()
+    db_path = str(tmpdir / "db.db")
+    options = ["file", db_path, str(repo / "items.json"), "--repo", str(repo)]
+    options += ["--id", "product_id", "--compress", codec, "--compress-threshold", "5"]
+    result = runner.invoke(cli, options, catch_exceptions=False)
+    assert result.exit_code == 0
+    db = sqlite_utils.Database(db_path)
+    names = [r["name"] for r in db.query("select name from item_version")]
+    prefix = {"zlib": b"\x00ghz", "zstd": b"\x00ghs"}[codec]
+    # "Gin" and "Rum" are below the threshold
+    assert [n if isinstance(n, str) else n[:4] for n in names] == [
+        "Gin",
+        prefix,
+        prefix,
+        "Rum",
+        prefix,
+    ]
+    conn = db.conn
+    register_functions(conn)
+    assert [
+        r[0] for r in conn.execute("select decompress(name) from item order by _id")
+    ] == ["Gin", "Tonic 3", "Rum"]
+    as_of = json.loads(runner.invoke(cli, ["as-of", db_path, "2099-01-01"]).output)
+    assert [r["name"] for r in as_of] == ["Gin", "Tonic 3", "Rum"]
+    # Resuming compares against the decompressed previous values
+    make_tonic_commits(repo, ["Tonic 3", "Tonic 4"])
+    result = runner.invoke(cli, options, catch_exceptions=False)
+    assert result.exit_code == 0
+    assert db["item_version"].count == 6
+
+
+def test_compress_dictionary(monkeypatch):
+    pytest.importorskip("zstandard")
+    monkeypatch.setattr(compression, "DICTIONARY_SAMPLES", 200)
+    saved = []
+
+    def save_dictionary(dictionary):
+        saved.append(dictionary)
+        return 1
+
+    compressor = compression.Compressor(
+        "zstd", 10, train_dictionary=True, save_dictionary=save_dictionary
+    )
+    values = [
+        json.dumps({"id": i, "description": "Incident number {} reported".format(i)})
+        for i in range(300)
+    ]
+    encoded = [compressor.encode(value) for value in values]
+    assert len(saved) == 1
+    # Values after training use the dictionary
+    assert encoded[0][4:8] == b"\x00\x00\x00\x00"
+    assert encoded[-1][4:8] == b"\x00\x00\x00\x01"
+    db = sqlite_utils.Database(memory=True)
+    db["compression_dictionaries"].insert({"id": 1, "dictionary": saved[0]}, pk="id")
+    decompressor = compression.Decompressor(db.conn)
+    assert [decompressor.decode(value) for value in encoded] == values
+
+
+@pytest.mark.parametrize("compress", (False, True))
+def test_intern_values(repo, tmpdir, compress):
+    geometry = json.dumps({"type": "Point", "coordinates": [1.5, 2.5] * 20})
+
+    def write_items(names):
+        (repo / "items.json").write_text(
+            json.dumps(
+                [
+                    {"product_id": i, "name": name, "geometry": geometry}
+                    for i, name in enumerate(names, 1)
+                ]
+            ),
+            "utf-8",
+        )
+        subprocess.call(git_commit + ["-a", "-m", "more"], cwd=str(repo))
+
+    write_items(["Gin", "Tonic"])
+    runner = CliRunner()
+    db_path = str(tmpdir / "db.db")
+    options = ["file", db_path, str(repo / "items.json"), "--repo", str(repo)]
+    options += ["--id", "product_id", "--intern-values", "--intern-threshold", "100"]
+    if compress:
+        options += ["--compress", "zlib", "--compress-threshold", "4"]
+    result = runner.invoke(cli, options, catch_exceptions=False)
+    assert result.exit_code == 0
+    write_items(["Gin", "Tonic 2"])
+    result = runner.invoke(cli, options, catch_exceptions=False)
+    assert result.exit_code == 0
+    db = sqlite_utils.Database(db_path)
+    assert db["interned_values"].count == 1
+    stored = [
+        r["geometry"]
+        for r in db.query(
+            "select geometry from item union all select geometry from item_version"
+        )
+        if r["geometry"] is not None
+    ]
+    assert stored == [b"\x00ghr" + b"\x00" * 7 + b"\x01"] * 4
+    as_of = json.loads(runner.invoke(cli, ["as-of", db_path, "2099-01-01"]).output)
+    assert [(r["name"], r["geometry"]) for r in as_of] == [
+        ("Gin", geometry),
+        ("Tonic 2", geometry),
+        ("Rum", None),
+    ]
+
+
+@pytest.mark.parametrize(
+    "file,options",
+    (
+        ("items.json", []),
+        ("items.json", ["--convert", "json.loads(content)"]),
+        ("items.json", ["--pipeline"]),
+        ("trees.csv", ["--csv"]),
+        ("trees.tsv", ["--dialect", "excel-tab"]),
+    ),
+)
+def test_ignore(repo, tmpdir, file, options):
+    runner = CliRunner()
+    db_path = str(tmpdir / "db.db")
+    result = runner.invoke(
+        cli,
+        ["file", db_path, str(repo / file), "--repo", str(repo)]
+        + ["--ignore", "name", "--ignore", "missing"]
+        + options,
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    db = sqlite_utils.Database(db_path)
+    assert db["item"].columns_dict.keys() == {
+        "product_id" if file == "items.json" else "TreeID",
+        "_commit",
+    }
+
+
+def test_startup_imports():
+    # Heavy modules should only be imported by the commands that need them
+    code = textwrap.dedent(
+        """
+        import sys
+        import git_history.cli
+        print(" ".join(sorted(sys.modules)))
+        """
+    )
+    output = subprocess.check_output([sys.executable, "-c", code]).decode("utf-8")
+    modules = set(output.split())
+    for module in ("git", "sqlite_utils", "multiprocessing", "concurrent.futures"):
+        assert module not in modules
+
+
+def test_convert_ignore_before_cache():
+    from git_history.blobs import Blob
+    from git_history.ingest import Ingestor
+
+    ingestor = Ingestor(
+        MemorySink(),
+        ids=["id"],
+        convert="json.loads(content)",
+        ignore=["raw"],
+        blob_cache_size=2,
+    )
+    blob = Blob(b'[{"id": 1, "raw": "x"}]', "a")
+    commit_at = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+    ingestor.ingest([(commit_at, "c1", blob), (commit_at, "c2", blob)])
+    # Cached items never had the ignored key, so nothing has to modify them
+    assert ingestor.blob_cache["a"] == [{"id": 1}]
+    assert not [version for version in ingestor.sink.versions if "raw" in version]
+    # Items passed in directly are left alone
+    items = [{"id": 2, "raw": "y"}]
+    ingestor.ingest_items(commit_at, "c3", items)
+    assert items == [{"id": 2, "raw": "y"}]
+
+
+def test_convert_imports_are_lazy():
+    fn = compile_convert("xml.dom.minidom.parseString(content)", ["xml.dom.minidom"])
+    assert isinstance(fn.__globals__["xml"], LazyModule)
+    assert fn.__globals__["xml"].module is None
+    assert fn("<a/>").documentElement.tagName == "a"
+    assert fn.__globals__["xml"].module is not None
+
+
+def test_ingestor_sinks(tmpdir):
+    versions = [
+        (
+            datetime.datetime(2021, 1, day, tzinfo=datetime.timezone.utc),
+            "hash{}".format(day),
+            json.dumps(items).encode("utf-8"),
+        )
+        for day, items in enumerate(
+            (
+                [{"id": 1, "name": "Gin"}, {"id": 2, "name": "Tonic"}],
+                [{"id": 1, "name": "Gin"}, {"id": 2, "name": "Tonic 2"}],
+                [{"id": 2, "name": "Tonic 2"}],
+            ),
+            1,
+        )
+    ]
+    memory = MemorySink()
+    ingestor = Ingestor(memory, ids=["id"], track_removals=True)
+    ingestor.ingest(versions[:2])
+    # The same instance can keep going, one blob at a time
+    ingestor.ingest_blob(*versions[2])
+    ingestor.close()
+    assert memory.seen_commits() == {"hash1", "hash2", "hash3"}
+    assert [
+        {k: v for k, v in version.items() if k not in ("_item_id", "_item_full_hash")}
+        for version in memory.versions
+    ] == [
+        {"id": 1, "name": "Gin", "_version": 1, "_commit": "hash1"},
+        {"id": 2, "name": "Tonic", "_version": 1, "_commit": "hash1"},
+        {"name": "Tonic 2", "_version": 2, "_commit": "hash2"},
+        {"_version": 2, "_commit": "hash3", "_removed": True},
+    ]
+    assert list(memory.items.values()) == [
+        {"id": 1, "name": "Gin"},
+        {"id": 2, "name": "Tonic 2"},
+    ]
+    assert len(memory.live_item_ids()) == 1
+
+    fp = io.StringIO()
+    with Ingestor(JSONLSink(fp), ids=["id"], full_versions=True) as ingestor:
+        ingestor.ingest(versions)
+    lines = [json.loads(line) for line in fp.getvalue().strip().split("\n")]
+    assert [(line["name"], line["_commit_at"][:10]) for line in lines] == [
+        ("Gin", "2021-01-01"),
+        ("Tonic", "2021-01-01"),
+        ("Tonic 2", "2021-01-02"),
+    ]
+
+    # Passing a path writes to SQLite, just like the file command
+    db_path = str(tmpdir / "db.db")
+    with Ingestor(db_path, ids=["id"]) as ingestor:
+        ingestor.ingest(versions)
+    db = sqlite_utils.Database(db_path)
+    assert [r["name"] for r in db["item"].rows] == ["Gin", "Tonic 2"]
+    assert db["item_version"].count == 3
+    assert "item_version_detail" in db.view_names()
+
+
+def test_batch_writer():
+    db = sqlite_utils.Database(memory=True)
+    db["commits"].create({"id": int, "hash": str}, pk="id")
+    writer = BatchWriter(db, "item", "item_version", encode_value=str.upper)
+    writer.add_commit({"id": 1, "hash": "a"})
+    gin = writer.item_pk("gin")
+    tonic = writer.item_pk("tonic")
+    assert writer.item_pk("gin") == gin == 1
+    writer.update_item(gin, {"name": "gin", "_commit": 1})
+    # Columns that first appear partway through a commit, in a different order
+    writer.update_item(tonic, {"_commit": 1, "size": "large", "name": "tonic"})
+    assert writer.add_version({"_item": gin, "_version": 1, "name": "gin"}) == 1
+    assert writer.add_version({"size": "large", "_item": tonic, "_version": 1}) == 2
+    writer.add_rows("notes", [{"id": 1, "note": "a"}], pk="id")
+    writer.add_rows("notes", [])
+    writer.flush()
+    assert list(db["item"].rows) == [
+        {"_id": 1, "_item_id": "gin", "name": "GIN", "_commit": 1, "size": None},
+        {"_id": 2, "_item_id": "tonic", "name": "TONIC", "_commit": 1, "size": "LARGE"},
+    ]
+    assert [
+        (row["_id"], row["name"], row["size"]) for row in db["item_version"].rows
+    ] == [(1, "GIN", None), (2, None, "LARGE")]
+    assert db["notes"].pks == ["id"]
+    # Updates with different column sets, a new column, replace=True
+    writer = BatchWriter(db, "item", "item_version")
+    assert writer.item_pk("tonic") == tonic
+    writer.add_commit({"id": 2, "hash": "b"})
+    writer.update_item(gin, {"name": "gin 2"})
+    writer.update_item(tonic, {"size": "small", "abv": 0})
+    assert writer.add_version({"_item": tonic, "_version": 2, "abv": 0}) == 3
+    writer.add_rows("notes", [{"id": 1, "note": "b"}], replace=True)
+    writer.flush()
+    assert [(row["name"], row["size"], row["abv"]) for row in db["item"].rows] == [
+        ("gin 2", None, None),
+        ("TONIC", "small", 0),
+    ]
+    assert db["item_version"].get(3)["abv"] == 0
+    assert list(db["notes"].rows) == [{"id": 1, "note": "b"}]
+    # Nothing from a commit is written if any part of it fails
+    writer.add_commit({"id": 3, "hash": "c"})
+    writer.add_version({"_item": gin, "_version": 2, "name": "gin 3"})
+    writer.add_rows("notes", [{"id": 1, "note": "c"}])
+    with pytest.raises(sqlite3.IntegrityError):
+        writer.flush()
+    assert db["commits"].count == 2
+    assert db["item_version"].count == 3
+    # Column names are compared case-insensitively, as SQLite does
+    writer = BatchWriter(db, "item", "item_version")
+    statements = []
+    db.conn.set_trace_callback(statements.append)
+    writer.add_commit({"id": 3, "hash": "c"})
+    writer.update_item(gin, {"NAME": "gin 3", "Size": "large"})
+    writer.flush()
+    db.conn.set_trace_callback(None)
+    # ... so the schema does not need checking for new columns
+    assert not [sql for sql in statements if "ALTER" in sql or "PRAGMA" in sql]
+    assert db["item"].get(gin)["name"] == "gin 3"
+
+
+def test_interrupted_commit(repo, tmpdir, monkeypatch):
+    runner = CliRunner()
+    db_path = str(tmpdir / "db.db")
+    options = ["file", db_path, str(repo / "items.json"), "--repo", str(repo)]
+    options += ["--id", "product_id", "--commit-stats", "--keyframes", "1"]
+    insert = BatchWriter._insert
+    tables = []
+
+    def fail_second_commit(self, table, rows, *args, **kwargs):
+        tables.append(table)
+        if table == "item_changed" and tables.count(table) == 2:
+            raise KeyboardInterrupt
+        return insert(self, table, rows, *args, **kwargs)
+
+    monkeypatch.setattr(BatchWriter, "_insert", fail_second_commit)
+    result = runner.invoke(cli, options)
+    assert result.exit_code == 1
+    assert result.output.strip() == "Aborted!"
+    assert "item_changed" in tables
+    db = sqlite_utils.Database(db_path)
+    assert db["commits"].count == 1
+    for table in ("item_version", "item_changed", "item_keyframe"):
+        assert (
+            db.execute(
+                "select count(*) from [{}] where {} not in (select _id from item_version where _commit = 1)".format(
+                    table, "_id" if table == "item_version" else "item_version"
+                )
+            ).fetchone()[0]
+            == 0
+        )
+    # Resuming gives the same result as an uninterrupted run
+    monkeypatch.setattr(BatchWriter, "_insert", insert)
+    assert runner.invoke(cli, options).exit_code == 0
+    fresh_path = str(tmpdir / "fresh.db")
+    assert runner.invoke(cli, [options[0], fresh_path] + options[2:]).exit_code == 0
+    fresh = sqlite_utils.Database(fresh_path)
+    for table in ("item", "item_version", "item_changed", "item_keyframe"):
+        assert list(db[table].rows) == list(fresh[table].rows)
+    for table in ("item_commit_stats", "item_commit_column_stats"):
+        assert db[table].count == fresh[table].count
+
+
+def test_concurrent_namespaces(tmpdir):
+    # Two runs writing different namespaces to the same database
+    db_path = str(tmpdir / "db.db")
+    ingestors = [
+        Ingestor(
+            SQLiteSink(
+                db_path,
+                namespace,
+                commit_stats=True,
+                intern_values=True,
+                intern_threshold=10,
+            ),
+            ids=["id"],
+        )
+        for namespace in ("one", "two")
+    ]
+    for day in range(1, 4):
+        for ingestor in ingestors:
+            namespace = ingestor.sink.namespace
+            ingestor.ingest_blob(
+                datetime.datetime(2021, 1, day, tzinfo=datetime.timezone.utc),
+                "{}-{}".format(namespace, day),
+                json.dumps(
+                    [{"id": 1, "day": day, "text": "{} long text".format(namespace)}]
+                ).encode("utf-8"),
+            )
+    for ingestor in ingestors:
+        ingestor.close()
+    db = sqlite_utils.Database(db_path)
+    assert [row["hash"] for row in db["commits"].rows] == [
+        "one-1",
+        "two-1",
+        "one-2",
+        "two-2",
+        "one-3",
+        "two-3",
+    ]
+    sql = """
+        select commits.hash, v.day from [{0}_version] v
+        join commits on commits.id = v._commit
+        join [{0}_commit_stats] s on s.[commit] = commits.id
+    """
+    for ingestor in ingestors:
+        namespace = ingestor.sink.namespace
+        rows = [(row["hash"], row["day"]) for row in db.query(sql.format(namespace))]
+        assert rows == [("{}-{}".format(namespace, day), day) for day in range(1, 4)]
+        # Each run interned its own value
+        items = iterate_items_as_of(db, namespace, ingestor.sink.commit_pk)
+        assert [item["text"] for item in items] == ["{} long text".format(namespace)]
+    assert db["interned_values"].count == 2
+
+
+def test_export(repo, tmpdir):
+    make_tonic_commits(repo, ["Tonic 3", "Tonic 4"])
+    runner = CliRunner()
+    db_path = str(tmpdir / "db.db")
+    result = runner.invoke(
+        cli,
+        ["file", db_path, str(repo / "items.json"), "--repo", str(repo)]
+        + ["--id", "product_id"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    db = sqlite_utils.Database(db_path)
+    hashes = [r["hash"] for r in db["commits"].rows]
+
+    def export(*args):
+        result = runner.invoke(cli, ["export", db_path] + list(args))
+        assert result.exit_code == 0, result.output
+        return result.output
+
+    def export_lines(*args):
+        return [json.loads(line) for line in export(*args).strip().split("\n")]
+
+    items = export_lines("items", "--batch-size", "2")
+    assert [item["name"] for item in items] == ["Gin", "Tonic 4", "Rum"]
+    # Small batches exercise the keyset pagination
+    versions = export_lines("versions", "--batch-size", "2")
+    assert [(v["_item"], v["_version"], v["name"]) for v in versions] == [
+        (1, 1, "Gin"),
+        (2, 1, "Tonic"),
+        (2, 2, "Tonic 2"),
+        (3, 1, "Rum"),
+        (2, 3, "Tonic 3"),
+        (2, 4, "Tonic 4"),
+    ]
+    assert versions[4]["_changed_columns"] == ["extra", "name"]
+    assert versions[4]["_commit_hash"] == hashes[2]
+    # --full replays each item, --since filters by commit
+    versions = export_lines("versions", "--full", "--since", hashes[1], "-n", "item")
+    assert [(v["product_id"], v["name"], v["extra"]) for v in versions] == [
+        (2, "Tonic 3", 0),
+        (2, "Tonic 4", 1),
+    ]
+    versions = export_lines("versions", "--until", hashes[1], "--since", "1999-01-01")
+    assert len(versions) == 4
+    snapshot = export_lines("snapshot", "--commit", hashes[2])
+    assert [item["name"] for item in snapshot] == ["Gin", "Tonic 3", "Rum"]
+    csv_output = export("snapshot", "--csv")
+    assert csv_output.splitlines()[:2] == [
+        "_id,_item_id,_version,_commit,product_id,name,extra",
+        "1,{},1,1,1,Gin,".format(snapshot[0]["_item_id"]),
+    ]
+    result = runner.invoke(cli, ["export", db_path, "items", "--full"])
+    assert result.exit_code == 1
+    assert "--full can only be used with versions" in result.output
+
+
+@pytest.mark.parametrize(
+    "options,expected",
+    (
+        ([], ["0", "1", "2", "3", "4", "5"]),
+        (["--every", "2"], ["0", "2", "4"]),
+        (["--one-per", "day"], ["1", "4", "5"]),
+        (["--one-per", "hour"], ["0", "1", "3", "4", "5"]),
+        (["--since", "2021-01-02", "--until", "2021-01-02"], ["2", "3", "4"]),
+        (["--since", "2021-01-02", "--every", "2"], ["2", "4"]),
+    ),
+)
+def test_sampling(tmpdir, options, expected):
+    repo = tmpdir / "sampled"
+    repo.mkdir()
+    subprocess.call(["git", "init"], cwd=str(repo))
+    subprocess.call(["git", "checkout", "-b", "main"], cwd=str(repo))
+    times = [
+        "2021-01-01T10:00:00",
+        "2021-01-01T11:00:00",
+        "2021-01-02T09:00:00",
+        "2021-01-02T09:30:00",
+        "2021-01-02T14:00:00",
+        "2021-01-03T10:00:00",
+    ]
+    for i, time in enumerate(times):
+        (repo / "items.json").write_text(json.dumps([{"id": 1, "n": str(i)}]), "utf-8")
+        subprocess.call(["git", "add", "items.json"], cwd=str(repo))
+        env = dict(
+            os.environ,
+            GIT_AUTHOR_DATE=time + "+00:00",
+            GIT_COMMITTER_DATE=time + "+00:00",
+        )
+        subprocess.call(git_commit + ["-m", str(i)], cwd=str(repo), env=env)
+    runner = CliRunner()
+    db_path = str(tmpdir / "db.db")
+    result = runner.invoke(
+        cli,
+        ["file", db_path, str(repo / "items.json"), "--repo", str(repo)]
+        + ["--id", "id", "--full-versions"]
+        + options,
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    db = sqlite_utils.Database(db_path)
+    assert [r["n"] for r in db["item_version"].rows] == expected
+
+
+def test_sample_commits_open_bucket():
+    from git_history.cli import sample_commits
+
+    commits = [
+        {"hash": "a", "commit_at": "2021-01-01T10:05:00+00:00"},
+        {"hash": "b", "commit_at": "2021-01-01T10:10:00+00:00"},
+        {"hash": "c", "commit_at": "2021-01-01T10:50:00+00:00"},
+    ]
+
+    def sample(commits, now):
+        return [
+            commit["hash"]
+            for commit in sample_commits(
+                commits, one_per="hour", now=datetime.datetime.fromisoformat(now)
+            )
+        ]
+
+    # A run during the hour can't know which commit will be the last
+    assert sample(commits[:2], "2021-01-01T10:15:00+00:00") == []
+    assert sample(commits, "2021-01-01T11:00:00+00:00") == ["c"]
+    assert sample(commits, "2021-01-01T11:30:00+01:00") == []
+
+
+@pytest.mark.parametrize("compress", (False, True))
+def test_fts(repo, tmpdir, compress):
+    runner = CliRunner()
+    db_path = str(tmpdir / "db.db")
+    options = ["file", db_path, str(repo / "items.json"), "--repo", str(repo)]
+    options += ["--id", "product_id"]
+    if compress:
+        options += ["--compress", "zlib", "--compress-threshold", "4"]
+    # The first run has no index, so the second has to populate it
+    result = runner.invoke(cli, options, catch_exceptions=False)
+    assert result.exit_code == 0
+    make_tonic_commits(repo, ["Tonic Water"])
+    options += ["--fts", "name", "--fts-versions"]
+    result = runner.invoke(cli, options, catch_exceptions=False)
+    assert result.exit_code == 0
+    make_tonic_commits(repo, ["Tonic Soda"])
+    result = runner.invoke(cli, options, catch_exceptions=False)
+    assert result.exit_code == 0
+    db = sqlite_utils.Database(db_path)
+
+    def search(table, q):
+        return [
+            row[0]
+            for row in db.execute(
+                "select rowid from [{0}_fts] where [{0}_fts] match ? order by rowid".format(
+                    table
+                ),
+                [q],
+            )
+        ]
+
+    assert search("item", "tonic") == [2]
+    # Replaced values are no longer indexed
+    assert search("item", "water") == []
+    assert search("item", "soda") == [2]
+    assert search("item", "rum") == [3]
+    if not compress:
+        # Raises an error if the index does not match the item table
+        db.execute("insert into item_fts(item_fts) values ('integrity-check')")
+    # Every version that changed the name
+    assert [
+        db["item_version"].get(pk)["_version"] for pk in search("item_version", "tonic")
+    ] == [1, 2, 3, 4]
+    # Resuming with different columns is an error
+    result = runner.invoke(cli, options[:-3] + ["--fts", "extra"])
+    assert result.exit_code == 1
+    assert "item_fts already indexes name" in result.output
+
+
+@pytest.mark.parametrize("full_versions", (False, True))
+def test_commit_stats(repo, tmpdir, full_versions):
+    make_tonic_commits(repo, ["Tonic 3"])
+    runner = CliRunner()
+    db_path = str(tmpdir / "db.db")
+    options = ["file", db_path, str(repo / "items.json"), "--repo", str(repo)]
+    options += ["--id", "product_id", "--track-removals", "--commit-stats"]
+    if full_versions:
+        options.append("--full-versions")
+    result = runner.invoke(cli, options, catch_exceptions=False)
+    assert result.exit_code == 0
+    db = sqlite_utils.Database(db_path)
+    commit_stats = db.query(
+        "select seen, new, changed, unchanged, removed from item_commit_stats"
+        " order by [commit]"
+    )
+    assert list(commit_stats) == [
+        {"seen": 2, "new": 2, "changed": 0, "unchanged": 0, "removed": 0},
+        {"seen": 3, "new": 1, "changed": 1, "unchanged": 1, "removed": 0},
+        {"seen": 2, "new": 0, "changed": 1, "unchanged": 1, "removed": 1},
+    ]
+    if full_versions:
+        # Full versions do not record which columns changed
+        assert not db["item_commit_column_stats"].exists()
+    else:
+        column_stats = [
+            (row["commit"], row["name"], row["changes"])
+            for row in db.query(
+                """
+                select [commit], columns.name, changes from item_commit_column_stats
+                join columns on columns.id = item_commit_column_stats.[column]
+                order by [commit], columns.name
+                """
+            )
+        ]
+        assert column_stats == [
+            (1, "name", 2),
+            (1, "product_id", 2),
+            (2, "name", 2),
+            (2, "product_id", 1),
+            (3, "extra", 1),
+            (3, "name", 1),
+        ]
+    # Requires --id
+    result = runner.invoke(cli, options[:5] + ["--commit-stats"])
+    assert result.exit_code == 1
+    assert "--commit-stats requires --id" in result.output
+
+
+def test_memory_sink_commit_stats(repo):
+    sink = MemorySink()
+    with Ingestor(sink, ids=["product_id"]) as ingestor:
+        ingestor.ingest_items(
+            "2021-01-01T00:00:00", "a", [{"product_id": 1}, {"product_id": 2}]
+        )
+        ingestor.ingest_items(
+            "2021-01-02T00:00:00", "b", [{"product_id": 1}, {"product_id": 3}]
+        )
+    assert sink.commit_stats == {
+        "a": {"seen": 2, "new": 2, "changed": 0, "unchanged": 0, "removed": 0},
+        "b": {"seen": 2, "new": 1, "changed": 0, "unchanged": 1, "removed": 0},
+    }
+
+
+def test_optimize(repo, tmpdir):
+    runner = CliRunner()
+    db_path = str(tmpdir / "db.db")
+    options = ["file", db_path, str(repo / "items.json"), "--repo", str(repo)]
+    options += ["--id", "product_id", "--optimize"]
+    result = runner.invoke(cli, options, catch_exceptions=False)
+    assert result.exit_code == 0
+    db = sqlite_utils.Database(db_path)
+    assert {
+        (table, tuple(index.columns))
+        for table in ("commits", "item", "item_version", "item_changed")
+        for index in db[table].indexes
+        if not index.unique
+    } == {
+        ("commits", ("namespace", "commit_at", "id")),
+        ("item", ("_commit",)),
+        ("item_version", ("_item", "_version")),
+        ("item_version", ("_item", "_commit", "_version")),
+        ("item_version", ("_commit", "_item", "_version")),
+        ("item_changed", ("column", "item_version")),
+    }
+    assert db["sqlite_stat1"].exists()
+    assert "idx_item_version__item__commit__version on item_version" in result.output
+    # The standalone command is safe to run again
+    result = runner.invoke(cli, ["optimize", db_path, "-n", "item"])
+    assert result.exit_code == 0
+    assert "idx_item_changed_column_item_version on item_changed" in result.output
+    # Indexes made redundant by the composite ones are dropped from
+    # databases created before the file command stopped adding them
+    db["item_version"].create_index(["_item"])
+    db["item_version"].create_index(["_commit"])
+    result = runner.invoke(cli, ["optimize", db_path])
+    assert result.exit_code == 0
+    assert "idx_item_version__item on" not in result.output
+    assert "idx_item_version__commit on" not in result.output
+    assert {tuple(index.columns) for index in db["item_version"].indexes} == {
+        ("_item", "_version"),
+        ("_item", "_commit", "_version"),
+        ("_commit", "_item", "_version"),
+    }
+
+
+def test_commit_metadata(repo, tmpdir):
+    runner = CliRunner()
+    db_path = str(tmpdir / "db.db")
+    db = sqlite_utils.Database(db_path)
+    # A database created before the metadata columns existed, which has
+    # recorded a commit that did not change the file
+    head = subprocess.check_output(
+        ["git", "rev-parse", "HEAD"], cwd=str(repo), text=True
+    ).strip()
+    db["namespaces"].insert({"id": 1, "name": "item"}, pk="id")
+    db["commits"].insert(
+        {"id": 1, "namespace": 1, "hash": head, "commit_at": "2021-01-01"},
+        pk="id",
+        foreign_keys=(("namespace", "namespaces", "id"),),
+    )
+    (repo / "items.json").write_text(json.dumps([{"product_id": 1}]), "utf-8")
+    subprocess.call(
+        git_commit + ["-a", "-m", "Title", "-m", "Body\nwith two lines"],
+        cwd=str(repo),
+    )
+    result = runner.invoke(
+        cli,
+        ["file", db_path, str(repo / "items.json"), "--repo", str(repo)]
+        + ["--id", "product_id"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    commits = list(db.query("select * from commits order by id"))
+    assert [commit["message"] for commit in commits] == [
+        None,
+        "first",
+        "second",
+        "Title\n\nBody\nwith two lines",
+    ]
+    first, second, third = commits[1:]
+    assert first["parents"] == "[]"
+    # The parent is the commit before, even though it did not change the file
+    parent = subprocess.check_output(
+        ["git", "rev-parse", "HEAD~1"], cwd=str(repo), text=True
+    ).strip()
+    assert json.loads(third["parents"]) == [parent]
+    assert third["author_name"] == third["committer_name"] == "Tests"
+    assert third["author_email"] == "actions@users.noreply.github.com"
+    assert third["authored_at"] <= third["commit_at"]
+    assert datetime.datetime.fromisoformat(third["commit_at"]).tzinfo is not None
+
+
+@pytest.mark.parametrize(
+    "filename,options",
+    (
+        ("items.json", ["--id", "product_id"]),
+        ("items.json", ["--ignore", "name"]),
+        ("trees.csv", ["--csv", "--id", "TreeID"]),
+        ("trees.csv", ["--csv", "--ignore", "name"]),
+        ("trees.tsv", ["--dialect", "excel-tab"]),
+    ),
+)
+def test_streaming(repo, tmpdir, monkeypatch, filename, options):
+    runner = CliRunner()
+
+    def run(db_path):
+        result = runner.invoke(
+            cli,
+            ["file", db_path, str(repo / filename), "--repo", str(repo)] + options,
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0
+        db = sqlite_utils.Database(db_path)
+        return {table: list(db[table].rows) for table in db.table_names()}
+
+    expected = run(str(tmpdir / "bytes.db"))
+    # Stream every file to the converter, rather than just the large ones
+    monkeypatch.setattr("git_history.blobs.STREAM_THRESHOLD", 0)
+    assert run(str(tmpdir / "streamed.db")) == expected
+
+
+def test_accepts_streams():
+    from git_history.ingest import Ingestor
+
+    assert Ingestor(MemorySink(), csv=True).accepts_streams
+    assert Ingestor(MemorySink(), dialect="excel-tab").accepts_streams
+    # json.loads() needs the whole file anyway
+    assert not Ingestor(MemorySink()).accepts_streams
+    assert not Ingestor(MemorySink(), convert="json.loads(content)").accepts_streams
+    assert not Ingestor(MemorySink(), csv=True, parse_workers=2).accepts_streams
+
+
+def test_blob_reader(repo):
+    from git_history.blobs import BlobReader
+
+    head = subprocess.check_output(
+        ["git", "rev-parse", "HEAD"], cwd=str(repo), text=True
+    ).strip()
+    with BlobReader(str(repo)) as blobs:
+        stream = blobs.open(head, "trees.csv")
+        assert stream.size == 30
+        assert stream.read(7) == b"TreeID,"
+        # Opening another blob skips the rest of that one
+        assert blobs.read(head, "increment.txt") == b"3"
+        assert blobs.read(head, "missing.json") is None
+        assert blobs.read(head, "trees.csv") == b"TreeID,name\n1,Sophia\n2,Charlie"
+
+
+def test_multiple_branches(repo, tmpdir):
+    # release branches off from main before the "second" commit
+    subprocess.call(["git", "branch", "release", "main~3"], cwd=str(repo))
+    subprocess.call(["git", "checkout", "-q", "release"], cwd=str(repo))
+    (repo / "items.json").write_text(
+        json.dumps(
+            [{"product_id": 1, "name": "Gin"}, {"product_id": 4, "name": "Ale"}]
+        ),
+        "utf-8",
+    )
+    subprocess.call(git_commit + ["-a", "-m", "release"], cwd=str(repo))
+    subprocess.call(["git", "checkout", "-q", "main"], cwd=str(repo))
+    runner = CliRunner()
+    db_path = str(tmpdir / "db.db")
+    result = runner.invoke(
+        cli,
+        ["file", db_path, str(repo / "items.json"), "--repo", str(repo)]
+        + ["--id", "product_id", "--full-versions"]
+        + ["--branch", "main", "--branch", "release"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    db = sqlite_utils.Database(db_path)
+    # The first commit is shared, so it is only ingested once
+    assert [row["message"] for row in db["commits"].rows] == [
+        "first",
+        "second",
+        "release",
+    ]
+    refs = {
+        row["name"]: [
+            commit["message"]
+            for commit in db.query(
+                """
+                select message from commits where id in (
+                  select [commit] from ref_commits where ref = ?
+                ) order by id
+                """,
+                [row["id"]],
+            )
+        ]
+        for row in db["refs"].rows
+    }
+    assert refs == {"main": ["first", "second"], "release": ["first", "release"]}
+    # Versions of one item on each branch
+    def versions(ref):
+        return [
+            row["name"]
+            for row in db.query(
+                """
+                select name from item_version
+                where _item = (select _id from item where product_id = 2)
+                and _commit in (
+                  select [commit] from ref_commits
+                  join refs on refs.id = ref_commits.ref
+                  where refs.name = ?
+                )
+                """,
+                [ref],
+            )
+        ]
+
+    assert versions("main") == ["Tonic", "Tonic 2"]
+    assert versions("release") == ["Tonic"]
+
+
+@pytest.mark.parametrize(
+    "options", ([], ["--track-removals", "--keyframes", "2", "--store-changed-columns"])
+)
+def test_branch_deltas(tmpdir, options):
+    repo = tmpdir / "repo"
+    repo.mkdir()
+    subprocess.call(["git", "init", "-q", "-b", "main"], cwd=str(repo))
+    runner = CliRunner()
+    hashes = {}
+
+    def commit(branch, date, items):
+        subprocess.call(["git", "checkout", "-q", branch], cwd=str(repo))
+        (repo / "items.json").write_text(json.dumps(items), "utf-8")
+        subprocess.call(["git", "add", "items.json"], cwd=str(repo))
+        env = dict(os.environ, GIT_AUTHOR_DATE=date, GIT_COMMITTER_DATE=date)
+        subprocess.call(git_commit + ["-q", "-m", date], cwd=str(repo), env=env)
+        hashes[date] = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=str(repo), text=True
+        ).strip()
+
+    def ingest(db_path):
+        result = runner.invoke(
+            cli,
+            ["file", db_path, str(repo / "items.json"), "--repo", str(repo)]
+            + ["--id", "id", "--branch", "main", "--branch", "release"]
+            + options,
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0
+
+    def as_of(db_path, ref, date):
+        result = runner.invoke(
+            cli, ["as-of", db_path, hashes[date], "--ref", ref], catch_exceptions=False
+        )
+        assert result.exit_code == 0
+        return [
+            {key: value for key, value in item.items() if key in ("id", "x", "y")}
+            for item in json.loads(result.output)
+        ]
+
+    # The version on release changes x, then main changes y, then release
+    # picks up the change to y
+    commit("main", "2021-01-01T09:00:00+00:00", [{"id": 1, "x": 1, "y": 1}])
+    subprocess.call(["git", "branch", "release"], cwd=str(repo))
+    commit("release", "2021-01-01T10:00:00+00:00", [{"id": 1, "x": 2, "y": 1}])
+    commit("main", "2021-01-01T11:00:00+00:00", [{"id": 1, "x": 1, "y": 2}])
+    # A second run has to pick up where each branch was
+    one_run, two_runs = str(tmpdir / "one.db"), str(tmpdir / "two.db")
+    ingest(two_runs)
+    commit(
+        "release",
+        "2021-01-01T12:00:00+00:00",
+        [{"id": 1, "x": 2, "y": 2}, {"id": 2, "x": 0, "y": 0}],
+    )
+    commit("main", "2021-01-01T13:00:00+00:00", [])
+    ingest(one_run)
+    ingest(two_runs)
+
+    for db_path in (one_run, two_runs):
+        assert as_of(db_path, "release", "2021-01-01T12:00:00+00:00") == [
+            {"id": 1, "x": 2, "y": 2},
+            {"id": 2, "x": 0, "y": 0},
+        ]
+        assert as_of(db_path, "main", "2021-01-01T11:00:00+00:00") == [
+            {"id": 1, "x": 1, "y": 2}
+        ]
+        assert as_of(db_path, "main", "2021-01-01T13:00:00+00:00") == (
+            [] if options else [{"id": 1, "x": 1, "y": 2}]
+        )
+        # Each version only records what changed on its own branch
+        versions = [
+            (version["_commit_hash"], version["_changed_columns"])
+            for version in map(
+                json.loads,
+                runner.invoke(
+                    cli, ["export", db_path, "versions"], catch_exceptions=False
+                ).output.splitlines(),
+            )
+            if version["_item"] == 1
+        ]
+        assert versions == [
+            (hashes["2021-01-01T09:00:00+00:00"], ["id", "x", "y"]),
+            (hashes["2021-01-01T10:00:00+00:00"], ["x"]),
+            (hashes["2021-01-01T11:00:00+00:00"], ["y"]),
+            (hashes["2021-01-01T12:00:00+00:00"], ["y"]),
+        ] + ([(hashes["2021-01-01T13:00:00+00:00"], [])] if options else [])
+    # Unknown branches are an error
+    result = runner.invoke(
+        cli, ["as-of", one_run, hashes["2021-01-01T09:00:00+00:00"], "--ref", "dev"]
+    )
+    assert result.exit_code == 1
+    assert "No ref called 'dev' in 'item'" in result.output
+
+
+def test_blob_cache():
+    from git_history.blobs import Blob
+    from git_history.ingest import parse_versions
+
+    calls = []
+
+    def convert(content):
+        calls.append(content)
+        return json.loads(content)
+
+    a = Blob(b'[{"id": 1}]', "a")
+    b = Blob(b'[{"id": 2}]', "b")
+    versions = [(None, str(i), blob) for i, blob in enumerate((a, b, a, b, a))]
+    cache = collections.OrderedDict()
+    parsed = list(parse_versions(versions, convert, cache, cache_size=2))
+    assert [items for _, _, _, items in parsed] == [[{"id": 1}], [{"id": 2}]] * 2 + [
+        [{"id": 1}]
+    ]
+    assert calls == [a, b]
+    # Only the most recent blobs are kept
+    calls.clear()
+    list(parse_versions(versions, convert, collections.OrderedDict(), cache_size=1))
+    assert len(calls) == 5
+
+
+@pytest.mark.parametrize("follow", (False, True))
+def test_follow(repo, tmpdir, follow):
+    # A straight move, then a rename that also changes the file
+    (repo / "data").mkdir()
+    subprocess.call(["git", "mv", "items.json", "data/items.json"], cwd=str(repo))
+    subprocess.call(git_commit + ["-m", "move"], cwd=str(repo))
+    items = json.loads((repo / "data" / "items.json").read_text("utf-8"))
+    items.append({"product_id": 4, "name": "Ale"})
+    (repo / "data" / "items.json").remove()
+    (repo / "data" / "products.json").write_text(json.dumps(items, indent=2), "utf-8")
+    subprocess.call(["git", "add", "-A", "data"], cwd=str(repo))
+    subprocess.call(git_commit + ["-m", "rename"], cwd=str(repo))
+    runner = CliRunner()
+    db_path = str(tmpdir / "db.db")
+    options = ["file", db_path, str(repo / "data" / "products.json")]
+    options += ["--repo", str(repo), "--id", "product_id"]
+    if follow:
+        options.append("--follow")
+    result = runner.invoke(cli, options, catch_exceptions=False)
+    assert result.exit_code == 0
+    db = sqlite_utils.Database(db_path)
+    messages = [row["message"] for row in db["commits"].rows]
+    if not follow:
+        # History starts where the file got its current name
+        assert messages == ["rename"]
+        return
+    assert messages == ["first", "second", "move", "rename"]
+    assert (
+        [
+            (row["product_id"], row["name"], row["versions"])
+            for row in db.query(
+                """
+            select item.product_id, item.name, count(*) as versions from item
+            join item_version on item_version._item = item._id
+            group by item._id order by item.product_id
+            """
+            )
+        ]
+        == [(1, "Gin", 1), (2, "Tonic 2", 2), (3, "Rum", 1), (4, "Ale", 1)]
+    )
+
+
+def test_find_previous_path_similarity():
+    from git_history import follow
+
+    lines = [b"line %d" % i for i in range(1000)]
+    original = follow.piece_checksums(b"\n".join(lines))
+    edited = follow.piece_checksums(b"\n".join(lines[:900] + [b"new"] * 100))
+    unrelated = follow.piece_checksums(b"\n".join(b"other %d" % i for i in range(1000)))
+    sampled = follow.sample(original, follow.SAMPLE_RATE)
+    assert len(sampled) < len(original)
+    assert (
+        follow.similarity(sampled, follow.sample(edited, follow.SAMPLE_RATE))
+        > follow.SIMILARITY_THRESHOLD
+    )
+    assert (
+        follow.similarity(sampled, follow.sample(unrelated, follow.SAMPLE_RATE)) < 0.1
+    )
+
+
+@pytest.mark.parametrize(
+    "options",
+    (
+        [],
+        ["--keyframes", "2", "--store-changed-columns"],
+        ["--track-removals", "--fts", "name", "--fts-versions", "--commit-stats"],
+    ),
+)
+def test_rewind(repo, tmpdir, options):
+    def commit(items, message):
+        (repo / "items.json").write_text(json.dumps(items), "utf-8")
+        subprocess.call(git_commit + ["-a", "-m", message], cwd=str(repo))
+
+    def ingest(db_path, *extra):
+        return CliRunner().invoke(
+            cli,
+            ["file", db_path, str(repo / "items.json"), "--repo", str(repo)]
+            + ["--id", "product_id"]
+            + options
+            + list(extra),
+        )
+
+    def contents(db_path):
+        # Everything except the primary keys, which are not reused
+        db = sqlite_utils.Database(db_path)
+        versions = db.execute(
+            """
+            select item._item_id, _version, hash, item_version.name
+            from item_version
+              join item on item._id = item_version._item
+              join commits on commits.id = item_version._commit
+            order by hash, item._item_id
+            """
+        ).fetchall()
+        items = [
+            {
+                **{k: v for k, v in row.items() if k not in ("_id", "_commit")},
+                "_commit": db["commits"].get(row["_commit"])["hash"],
+            }
+            for row in db["item"].rows_where(order_by="_item_id")
+        ]
+        search = (
+            db.execute("select name from item_fts order by name").fetchall()
+            if db["item_fts"].exists()
+            else None
+        )
+        counts = [
+            db[table].count if db[table].exists() else None
+            for table in ("item_changed", "item_keyframe")
+        ]
+        return (
+            [row["hash"] for row in db["commits"].rows],
+            versions,
+            items,
+            search,
+            counts,
+        )
+
+    commit([{"product_id": 1, "name": "Gin X"}, {"product_id": 4, "name": "Ale"}], "3")
+    db_path = str(tmpdir / "db.db")
+    assert ingest(db_path).exit_code == 0
+    # Replace the last commit with a different one
+    subprocess.call(["git", "reset", "-q", "--hard", "HEAD~1"], cwd=str(repo))
+    commit(
+        [{"product_id": 2, "name": "Tonic 3"}, {"product_id": 5, "name": "Wine"}], "4"
+    )
+    result = ingest(db_path)
+    assert result.exit_code == 1
+    assert "1 previously imported commit is no longer in the history of main" in (
+        result.output
+    )
+    assert "--rewind" in result.output
+    assert ingest(db_path, "--rewind").exit_code == 0
+    fresh_path = str(tmpdir / "fresh.db")
+    assert ingest(fresh_path).exit_code == 0
+    assert contents(db_path) == contents(fresh_path)
+    # Nothing is left over from the commit that was rolled back
+    db = sqlite_utils.Database(db_path)
+    assert db.execute("select count(*) from item where name = 'Ale'").fetchone()[0] == 0
+    if db["item_version_fts"].exists():
+        assert (
+            list(db.query("select * from item_version_fts where name = 'Gin X'")) == []
+        )
+    if db["item_commit_stats"].exists():
+        assert db["item_commit_stats"].count == db["commits"].count
+
+
+def test_catalog(repo, tmpdir):
+    runner = CliRunner()
+    (tmpdir / "shards").mkdir()
+    paths = {}
+    for namespace, filename, id_column in (
+        ("item", "items.json", "product_id"),
+        ("trees", "trees.csv", "TreeID"),
+    ):
+        paths[namespace] = str(tmpdir / "shards" / "{}.db".format(namespace))
+        result = runner.invoke(
+            cli,
+            ["file", paths[namespace], str(repo / filename), "--repo", str(repo)]
+            + ["--id", id_column, "--namespace", namespace]
+            + (["--csv"] if filename.endswith(".csv") else []),
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0
+    catalog_path = str(tmpdir / "catalog.db")
+    result = runner.invoke(
+        cli, ["catalog", catalog_path, paths["item"], paths["trees"]]
+    )
+    assert result.exit_code == 0
+    assert result.output.splitlines() == [
+        "shard_1: {} - item".format(paths["item"]),
+        "shard_2: {} - trees".format(paths["trees"]),
+    ]
+    db = sqlite_utils.Database(catalog_path)
+    # Paths are stored relative to the catalog
+    assert [row["path"] for row in db["shards"].rows] == [
+        os.path.join("shards", "item.db"),
+        os.path.join("shards", "trees.db"),
+    ]
+    assert attach_shards(db.conn) == {
+        "shard_1": paths["item"],
+        "shard_2": paths["trees"],
+    }
+    sql = """
+        select namespaces.name, commits.hash, {0}_version._version, columns.name
+        from {0}_version
+          join commits on commits.id = {0}_version._commit
+          join namespaces on namespaces.id = commits.namespace
+          join {0}_changed on {0}_changed.item_version = {0}_version._id
+          join columns on columns.id = {0}_changed.column
+        order by {0}_version._id, columns.name
+    """
+    for namespace, path in paths.items():
+        shard = sqlite_utils.Database(path)
+        # The same rows are joined through the views as in the shard itself
+        assert (
+            db.execute(sql.format(namespace)).fetchall()
+            == shard.execute(sql.format(namespace)).fetchall()
+        )
+        assert (
+            db.execute("select count(*) from {}".format(namespace)).fetchone()
+            == shard.execute("select count(*) from {}".format(namespace)).fetchone()
+        )
+    assert db.execute("select count(*) from commits").fetchone()[0] == 3
+    assert len({row[0] for row in db.execute("select id from columns")}) == 4
+    # A namespace can only be in one shard
+    copy = str(tmpdir / "copy.db")
+    shutil.copy(paths["item"], copy)
+    result = runner.invoke(cli, ["catalog", catalog_path, copy])
+    assert result.exit_code == 1
+    assert "Namespace item is in more than one shard" in result.output
+    assert db["shards"].count == 2
+
+
+def test_merge(repo, tmpdir):
+    runner = CliRunner()
+    subprocess.call(["git", "branch", "other", "main~3"], cwd=str(repo))
+    head = subprocess.check_output(
+        ["git", "rev-parse", "HEAD"], cwd=str(repo), text=True
+    ).strip()
+    paths = {}
+    for namespace, filename, options in (
+        (
+            "item",
+            "items.json",
+            ["--id", "product_id", "--fts", "name", "--commit-stats"]
+            + ["--keyframes", "2", "--branch", "main", "--branch", "other"],
+        ),
+        ("trees", "trees.csv", ["--id", "TreeID", "--csv", "--compress", "zlib"]),
+        ("existing", "incidents.json", ["--id", "IncidentID"]),
+    ):
+        paths[namespace] = str(tmpdir / "{}.db".format(namespace))
+        result = runner.invoke(
+            cli,
+            ["file", paths[namespace], str(repo / filename), "--repo", str(repo)]
+            + ["--namespace", namespace, "--intern-values", "--intern-threshold", "1"]
+            + ["--compress-threshold", "1"]
+            + options,
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0
+    # Merge into a database that already has interned values with the same ids
+    merged_path = paths["existing"]
+    result = runner.invoke(cli, ["merge", merged_path, paths["item"], paths["trees"]])
+    assert result.exit_code == 0
+    assert result.output.splitlines() == [
+        "{}: item".format(paths["item"]),
+        "{}: trees".format(paths["trees"]),
+    ]
+    merged = sqlite_utils.Database(merged_path)
+    assert [row["name"] for row in merged["namespaces"].rows] == [
+        "existing",
+        "item",
+        "trees",
+    ]
+    for namespace in ("item", "trees"):
+        # HEAD does not change either file, so it is not a known commit
+        for path in (paths[namespace], merged_path):
+            result = runner.invoke(cli, ["as-of", path, head, "-n", namespace])
+            assert result.exit_code == 1
+            assert "Unknown commit" in result.output
+        # Items are reconstructed the same, with decoded values
+        latest = merged.execute(
+            """
+            select hash from commits where namespace =
+              (select id from namespaces where name = ?)
+            order by id desc limit 1
+            """,
+            [namespace],
+        ).fetchone()[0]
+        outputs = [
+            [
+                dict(item, _commit=None)
+                for item in json.loads(
+                    runner.invoke(cli, ["as-of", path, latest, "-n", namespace]).output
+                )
+            ]
+            for path in (paths[namespace], merged_path)
+        ]
+        assert outputs[0] == outputs[1]
+        assert {"Gin", "Sophia"} & {item["name"] for item in outputs[0]}
+        sql = """
+            select commits.hash, {0}_version._item, {0}_version._version,
+              columns.name, {0}._item_id
+            from {0}_version
+              join {0} on {0}._id = {0}_version._item
+              join commits on commits.id = {0}_version._commit
+              join {0}_changed on {0}_changed.item_version = {0}_version._id
+              join columns on columns.id = {0}_changed.column
+            order by {0}_version._id, columns.name
+        """.format(
+            namespace
+        )
+        source = sqlite_utils.Database(paths[namespace])
+        assert merged.execute(sql).fetchall() == source.execute(sql).fetchall()
+    source = sqlite_utils.Database(paths["item"])
+    for sql in (
+        """
+        select refs.name, commits.hash from ref_commits
+          join refs on refs.id = ref_commits.ref
+          join commits on commits.id = ref_commits.[commit]
+        order by refs.name, commits.hash
+        """,
+        """
+        select commits.hash, item_commit_stats.new, columns.name, changes
+        from item_commit_column_stats
+          join item_commit_stats using ([commit])
+          join commits on commits.id = item_commit_stats.[commit]
+          join columns on columns.id = item_commit_column_stats.[column]
+        order by commits.hash, columns.name
+        """,
+        "select rowid from item_fts where item_fts match 'tonic'",
+        "select * from item_keyframe",
+    ):
+        assert merged.execute(sql).fetchall() == source.execute(sql).fetchall()
+    # The merged namespace can be updated incrementally
+    commit_count = merged["commits"].count
+    result = runner.invoke(
+        cli,
+        ["file", merged_path, str(repo / "items.json"), "--repo", str(repo)]
+        + ["--namespace", "item", "--id", "product_id", "--fts", "name"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    assert merged["commits"].count == commit_count
+    # Namespaces cannot be merged twice
+    result = runner.invoke(cli, ["merge", merged_path, paths["item"]])
+    assert result.exit_code == 1
+    assert "Namespace item from {} is already in the destination".format(
+        paths["item"]
+    ) in (result.output)
+
+
+@pytest.mark.parametrize(
+    "options",
+    (
+        [],
+        ["--full-versions"],
+        ["--track-removals", "--keyframes", "2", "--store-changed-columns"]
+        + ["--fts", "name", "--fts-versions"],
+    ),
+)
+def test_compact(tmpdir, options):
+    repo = tmpdir / "repo"
+    repo.mkdir()
+    subprocess.call(["git", "init", "-q", "-b", "main"], cwd=str(repo))
+    runner = CliRunner()
+    hashes = {}
+
+    def commit(date, items):
+        (repo / "items.json").write_text(json.dumps(items), "utf-8")
+        subprocess.call(["git", "add", "items.json"], cwd=str(repo))
+        env = dict(os.environ, GIT_AUTHOR_DATE=date, GIT_COMMITTER_DATE=date)
+        subprocess.call(git_commit + ["-q", "-m", date], cwd=str(repo), env=env)
+        hashes[date] = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=str(repo), text=True
+        ).strip()
+
+    def ingest(db_path):
+        result = runner.invoke(
+            cli,
+            ["file", db_path, str(repo / "items.json"), "--repo", str(repo)]
+            + ["--id", "id"]
+            + options,
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0
+
+    def as_of(db_path, date):
+        output = runner.invoke(cli, ["as-of", db_path, hashes[date]]).output
+        # Version numbers change, but nothing else
+        return [dict(item, _version=None) for item in json.loads(output)]
+
+    gin, tonic = {"id": 1, "name": "Gin"}, {"id": 2, "name": "Tonic"}
+    commit("2021-01-01T09:00:00+00:00", [gin, tonic])
+    commit("2021-01-01T10:00:00+00:00", [dict(gin, abv=40), tonic])
+    commit("2021-01-01T11:00:00+00:00", [dict(gin, name="Gin 2", abv=40)])
+    commit("2021-01-01T12:00:00+00:00", [dict(gin, abv=40)])
+    # Changed and changed back on the same day
+    commit("2021-01-02T09:00:00+00:00", [dict(gin, abv=41), tonic])
+    commit("2021-01-02T10:00:00+01:00", [dict(gin, abv=40), tonic])
+    commit("2021-01-03T09:00:00+00:00", [dict(gin, abv=42), tonic])
+    commit("2021-01-03T10:00:00+00:00", [dict(gin, abv=43), tonic])
+    ends_of_days = [
+        "2021-01-01T12:00:00+00:00",
+        "2021-01-02T10:00:00+01:00",
+        "2021-01-03T10:00:00+00:00",
+    ]
+    db_path = str(tmpdir / "db.db")
+    ingest(db_path)
+    before = [as_of(db_path, date) for date in ends_of_days]
+    db = sqlite_utils.Database(db_path)
+    version_count = db["item_version"].count
+
+    result = runner.invoke(cli, ["compact", db_path, "--before", "2021-01-03"])
+    assert result.exit_code == 0
+    removed = version_count - db["item_version"].count
+    assert result.output == "item: removed {} versions\n".format(removed)
+    assert removed > 0
+    assert [as_of(db_path, date) for date in ends_of_days] == before
+    assert db.execute("pragma auto_vacuum").fetchone()[0] == 2
+    # Later runs only need an incremental vacuum
+    result = runner.invoke(
+        cli, ["compact", db_path, "--before", "2021-01-04", "--per", "week"]
+    )
+    assert result.exit_code == 0
+    assert db.execute("pragma freelist_count").fetchone()[0] == 0
+    assert [as_of(db_path, date) for date in ends_of_days[-1:]] == before[-1:]
+    # Versions are numbered from 1 again
+    numbers = collections.defaultdict(list)
+    for item, version in db.execute(
+        "select _item, _version from item_version order by _item, _version"
+    ):
+        numbers[item].append(version)
+    assert all(
+        versions == list(range(1, len(versions) + 1)) for versions in numbers.values()
+    )
+    # Nothing older than the cutoff is left that is not the last of its day
+    assert (
+        db.execute(
+            """
+            select count(*) from (
+              select _item, date(commit_at) from item_version
+                join commits on commits.id = item_version._commit
+              where datetime(commit_at) < '2021-01-03'
+              group by 1, 2 having count(*) > 1
+            )
+            """
+        ).fetchone()[0]
+        == 0
+    )
+    if "--full-versions" not in options:
+        # Gin's change on the 2nd was reverted, so that day records nothing
+        changed = db.execute(
+            """
+            select count(*) from item_changed
+              join item_version on item_version._id = item_changed.item_version
+              join commits on commits.id = item_version._commit
+            where item_version._item = 1 and commits.hash = ?
+            """,
+            [hashes["2021-01-02T10:00:00+01:00"]],
+        ).fetchone()[0]
+        assert changed == 0
+    if db["item_version_fts"].exists():
+        assert (
+            db.execute(
+                "select count(*) from item_version_fts where item_version_fts match 'gin'"
+            ).fetchone()[0]
+            == db.execute(
+                "select count(*) from item_version where name like 'gin%'"
+            ).fetchone()[0]
+        )
+    if "--store-changed-columns" in options:
+        assert (
+            db.execute(
+                """
+                select count(*) from item_version_detail
+                where _changed_columns != (
+                  select json_group_array(name) from (
+                    select name from columns where id in (
+                      select column from item_changed
+                      where item_version = item_version_detail._id
+                    ) order by name
+                  )
+                )
+                """
+            ).fetchone()[0]
+            == 0
+        )
+
+    if "--full-versions" in options:
+        # Incremental runs need the hashes that are only stored for deltas
+        return
+    # Incremental runs carry on as they would have without compacting
+    commit("2021-01-04T09:00:00+00:00", [dict(gin, abv=40), {"id": 3}])
+    fresh_path = str(tmpdir / "fresh.db")
+    ingest(fresh_path)
+    ingest(db_path)
+    assert as_of(db_path, "2021-01-04T09:00:00+00:00") == as_of(
+        fresh_path, "2021-01-04T09:00:00+00:00"
+    )
+    assert db["commits"].count == len(hashes)